@@ -0,0 +1,80 @@
+"""Listener fan-out benchmark.
+
+Compares the indexed dispatcher against the previous approach of opening a pipeline tap per
+listener and filtering every item in each tap. Listeners are spread evenly over a set of
+``(table, symbol)`` topics, and throughput is measured as items per second leaving storage.
+
+Run with::
+
+    python benchmarks/bench_dispatch.py
+"""
+import itertools
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import trio
+from slurry import Pipeline
+
+from bitmex_trio_websocket.dispatcher import Dispatcher
+from bitmex_trio_websocket.storage import Batch
+
+TABLES = ('orderBookL2', 'trade', 'quote', 'instrument')
+SYMBOLS = ('XBTUSD', 'ETHUSD', 'XRPUSD')
+TOPICS = list(itertools.product(TABLES, SYMBOLS))
+ITEMS = 5000
+LISTENER_COUNTS = (1, 4, 16, 32, 60)
+
+def make_items(count):
+    topics = itertools.cycle(TOPICS)
+    return [Batch([{'id': i}], symbol, table, 'update') for i, (table, symbol) in zip(range(count), topics)]
+
+async def source(items):
+    for item in items:
+        yield item
+
+async def bench_dispatcher(listeners, items):
+    dispatcher = Dispatcher()
+    received = [0]
+
+    async def consume(listener):
+        async for _ in listener:
+            received[0] += 1
+
+    start = time.perf_counter()
+    async with trio.open_nursery() as nursery:
+        for table, symbol in itertools.islice(itertools.cycle(TOPICS), listeners):
+            nursery.start_soon(consume, dispatcher.attach(table, [symbol]))
+        await dispatcher.pump(source(items), None)
+    return time.perf_counter() - start, received[0]
+
+async def bench_taps(listeners, items):
+    received = [0]
+
+    async def consume(aiter, table, symbols):
+        async with aiter:
+            async for item, item_symbol, item_table, _ in aiter:
+                if item_table == table and item_symbol in symbols:
+                    received[0] += 1
+
+    start = time.perf_counter()
+    async with Pipeline.create(source(items)) as pipeline, trio.open_nursery() as nursery:
+        for table, symbol in itertools.islice(itertools.cycle(TOPICS), listeners):
+            nursery.start_soon(consume, pipeline.tap(), table, (symbol,))
+    return time.perf_counter() - start, received[0]
+
+async def main():
+    items = make_items(ITEMS)
+    print(f'{ITEMS} items over {len(TOPICS)} topics')
+    print(f'{"listeners":>10} {"taps items/s":>14} {"dispatch items/s":>18} {"speedup":>8}')
+    for listeners in LISTENER_COUNTS:
+        tap_time, tap_received = await bench_taps(listeners, items)
+        dispatch_time, dispatch_received = await bench_dispatcher(listeners, items)
+        assert tap_received == dispatch_received
+        print(f'{listeners:>10} {ITEMS / tap_time:>14.0f} {ITEMS / dispatch_time:>18.0f}'
+              f' {tap_time / dispatch_time:>7.1f}x')
+
+if __name__ == '__main__':
+    trio.run(main)
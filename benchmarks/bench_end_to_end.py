@@ -0,0 +1,116 @@
+"""End-to-end throughput benchmark.
+
+Runs the local BitMEX server in a separate process and measures messages per second, per row
+latency percentiles and memory through ``open_bitmex_websocket`` -> ``listen``. Latency is
+measured from the row timestamp set by the server, to the time the row is yielded by the
+listener. Both processes share the host clock. Each scenario runs its client in a process of its
+own, so the peak memory reported is that of the scenario.
+
+Run with::
+
+    python benchmarks/bench_end_to_end.py [--duration SECONDS] [--scenario NAME ...]
+"""
+import argparse
+from datetime import datetime, timezone
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import trio
+from async_generator import aclosing
+
+from bitmex_trio_websocket import open_bitmex_websocket
+from bitmex_trio_websocket.testing import open_bitmex_server
+
+SYMBOLS = ('XBTUSD', 'ETHUSD', 'XRPUSD')
+
+# name: (listeners as (table, symbol), server rates, server rows)
+SCENARIOS = {
+    'book-1k': ([('orderBookL2', 'XBTUSD')], {'orderBookL2': 1000}, {}),
+    'book-max': ([('orderBookL2', 'XBTUSD')], {'orderBookL2': math.inf}, {}),
+    'trade-max': ([('trade', 'XBTUSD')], {'trade': math.inf}, {'trade': 10}),
+    'mixed': ([(table, symbol) for table in ('orderBookL2', 'trade', 'quote', 'instrument') for symbol in SYMBOLS],
+              {'orderBookL2': 500, 'trade': 200, 'quote': 200, 'instrument': 10}, {}),
+}
+
+def run_server(rates, rows, port_queue):
+    async def main():
+        async with open_bitmex_server(symbols=SYMBOLS, rates=rates, rows=rows) as server:
+            port_queue.put(server.port)
+            await trio.sleep_forever()
+    trio.run(main)
+
+def parse_timestamp(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc).timestamp()
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def measure(url, listeners, duration):
+    rows = 0
+    latencies = []
+
+    async def listen(bws, table, symbol):
+        nonlocal rows
+        async with aclosing(bws.listen(table, symbol)) as agen:
+            async for item in agen:
+                now = time.time()
+                rows += 1
+                if table != 'orderBookL2' or 'id' in item:
+                    latencies.append(now - parse_timestamp(item['timestamp']))
+
+    async with open_bitmex_websocket('testnet', url=url) as bws:
+        async with trio.open_nursery() as nursery:
+            for table, symbol in listeners:
+                nursery.start_soon(listen, bws, table, symbol)
+            # Let the partials settle before measuring.
+            await trio.sleep(0.5)
+            rows = 0
+            latencies.clear()
+            start = time.perf_counter()
+            await trio.sleep(duration)
+            elapsed = time.perf_counter() - start
+            nursery.cancel_scope.cancel()
+    latencies.sort()
+    return rows / elapsed, latencies
+
+def run_client(url, listeners, duration, result_queue):
+    throughput, latencies = trio.run(measure, url, listeners, duration)
+    summary = [percentile(latencies, fraction) for fraction in (0.5, 0.9, 0.99)]
+    summary.append(latencies[-1] if latencies else float('nan'))
+    result_queue.put((throughput, summary, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS))
+    args = parser.parse_args()
+
+    print(f'{"scenario":>10} {"rows/s":>10} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8} {"maxrss MiB":>11}')
+    for name in args.scenario or SCENARIOS:
+        listeners, rates, rows = SCENARIOS[name]
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=run_server, args=(rates, rows, port_queue), daemon=True)
+        server.start()
+        try:
+            url = f'ws://127.0.0.1:{port_queue.get(timeout=10)}/realtime'
+            result_queue = multiprocessing.Queue()
+            client = multiprocessing.Process(target=run_client, args=(url, listeners, args.duration, result_queue))
+            client.start()
+            throughput, summary, maxrss = result_queue.get()
+            client.join()
+        finally:
+            server.terminate()
+            server.join()
+        latencies = ' '.join(f'{value * 1000:>8.2f}' for value in summary)
+        print(f'{name:>10} {throughput:>10.0f} {latencies} {maxrss:>11.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Frame log replay benchmark.
+
+Records a synthetic orderBookL2 session to a temporary frame log, and measures how fast it can
+be replayed through the parser and storage engine.
+
+Run with::
+
+    python benchmarks/bench_replay.py
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import trio
+
+from bitmex_trio_websocket.recorder import Recorder, open_replay, read_frames
+
+FRAMES = 20000
+LEVELS = 500
+
+def make_frames(count):
+    rng = random.Random(0)
+    levels = [{'symbol': 'XBTUSD', 'id': i, 'side': 'Buy' if i < LEVELS // 2 else 'Sell',
+               'size': rng.randint(1, 1000), 'price': 40000.0 + i * 0.5} for i in range(LEVELS)]
+    yield json.dumps({'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+                      'attributes': {}, 'data': levels})
+    for _ in range(count - 1):
+        rows = [{'symbol': 'XBTUSD', 'id': level['id'], 'side': level['side'], 'size': rng.randint(1, 1000)}
+                for level in rng.sample(levels, 3)]
+        yield json.dumps({'table': 'orderBookL2', 'action': 'update', 'data': rows})
+
+async def main():
+    for compress in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frames.log')
+            recorder = Recorder(path, compress=compress)
+            recorder._open() # pylint: disable=protected-access
+            for frame in make_frames(FRAMES):
+                recorder.write(frame)
+            recorder.close()
+            size = os.path.getsize(path)
+
+            start = time.perf_counter()
+            for _ in read_frames(path):
+                pass
+            read_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            async with open_replay(path) as pipeline, pipeline.tap() as aiter:
+                async for _ in aiter:
+                    pass
+            replay_time = time.perf_counter() - start
+
+        print(f'compress={compress!s:5} size={size / 2 ** 20:6.1f} MiB '
+              f'read={FRAMES / read_time:9.0f} frames/s replay={FRAMES / replay_time:7.0f} frames/s')
+
+if __name__ == '__main__':
+    trio.run(main)
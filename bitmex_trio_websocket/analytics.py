@@ -0,0 +1,183 @@
+"""Incrementally maintained order book analytics."""
+from typing import Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+
+# Table that analytics updates are routed under
+ANALYTICS_TABLE = 'bookAnalytics'
+
+# Depth bands, in basis points from the mid price
+DEFAULT_BANDS = (10, 25, 50, 100)
+
+class BookMetrics(NamedTuple):
+    """
+    Derived values of an order book.
+
+    ``imbalance`` is ``(bids - asks) / (bids + asks)`` of the total size of the top levels of each
+    side. ``bid_depth`` and ``ask_depth`` hold the total size of the levels within each depth band
+    from the mid price, and ``bid_price`` and ``ask_price`` the size weighted average price of the
+    levels within each band. Values are ``None`` while a side of the book is empty.
+    """
+    symbol: str
+    sequence: int
+    mid: Optional[float]
+    microprice: Optional[float]
+    imbalance: Optional[float]
+    bid_depth: Tuple[float, ...]
+    ask_depth: Tuple[float, ...]
+    bid_price: Tuple[Optional[float], ...]
+    ask_price: Tuple[Optional[float], ...]
+
+# Metrics that thresholds apply to
+METRIC_FIELDS = BookMetrics._fields[2:]
+
+class BookAnalytics:
+    """
+    Keeps the :class:`BookMetrics` of an order book up to date, as its levels change.
+
+    The order book reports every level change with :meth:`change`, and :meth:`refresh` is called
+    once per message. The total size of the top levels, and the size and notional value within
+    each band, are adjusted by the change of each level, rather than summed over the book. When
+    the mid price moves, only the levels between the old and the new edge of each band are
+    added or removed. The cost of a message is therefore proportional to the number of levels it
+    changes, plus ``levels`` if it changes the top of the book.
+
+    :param book: The order book.
+    :param int levels: Number of levels per side used for the imbalance.
+    :param bands: Depth bands, in basis points from the mid price.
+    """
+    def __init__(self, book, levels: int = 10, bands: Sequence[float] = DEFAULT_BANDS):
+        if levels < 1:
+            raise ValueError('levels must be at least 1')
+        if not bands or any(band <= 0 for band in bands):
+            raise ValueError('bands must be positive basis points')
+        self.book = book
+        self.levels = levels
+        self.bands = tuple(sorted(bands))
+        self.metrics = None
+        # Everything is recomputed on the next refresh, after the book has been cleared.
+        self._full = True
+        self._top_dirty = {'Buy': True, 'Sell': True}
+        self._top = {'Buy': 0.0, 'Sell': 0.0}
+        # Band edge prices, and the size and notional value within each band, per side.
+        self._edges = {'Buy': None, 'Sell': None}
+        self._sizes = {'Buy': [0.0] * len(self.bands), 'Sell': [0.0] * len(self.bands)}
+        self._notionals = {'Buy': [0.0] * len(self.bands), 'Sell': [0.0] * len(self.bands)}
+
+    def reset(self):
+        """Recompute everything on the next refresh."""
+        self._full = True
+
+    def _in_top(self, side: str, price: float) -> bool:
+        levels = self.book.bids if side == 'Buy' else self.book.asks
+        if len(levels) <= self.levels:
+            return True
+        if side == 'Buy':
+            return price >= levels.keys()[-self.levels]
+        return price <= levels.keys()[self.levels - 1]
+
+    def change(self, side: str, price: float, old: float, new: float):
+        """Account for the size of a level changing from ``old`` to ``new``. Removed levels have size 0."""
+        if self._full or old == new:
+            return
+        if not self._top_dirty[side] and self._in_top(side, price):
+            self._top_dirty[side] = True
+        edges = self._edges[side]
+        if edges is None:
+            return
+        difference = new - old
+        sizes, notionals = self._sizes[side], self._notionals[side]
+        # Bands are nested, so a level is in every band from the first band that holds it.
+        for index, edge in enumerate(edges):
+            if price >= edge if side == 'Buy' else price <= edge:
+                for band in range(index, len(edges)):
+                    sizes[band] += difference
+                    notionals[band] += difference * price
+                break
+
+    def _sum_top(self, side: str):
+        self._top[side] = sum(size for _, size in self.book.depth(side, self.levels))
+        self._top_dirty[side] = False
+
+    def _move_edges(self, side: str, mid: float):
+        """Moves the band edges of a side to a new mid price."""
+        levels = self.book.bids if side == 'Buy' else self.book.asks
+        sign = -1 if side == 'Buy' else 1
+        edges = [mid * (1 + sign * band / 10000) for band in self.bands]
+        old = self._edges[side]
+        sizes, notionals = self._sizes[side], self._notionals[side]
+        if old is None:
+            for index, edge in enumerate(edges):
+                prices = list(levels.irange(edge, None) if side == 'Buy' else levels.irange(None, edge))
+                sizes[index] = sum(levels[price] for price in prices)
+                notionals[index] = sum(levels[price] * price for price in prices)
+        else:
+            for index, (before, after) in enumerate(zip(old, edges)):
+                if before == after:
+                    continue
+                # Levels between the edges enter the band when it widens, and leave it when it narrows.
+                if side == 'Buy':
+                    prices = levels.irange(min(before, after), max(before, after), inclusive=(True, False))
+                    direction = 1 if after < before else -1
+                else:
+                    prices = levels.irange(min(before, after), max(before, after), inclusive=(False, True))
+                    direction = 1 if after > before else -1
+                for price in prices:
+                    size = levels[price]
+                    sizes[index] += direction * size
+                    notionals[index] += direction * size * price
+        self._edges[side] = edges
+
+    def refresh(self, sequence: int = 0) -> bool:
+        """Updates the metrics after a message. Returns ``True`` if they changed."""
+        book = self.book
+        if self._full:
+            self._full = False
+            self._top_dirty = {'Buy': True, 'Sell': True}
+            self._edges = {'Buy': None, 'Sell': None}
+        for side in ('Buy', 'Sell'):
+            if self._top_dirty[side]:
+                self._sum_top(side)
+        bid, ask = book.best_bid, book.best_ask
+        empty = (None,) * len(self.bands)
+        if bid is None or ask is None:
+            # Band edges are relative to the mid price, so start over once both sides are back.
+            self._full = True
+            mid = microprice = None
+            bid_depth = ask_depth = (0.0,) * len(self.bands)
+            bid_price = ask_price = empty
+        else:
+            mid = (bid[0] + ask[0]) / 2
+            microprice = (bid[0] * ask[1] + ask[0] * bid[1]) / (bid[1] + ask[1]) if bid[1] + ask[1] else mid
+            for side in ('Buy', 'Sell'):
+                self._move_edges(side, mid)
+            bid_depth, ask_depth = tuple(self._sizes['Buy']), tuple(self._sizes['Sell'])
+            bid_price = tuple(notional / size if size else None
+                              for size, notional in zip(bid_depth, self._notionals['Buy']))
+            ask_price = tuple(notional / size if size else None
+                              for size, notional in zip(ask_depth, self._notionals['Sell']))
+        total = self._top['Buy'] + self._top['Sell']
+        imbalance = (self._top['Buy'] - self._top['Sell']) / total if total and mid is not None else None
+        metrics = BookMetrics(book.symbol, sequence, mid, microprice, imbalance, bid_depth, ask_depth,
+                              bid_price, ask_price)
+        previous = self.metrics
+        self.metrics = metrics
+        return previous is None or previous[2:] != metrics[2:]
+
+def exceeds(previous: Optional[BookMetrics], current: BookMetrics,
+            threshold: Union[float, Mapping[str, float]] = 0) -> bool:
+    """
+    Returns ``True`` if any metric changed by more than the threshold. ``threshold`` is either an
+    absolute threshold for all metrics, or a mapping of metric name to threshold, in which case
+    only the given metrics are compared. Band metrics change if any of their bands do.
+    """
+    if previous is None:
+        return True
+    thresholds = threshold if isinstance(threshold, Mapping) else dict.fromkeys(METRIC_FIELDS, threshold)
+    for name, limit in thresholds.items():
+        before, after = getattr(previous, name), getattr(current, name)
+        pairs = zip(before, after) if isinstance(after, tuple) else ((before, after),)
+        for old, new in pairs:
+            if (old is None) != (new is None):
+                return True
+            if old is not None and abs(new - old) > limit:
+                return True
+    return False
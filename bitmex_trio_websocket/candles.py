@@ -0,0 +1,190 @@
+"""Incremental OHLCV candle aggregation from the trade stream."""
+from collections import Counter
+import logging
+from time import time_ns
+from typing import List, Optional
+
+import trio
+
+from .history import parse_timestamp
+from .storage import Batch
+
+log = logging.getLogger(__name__)
+
+def candle_table(interval: float) -> str:
+    """Name of the table that candles of an interval are routed under."""
+    return f'candle:{interval:g}s'
+
+def candle_key(table: str, candle: 'Candle') -> tuple:
+    """Conflation key of a candle. Updates of a candle replace each other, but not other candles."""
+    return (candle.symbol, candle.interval, candle.start)
+
+class Candle:
+    """
+    An OHLCV bar for a symbol and interval.
+
+    ``start`` and ``end`` are epoch nanoseconds. ``turnover`` is the sum of price times size, and
+    is used to calculate the volume weighted average price. A candle is ``closed`` once its
+    interval has ended, after which it is no longer updated.
+    """
+    __slots__ = ('symbol', 'interval', 'start', 'end', 'open', 'high', 'low', 'close', 'volume',
+                 'turnover', 'trades', 'closed')
+
+    def __init__(self, symbol: str, interval: float, start: int, end: int, price: float):
+        self.symbol = symbol
+        self.interval = interval
+        self.start = start
+        self.end = end
+        self.open = self.high = self.low = self.close = price
+        self.volume = 0
+        self.turnover = 0.0
+        self.trades = 0
+        self.closed = False
+
+    def add(self, price: float, size: float):
+        """Add a trade to the candle."""
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += size
+        self.turnover += price * size
+        self.trades += 1
+
+    @property
+    def vwap(self) -> Optional[float]:
+        """Volume weighted average price, or ``None`` if there is no volume."""
+        return self.turnover / self.volume if self.volume else None
+
+    def __repr__(self):
+        return (f'<Candle {self.symbol} {self.interval:g}s start={self.start} o={self.open} h={self.high} '
+                f'l={self.low} c={self.close} v={self.volume} closed={self.closed}>')
+
+class CandleAggregator:
+    """
+    Aggregates trades from storage into candles of arbitrary intervals.
+
+    :meth:`derive` is a storage hook for the trade table, see :meth:`Storage.add_hook`. Each
+    inserted trade updates the current candle of every registered interval for its symbol, in
+    O(1), and the candle is returned with the ``'update'`` action, under the table given by
+    :func:`candle_table`. Intervals are aligned to the epoch.
+
+    A candle is closed and returned with the ``'close'`` action, when a trade from a later interval
+    arrives, or sent by :meth:`close_expired` at the latest ``grace`` seconds after the interval has
+    ended by the local clock. Trades for an interval that has already been closed are counted in
+    :attr:`late` and ignored.
+
+    :param float grace: Seconds to wait for late trades, before closing a candle by the clock.
+    """
+    # Seconds between checks for candles to close by the clock
+    CLOSE_INTERVAL = 0.1
+
+    def __init__(self, grace: float = 0.5):
+        self.grace = grace
+        self.late = 0
+        # (symbol, interval) -> registration count
+        self._intervals = Counter()
+        # symbol -> {interval: current candle or None}
+        self._candles = {}
+        # (symbol, interval) -> start of the last closed candle
+        self._closed = {}
+        self._closing = False
+
+    def register(self, symbol: str, interval: float):
+        """Start aggregating candles of an interval for a symbol."""
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        self._intervals[symbol, interval] += 1
+        self._candles.setdefault(symbol, {}).setdefault(interval, None)
+
+    def unregister(self, symbol: str, interval: float):
+        """Stop aggregating candles of an interval for a symbol, when there are no more registrations."""
+        self._intervals[symbol, interval] -= 1
+        if self._intervals[symbol, interval] <= 0:
+            del self._intervals[symbol, interval]
+            self._closed.pop((symbol, interval), None)
+            candles = self._candles[symbol]
+            del candles[interval]
+            if not candles:
+                del self._candles[symbol]
+
+    @property
+    def active(self) -> bool:
+        """``True`` while any interval is registered."""
+        return bool(self._candles)
+
+    def candle(self, symbol: str, interval: float) -> Optional[Candle]:
+        """The current candle of a symbol and interval, if any."""
+        return self._candles.get(symbol, {}).get(interval)
+
+    def _close(self, candle: Candle, output: List[Batch]):
+        if candle.closed:
+            return
+        candle.closed = True
+        candles = self._candles.get(candle.symbol)
+        if candles is not None and candles.get(candle.interval) is candle:
+            candles[candle.interval] = None
+        self._closed[candle.symbol, candle.interval] = candle.start
+        output.append(Batch([candle], candle.symbol, candle_table(candle.interval), 'close'))
+
+    def _trade(self, trade, candles, output: List[Batch]):
+        symbol = trade['symbol']
+        timestamp = parse_timestamp(trade['timestamp'])
+        price = trade['price']
+        size = trade['size']
+        for interval, candle in list(candles.items()):
+            length = int(interval * 1_000_000_000)
+            start = timestamp - timestamp % length
+            if candle is not None and start > candle.start:
+                self._close(candle, output)
+                candle = None
+            if candle is None:
+                if start <= self._closed.get((symbol, interval), -1):
+                    self.late += 1
+                    continue
+                candle = candles[interval] = Candle(symbol, interval, start, start + length, price)
+            elif start < candle.start:
+                self.late += 1
+                continue
+            candle.add(price, size)
+            output.append(Batch([candle], symbol, candle_table(interval), 'update'))
+
+    def derive(self, batch: Batch) -> List[Batch]:
+        """Aggregates the trades of a trade batch, and returns the updated and closed candles."""
+        output = []
+        if batch.action == 'insert':
+            for row in batch.rows:
+                candles = self._candles.get(row['symbol'])
+                if candles:
+                    self._trade(row, candles, output)
+        return output
+
+    def expired(self) -> List[Batch]:
+        """Closes the candles that ended more than ``grace`` seconds ago by the local clock."""
+        output = []
+        cutoff = time_ns() - int(self.grace * 1_000_000_000)
+        for candles in list(self._candles.values()):
+            for candle in list(candles.values()):
+                if candle is not None and candle.end <= cutoff:
+                    self._close(candle, output)
+        return output
+
+    async def close_expired(self, output):
+        """
+        Sends expired candles to ``output``, while any interval is registered, so quiet symbols
+        don't hold back closed candles. Use :meth:`start` to run it.
+        """
+        try:
+            while self._candles:
+                await trio.sleep(self.CLOSE_INTERVAL)
+                for batch in self.expired():
+                    await output(batch)
+        finally:
+            self._closing = False
+
+    def start(self, nursery: trio.Nursery, output):
+        """Runs :meth:`close_expired` in a nursery, unless it is already running."""
+        if not self._closing:
+            self._closing = True
+            nursery.start_soon(self.close_expired, output)
@@ -0,0 +1,70 @@
+"""JSON backends for encoding and decoding websocket frames."""
+from collections import namedtuple
+from functools import partial
+import json
+from typing import Optional, Tuple, Union
+
+JSONBackend = namedtuple('JSONBackend', ['name', 'loads', 'dumps'])
+
+# Data frames from BitMEX always begin with the table, followed by the action.
+_TABLE_PREFIX = '{"table":"'
+_TABLE_PREFIX_BYTES = b'{"table":"'
+_ACTION_SEPARATOR = '","action":"'
+_ACTION_SEPARATOR_BYTES = b'","action":"'
+
+def _orjson():
+    import orjson # pylint: disable=import-outside-toplevel
+    return JSONBackend('orjson', orjson.loads, lambda obj: orjson.dumps(obj).decode())
+
+def _ujson():
+    import ujson # pylint: disable=import-outside-toplevel
+    return JSONBackend('ujson', ujson.loads, ujson.dumps)
+
+def _json():
+    return JSONBackend('json', json.loads, partial(json.dumps, separators=(',', ':')))
+
+_BACKENDS = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+def get_backend(name: Optional[str] = None) -> JSONBackend:
+    """
+    Returns a JSON backend by name. Options: ``'orjson'``, ``'ujson'``, ``'json'``.
+
+    If no name is given, the fastest installed backend is used, falling back to the standard
+    library json module.
+    """
+    if name is not None:
+        if name not in _BACKENDS:
+            raise ValueError(f'Unknown JSON backend: {name}')
+        return _BACKENDS[name]()
+    for factory in _BACKENDS.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+    raise RuntimeError('No JSON backend available.') # pragma: no cover
+
+def route(frame: Union[str, bytes]) -> Optional[Tuple[str, str]]:
+    """
+    Extracts ``(table, action)`` from a raw data frame, without decoding it.
+
+    Returns ``None`` if the frame is not a data frame, or is formatted unexpectedly, in which case
+    the frame must be fully decoded to find out what it contains.
+    """
+    if isinstance(frame, str):
+        prefix, separator = _TABLE_PREFIX, _ACTION_SEPARATOR
+    else:
+        prefix, separator = _TABLE_PREFIX_BYTES, _ACTION_SEPARATOR_BYTES
+    if not frame.startswith(prefix):
+        return None
+    start = len(prefix)
+    end = frame.find(separator, start)
+    if end < 0:
+        return None
+    action_start = end + len(separator)
+    action_end = frame.find(separator[0:1], action_start)
+    if action_end < 0:
+        return None
+    table, action = frame[start:end], frame[action_start:action_end]
+    if not isinstance(frame, str):
+        table, action = table.decode(), action.decode()
+    return table, action
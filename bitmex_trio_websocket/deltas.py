@@ -0,0 +1,94 @@
+"""Normalized price level deltas of order books."""
+from collections import Counter
+import logging
+from typing import Callable, List, NamedTuple, Tuple
+
+from .orderbook import OrderBook
+from .storage import Batch
+
+log = logging.getLogger(__name__)
+
+# Table that book deltas are routed under
+DELTA_TABLE = 'bookDeltas'
+
+# A (side, price, size) price level. A size of 0 means the level was removed.
+LevelChange = Tuple[str, float, float]
+
+class BookDelta(NamedTuple):
+    """
+    Changes to the price levels of an order book, from a single message.
+
+    ``sequence`` increases by one for every delta of a symbol, so gaps show that deltas were
+    missed. If ``snapshot`` is true, ``levels`` holds every level of the book, bids then asks from
+    the top of the book, and replaces any previous state.
+    """
+    symbol: str
+    sequence: int
+    snapshot: bool
+    levels: List[LevelChange]
+
+class BookDeltas:
+    """
+    Turns orderBookL2 storage output into :class:`BookDelta` items for registered symbols.
+
+    :meth:`derive` is a storage hook for the orderBookL2 table, see :meth:`Storage.add_hook`. After
+    each orderBookL2 message for a registered symbol, the price levels changed by the message are
+    returned with the ``'update'`` action, under :data:`DELTA_TABLE`. Levels are aggregated by price, so each level appears once per delta, with
+    its new size. Partials, and resynchronization after a reconnect, produce a snapshot with the
+    ``'partial'`` action instead.
+
+    :param order_book: Function that returns the order book of a symbol. Usually
+        :meth:`Storage.order_book`.
+    """
+    def __init__(self, order_book: Callable[[str], OrderBook]):
+        self._order_book = order_book
+        # symbol -> registration count
+        self._symbols = Counter()
+        # symbol -> sequence number of the last delta
+        self._sequences = Counter()
+
+    def register(self, symbol: str):
+        """Start tracking deltas of a symbol."""
+        if not self._symbols[symbol]:
+            book = self._order_book(symbol)
+            book.deltas = {}
+            book.reset = False
+        self._symbols[symbol] += 1
+
+    def unregister(self, symbol: str):
+        """Stop tracking deltas of a symbol, when there are no more registrations."""
+        self._symbols[symbol] -= 1
+        if self._symbols[symbol] <= 0:
+            del self._symbols[symbol]
+            self._order_book(symbol).deltas = None
+
+    @property
+    def active(self) -> bool:
+        """``True`` while any symbol is registered."""
+        return bool(self._symbols)
+
+    def snapshot(self, symbol: str) -> BookDelta:
+        """A snapshot of the current book of a symbol, with the sequence number of the last delta."""
+        book = self._order_book(symbol)
+        levels = [('Buy', price, size) for price, size in book.depth('Buy')]
+        levels.extend(('Sell', price, size) for price, size in book.depth('Sell'))
+        return BookDelta(symbol, self._sequences[symbol], True, levels)
+
+    def derive(self, batch: Batch) -> List[Batch]:
+        """Returns the delta of an orderBookL2 batch of a registered symbol, if the book changed."""
+        symbol = batch.symbol
+        if symbol not in self._symbols:
+            return []
+        book = self._order_book(symbol)
+        if book.reset or batch.action == 'partial':
+            book.deltas.clear()
+            book.reset = False
+            self._sequences[symbol] += 1
+            return [Batch([self.snapshot(symbol)], symbol, DELTA_TABLE, 'partial')]
+        if book.deltas:
+            levels = [(side, price, size) for (side, price), size in book.deltas.items()]
+            book.deltas.clear()
+            self._sequences[symbol] += 1
+            delta = BookDelta(symbol, self._sequences[symbol], False, levels)
+            return [Batch([delta], symbol, DELTA_TABLE, 'update')]
+        return []
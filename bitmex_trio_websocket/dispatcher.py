@@ -0,0 +1,289 @@
+"""Routes storage output to listeners."""
+from collections import Counter, deque
+import logging
+import math
+from time import perf_counter_ns
+from typing import Callable, Hashable, Optional, Sequence
+
+from async_generator import aclosing
+from slurry.sections.abc import Section
+import trio
+
+from .exceptions import BitMEXWebsocketOverflowError
+from .storage import Batch
+
+log = logging.getLogger(__name__)
+
+# Overflow policies for bounded listeners
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'conflate', 'raise')
+
+class Listener:
+    """A single listener registration.
+
+    Items routed to the listener are queued until the consumer iterates the listener. The queue
+    holds at most ``max_buffer_size`` items. When it is full, the ``overflow`` policy decides what
+    happens to the next item:
+
+    * ``'block'`` - Wait for the consumer. This applies backpressure to the whole pipeline.
+    * ``'drop_oldest'`` - Discard the oldest queued item.
+    * ``'conflate'`` - Replace the queued item with the same storage key, keeping its place in the
+      queue. If there is none, the oldest queued item is discarded.
+    * ``'raise'`` - Raise :class:`BitMEXWebsocketOverflowError` in the consumer.
+
+    A conflating listener always replaces a queued item with a newer item for the same storage key,
+    whether the queue is full or not. The consumer then gets the latest version of each row, and
+    the work done by the consumer is bounded by the number of distinct rows, rather than the
+    message rate.
+
+    A batch listener receives a :class:`~bitmex_trio_websocket.storage.Batch` of rows per message
+    instead of single rows, and its queue holds batches. Batches can't be conflated.
+
+    :param bool conflate: Always conflate queued items by storage key.
+    :param key: Function that returns the storage key for an item. Used for conflation.
+    :param bool batches: Receive a batch of rows per message.
+    """
+    def __init__(self, table: str, symbols: Sequence[str], *,
+                 max_buffer_size: float = math.inf, overflow: str = 'block', conflate: bool = False,
+                 key: Optional[Callable[[str, object], Optional[Hashable]]] = None, batches: bool = False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow must be one of: {", ".join(OVERFLOW_POLICIES)}')
+        if max_buffer_size < 1:
+            raise ValueError('max_buffer_size must be at least 1')
+        if batches and (conflate or overflow == 'conflate'):
+            raise ValueError('Batch listeners can\'t be conflated.')
+        if (conflate or overflow == 'conflate') and key is None:
+            raise ValueError('Conflation requires a key function.')
+        self.table = table
+        self.symbols = tuple(symbols)
+        self.max_buffer_size = max_buffer_size
+        self.overflow = overflow
+        self.conflate = conflate
+        self.batches = batches
+        self.attached = True
+        self.dropped = 0
+        self.conflated = 0
+        self._key = key
+        # Entries are [key, item] lists, so conflation can replace an item in place.
+        self._queue = deque()
+        self._pending = {}
+        self._error = None
+        self._closed = False
+        self._readable = trio.lowlevel.ParkingLot()
+        self._writable = trio.lowlevel.ParkingLot()
+
+    @property
+    def backlog(self) -> int:
+        """Number of items delivered to the listener, that have not been consumed yet."""
+        return len(self._queue)
+
+    @property
+    def keys(self):
+        """The routing keys this listener is registered under."""
+        if not self.symbols:
+            return [(self.table, None)]
+        return [(self.table, symbol) for symbol in self.symbols]
+
+    def _append(self, item, key=None):
+        entry = [key, item]
+        self._queue.append(entry)
+        if key is not None:
+            self._pending[key] = entry
+        if self._readable:
+            self._readable.unpark()
+
+    def _popleft(self):
+        entry = self._queue.popleft()
+        if entry[0] is not None and self._pending.get(entry[0]) is entry:
+            del self._pending[entry[0]]
+        if self._writable:
+            self._writable.unpark()
+        return entry[1]
+
+    def put_nowait(self, item) -> bool:
+        """
+        Queue an item, applying the overflow policy if the queue is full.
+
+        Returns ``False`` if the policy is ``'block'`` and the queue is full. The item is not queued
+        in that case.
+        """
+        if self._closed:
+            raise trio.ClosedResourceError
+        key = None
+        if self.conflate or self.overflow == 'conflate':
+            key = self._key(self.table, item)
+            entry = self._pending.get(key) if key is not None else None
+            if entry is not None and (self.conflate or len(self._queue) >= self.max_buffer_size):
+                entry[1] = item
+                self.conflated += 1
+                return True
+        if len(self._queue) < self.max_buffer_size:
+            self._append(item, key)
+            return True
+        overflow = self.overflow
+        if overflow == 'block':
+            return False
+        if overflow == 'raise':
+            if self._error is None:
+                self._error = BitMEXWebsocketOverflowError(self.table, self.max_buffer_size)
+                self._readable.unpark_all()
+            self.dropped += 1
+            return True
+        self._popleft()
+        self.dropped += 1
+        self._append(item, key)
+        return True
+
+    async def put(self, item):
+        """Queue an item, waiting for room if the policy is ``'block'``."""
+        while not self.put_nowait(item):
+            await self._writable.park()
+
+    def close(self):
+        """Close the listener. The consumer finishes iterating any queued items."""
+        self.attached = False
+        self._closed = True
+        self._readable.unpark_all()
+        self._writable.unpark_all()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await trio.lowlevel.checkpoint_if_cancelled()
+        while True:
+            if self._error is not None:
+                raise self._error
+            if self._queue:
+                item = self._popleft()
+                await trio.lowlevel.cancel_shielded_checkpoint()
+                return item
+            if self._closed:
+                raise StopAsyncIteration
+            await self._readable.park()
+
+class Dispatcher(Section):
+    """Fans out storage output to listeners.
+
+    Listeners are indexed by ``(table, symbol)``. A listener without symbols is indexed by
+    ``(table, None)`` and receives every item from the table. Each item is only handed to the
+    listeners that match it, so the cost of routing an item is proportional to the number of
+    interested listeners, rather than the total number of listeners.
+
+    Storage output arrives as one :class:`~bitmex_trio_websocket.storage.Batch` per message. Batch
+    listeners get the batch, or the part of it for their symbol, in a single queue operation, while
+    other listeners get the rows one by one. Rows are only grouped by symbol when the batch has
+    no symbol and the table has listeners for specific symbols.
+
+    :param key: Function that returns the storage key for an item. Used by conflating listeners.
+    """
+    def __init__(self, key: Optional[Callable[[str, object], Optional[Hashable]]] = None):
+        self._routes = {}
+        self._tables = Counter()
+        # Tables with listeners for specific symbols
+        self._symbol_tables = Counter()
+        self._key = key
+        # Optional metrics collector
+        self.metrics = None
+
+    @property
+    def listeners(self):
+        """All attached listeners."""
+        return {listener for listeners in self._routes.values() for listener in listeners}
+
+    def attach(self, table: str, symbols: Optional[Sequence[str]] = (), *,
+               max_buffer_size: float = math.inf, overflow: str = 'block', conflate: bool = False,
+               batches: bool = False,
+               key: Optional[Callable[[str, object], Optional[Hashable]]] = None) -> Listener:
+        """
+        Register a new listener for a table and optionally a set of symbols. ``key`` replaces the
+        key function of the dispatcher, for items that are not storage rows.
+        """
+        listener = Listener(table, symbols or (), max_buffer_size=max_buffer_size, overflow=overflow,
+                            conflate=conflate, key=key or self._key, batches=batches)
+        for key in listener.keys:
+            self._routes[key] = self._routes.get(key, ()) + (listener,)
+        self._tables[table] += 1
+        if listener.symbols:
+            self._symbol_tables[table] += 1
+        return listener
+
+    def detach(self, listener: Listener):
+        """Remove a listener. Any undelivered items are discarded."""
+        if not listener.attached:
+            return
+        for key in listener.keys:
+            listeners = tuple(l for l in self._routes.get(key, ()) if l is not listener)
+            if listeners:
+                self._routes[key] = listeners
+            else:
+                self._routes.pop(key, None)
+        self._tables[listener.table] -= 1
+        if self._tables[listener.table] <= 0:
+            del self._tables[listener.table]
+        if listener.symbols:
+            self._symbol_tables[listener.table] -= 1
+            if self._symbol_tables[listener.table] <= 0:
+                del self._symbol_tables[listener.table]
+        listener.close()
+
+    def listening(self, table: str) -> bool:
+        """Returns ``True`` if any listener is attached to the table."""
+        return table in self._tables
+
+    def close(self):
+        """Close all listeners. Listeners will finish iterating any items already delivered."""
+        for listeners in self._routes.values():
+            for listener in listeners:
+                listener.close()
+        self._routes.clear()
+        self._tables.clear()
+        self._symbol_tables.clear()
+
+    async def _deliver(self, listeners, batch: Batch):
+        for listener in listeners:
+            try:
+                if listener.batches:
+                    if not listener.put_nowait(batch):
+                        await listener.put(batch)
+                else:
+                    for item in batch.rows:
+                        if not listener.put_nowait(item):
+                            await listener.put(item)
+            except trio.ClosedResourceError:
+                # The consumer went away without detaching.
+                self.detach(listener)
+
+    @staticmethod
+    def _by_symbol(batch: Batch):
+        """Split a batch into a batch per symbol."""
+        groups = {}
+        for row in batch.rows:
+            symbol = row.get('symbol')
+            if symbol is not None:
+                groups.setdefault(symbol, []).append(row)
+        return [batch._replace(rows=rows, symbol=symbol) for symbol, rows in groups.items()]
+
+    async def publish(self, batch: Batch):
+        """Routes a :class:`~bitmex_trio_websocket.storage.Batch` to matching listeners."""
+        table = batch.table
+        listeners = self._routes.get((table, None))
+        if listeners:
+            await self._deliver(listeners, batch)
+        if table in self._symbol_tables:
+            for part in (batch,) if batch.symbol is not None else self._by_symbol(batch):
+                listeners = self._routes.get((table, part.symbol))
+                if listeners:
+                    await self._deliver(listeners, part)
+
+    async def pump(self, input, output):
+        """Routes :class:`~bitmex_trio_websocket.storage.Batch` items from storage to matching listeners."""
+        publish = self.publish
+        delivery = self.metrics.stages['delivery'] if self.metrics is not None else None
+        async with aclosing(input) as agen:
+            async for batch in agen:
+                if delivery is not None:
+                    start = perf_counter_ns()
+                await publish(batch)
+                if delivery is not None:
+                    delivery.record(perf_counter_ns() - start)
+        self.close()
@@ -10,4 +10,16 @@ class BitMEXWebsocketApiError(Exception):
         self.status = status
         super().__init__(message)
         
-    pass
\ No newline at end of file
+    pass
+
+class BitMEXWebsocketOverflowError(Exception):
+    """Raised in a listener when its queue is full and the overflow policy is ``'raise'``.
+
+    :param string table: The table of the listener.
+    :param int max_buffer_size: The queue size limit of the listener.
+
+    """
+    def __init__(self, table, max_buffer_size) -> None:
+        self.table = table
+        self.max_buffer_size = max_buffer_size
+        super().__init__(f'Listener on {table} exceeded {max_buffer_size} queued items.')
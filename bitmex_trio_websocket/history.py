@@ -0,0 +1,138 @@
+"""Fixed capacity columnar history for append-mostly tables like trade and quote."""
+from array import array
+from calendar import timegm
+from time import time_ns
+from typing import Dict, Mapping, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Columns stored for each history table, as name -> array typecode. ``timestamp`` is stored as
+# epoch nanoseconds and ``side`` as 1 for Buy, -1 for Sell and 0 otherwise.
+HISTORY_COLUMNS = {
+    'trade': {'timestamp': 'q', 'price': 'd', 'size': 'd', 'side': 'b'},
+    'quote': {'timestamp': 'q', 'bidPrice': 'd', 'bidSize': 'd', 'askPrice': 'd', 'askSize': 'd'},
+    'liquidation': {'timestamp': 'q', 'price': 'd', 'leavesQty': 'd', 'side': 'b'},
+}
+
+SIDES = {'Buy': 1, 'Sell': -1}
+
+# Epoch seconds at midnight, by date string
+_days = {}
+
+def parse_timestamp(value: str) -> int:
+    """
+    Converts a BitMEX timestamp like ``2021-01-01T12:00:00.123Z`` to epoch nanoseconds.
+
+    This is much faster than a general purpose parser, since it only handles the fixed format used
+    by BitMEX, and the date part is cached.
+    """
+    try:
+        day = _days[value[:10]]
+    except KeyError:
+        day = _days[value[:10]] = timegm((int(value[:4]), int(value[5:7]), int(value[8:10]), 0, 0, 0))
+    seconds = day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+    fraction = value[20:-1]
+    return seconds * 1_000_000_000 + (int(fraction.ljust(9, '0')) if fraction else 0)
+
+class RingBuffer:
+    """
+    Fixed capacity ring buffer of numeric columns.
+
+    Each column is a contiguous ``array.array`` of twice the capacity, and every value is written
+    twice, ``capacity`` elements apart. This way the last ``n`` rows are always a contiguous slice,
+    so they can be exported as zero-copy NumPy views without wrapping around the end of the buffer.
+    Appending is O(1).
+
+    :param int capacity: Maximum number of rows kept.
+    :param columns: Mapping of column name to ``array`` typecode.
+    """
+    def __init__(self, capacity: int, columns: Mapping[str, str]):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.columns = {name: array(typecode, bytes(array(typecode).itemsize * 2 * capacity))
+                        for name, typecode in columns.items()}
+        # Total number of rows appended
+        self.count = 0
+
+    def append(self, row: Mapping[str, float]):
+        """Append a row. Columns missing from the row are stored as zero."""
+        index = self.count % self.capacity
+        mirror = index + self.capacity
+        for name, column in self.columns.items():
+            value = row.get(name) or 0
+            column[index] = value
+            column[mirror] = value
+        self.count += 1
+
+    def clear(self):
+        """Remove all rows."""
+        self.count = 0
+
+    def _span(self, n: Optional[int]):
+        size = len(self)
+        n = size if n is None else max(0, min(n, size))
+        end = self.count % self.capacity + (self.capacity if self.count >= self.capacity else 0)
+        return end - n, end
+
+    def column(self, name: str, n: Optional[int] = None) -> memoryview:
+        """A zero-copy memoryview of the last ``n`` values of a column, oldest first."""
+        start, end = self._span(n)
+        return memoryview(self.columns[name])[start:end]
+
+    def last(self, n: Optional[int] = None) -> Dict[str, 'numpy.ndarray']:
+        """
+        The last ``n`` rows, oldest first, as a dict of zero-copy NumPy views per column. The views
+        are only valid until the rows are overwritten. Requires NumPy.
+        """
+        if numpy is None:
+            raise RuntimeError('NumPy is required for array export. Install with `pip install numpy`.')
+        start, end = self._span(n)
+        return {name: numpy.frombuffer(column, column.typecode)[start:end]
+                for name, column in self.columns.items()}
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the column arrays in bytes."""
+        return sum(len(column) * column.itemsize for column in self.columns.values())
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+class History:
+    """
+    Ring buffer history for a table, with a buffer per symbol.
+
+    Rows are converted to numeric columns as they are appended. See :data:`HISTORY_COLUMNS`.
+
+    :param str table: Table name. Must be one of :data:`HISTORY_COLUMNS`.
+    :param int capacity: Number of rows kept per symbol.
+    """
+    def __init__(self, table: str, capacity: int):
+        if table not in HISTORY_COLUMNS:
+            raise ValueError(f'History is only supported for tables: {", ".join(HISTORY_COLUMNS)}')
+        self.table = table
+        self.capacity = capacity
+        self.columns = HISTORY_COLUMNS[table]
+        self.buffers = {}
+
+    def buffer(self, symbol: str) -> RingBuffer:
+        """Returns the ring buffer for a symbol."""
+        try:
+            return self.buffers[symbol]
+        except KeyError:
+            buffer = self.buffers[symbol] = RingBuffer(self.capacity, self.columns)
+            return buffer
+
+    def append(self, rows):
+        """Append table rows to the buffers of their symbols."""
+        for row in rows:
+            values = {name: row[name] for name in self.columns if name in row}
+            timestamp = row.get('timestamp')
+            values['timestamp'] = parse_timestamp(timestamp) if timestamp else time_ns()
+            if 'side' in values:
+                values['side'] = SIDES.get(values['side'], 0)
+            self.buffer(row['symbol']).append(values)
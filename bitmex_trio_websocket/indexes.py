@@ -0,0 +1,58 @@
+"""Secondary indexes on storage tables."""
+from typing import Hashable, Iterable, Mapping, Sequence
+
+class Index:
+    """
+    Secondary index of a table on one or more columns.
+
+    Maps the values of the indexed columns of each row to the primary keys of the rows, in
+    insertion order. Rows without an indexed column are indexed with ``None`` for that column.
+
+    :param columns: Names of the indexed columns.
+    """
+    def __init__(self, columns: Sequence[str]):
+        if not columns:
+            raise ValueError('An index needs at least one column.')
+        self.columns = tuple(columns)
+        # Column values -> {primary key: None}, used as an ordered set.
+        self._entries = {}
+
+    def values(self, row: Mapping) -> tuple:
+        """The indexed values of a row."""
+        return tuple(row.get(column) for column in self.columns)
+
+    def affected(self, update: Mapping) -> bool:
+        """Returns ``True`` if an update changes any of the indexed columns."""
+        return any(column in update for column in self.columns)
+
+    def add(self, key: Hashable, row: Mapping):
+        """Add a row to the index."""
+        values = self.values(row)
+        try:
+            self._entries[values][key] = None
+        except KeyError:
+            self._entries[values] = {key: None}
+
+    def remove(self, key: Hashable, row: Mapping):
+        """Remove a row from the index, using the values it was indexed with."""
+        values = self.values(row)
+        keys = self._entries.get(values)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._entries[values]
+
+    def clear(self):
+        """Remove all rows from the index."""
+        self._entries.clear()
+
+    def lookup(self, values: tuple) -> Iterable[Hashable]:
+        """The primary keys of the rows with the given indexed values."""
+        return self._entries.get(values, {}).keys()
+
+    def count(self, values: tuple) -> int:
+        """Number of rows with the given indexed values."""
+        return len(self._entries.get(values, ()))
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._entries.values())
@@ -0,0 +1,144 @@
+"""Receive time stamping and exchange to client latency tracking."""
+import logging
+from time import monotonic_ns, time_ns
+from typing import Dict, Mapping, NamedTuple, Optional, Union
+
+from async_generator import aclosing
+from slurry.sections.abc import Section
+
+from .history import parse_timestamp
+from .metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+# Epoch time of monotonic time zero, used to convert receive stamps to epoch time.
+_EPOCH = time_ns() - monotonic_ns()
+
+def epoch_ns(monotonic: int) -> int:
+    """Converts a monotonic receive stamp to nanoseconds since the epoch."""
+    return monotonic + _EPOCH
+
+class Frame(NamedTuple):
+    """A raw websocket frame, with its monotonic receive time in nanoseconds."""
+    received: int
+    connection: int
+    data: Union[str, bytes]
+
+class ReceiveStamp(Section):
+    """
+    Pass-through section that stamps each frame with a monotonic receive time.
+
+    Placed right after a websocket section, so the stamp is taken as close to the socket as
+    possible, before frames from multiple connections are merged.
+
+    :param int connection: Index of the connection the frames are received on.
+    """
+    def __init__(self, connection: int = 0):
+        self.connection = connection
+
+    async def pump(self, input, output):
+        connection = self.connection
+        async with aclosing(input) as agen:
+            async for frame in agen:
+                await output(Frame(monotonic_ns(), connection, frame))
+
+class LatencyTracker:
+    """
+    Measures the one-way latency from the exchange to the client.
+
+    The latency of a message is the time it was received, minus the ``timestamp`` of its last row.
+    Partials are ignored, since they hold old rows. Latencies are kept in a histogram per table and
+    per connection, in nanoseconds.
+
+    Latencies depend on the local clock being in sync with the exchange clock. The clock offset is
+    estimated as the smallest latency seen during the last ``window`` to ``2 * window`` seconds.
+    This is the offset of the local clock plus the shortest network delay, so a negative offset
+    means the local clock is behind the exchange clock. Latencies are shifted up by a negative
+    offset, so they are never below zero.
+
+    Staleness is the time since the last message of a table, or any table, was received.
+
+    :param float window: Clock offset estimation window, in seconds.
+    """
+    def __init__(self, window: float = 60):
+        self.window = int(window * 1e9)
+        self.tables: Dict[str, Histogram] = {}
+        self.connections: Dict[int, Histogram] = {}
+        # Smallest latency of the current and the previous window
+        self._minimum = None
+        self._previous = None
+        self._window_start = None
+        # Monotonic receive time of the last message, by table and by connection
+        self._received = {}
+        self._connection_received = {}
+
+    @property
+    def offset(self) -> Optional[float]:
+        """Estimated offset of the local clock from the exchange clock, in seconds."""
+        if self._minimum is None:
+            return None
+        if self._previous is None:
+            return self._minimum / 1e9
+        return min(self._minimum, self._previous) / 1e9
+
+    def observe(self, table: str, message: Mapping, received: int, connection: int = 0):
+        """Record the latency of a decoded data message, received at the monotonic time ``received``."""
+        self._received[table] = received
+        self._connection_received[connection] = received
+        if message.get('action') == 'partial':
+            return
+        data = message.get('data')
+        if not data:
+            return
+        timestamp = data[-1].get('timestamp')
+        if timestamp is None:
+            return
+        latency = epoch_ns(received) - parse_timestamp(timestamp)
+
+        if self._window_start is None:
+            self._window_start = received
+        elif received - self._window_start >= self.window:
+            self._previous, self._minimum = self._minimum, None
+            self._window_start = received
+        if self._minimum is None or latency < self._minimum:
+            self._minimum = latency
+        offset = self._minimum if self._previous is None else min(self._minimum, self._previous)
+        if offset < 0:
+            latency -= offset
+
+        try:
+            self.tables[table].record(latency)
+        except KeyError:
+            self.tables[table] = Histogram()
+            self.tables[table].record(latency)
+        try:
+            self.connections[connection].record(latency)
+        except KeyError:
+            self.connections[connection] = Histogram()
+            self.connections[connection].record(latency)
+
+    def staleness(self, table: Optional[str] = None, connection: Optional[int] = None) -> Optional[float]:
+        """
+        Seconds since the last message of a table, or of any table, was received. Pass
+        ``connection`` for the staleness of a single connection. Returns ``None`` if nothing has
+        been received yet.
+        """
+        if table is not None:
+            received = self._received.get(table)
+        elif connection is not None:
+            received = self._connection_received.get(connection)
+        else:
+            received = max(self._received.values(), default=None)
+        if received is None:
+            return None
+        return (monotonic_ns() - received) / 1e9
+
+    def snapshot(self) -> dict:
+        """Returns the clock offset in seconds, latency percentiles in microseconds and staleness in seconds."""
+        now = monotonic_ns()
+        return {
+            'offset': self.offset,
+            'tables': {table: histogram.snapshot() for table, histogram in self.tables.items()},
+            'connections': {connection: histogram.snapshot() for connection, histogram in self.connections.items()},
+            'staleness': {table: (now - received) / 1e9 for table, received in self._received.items()},
+        }
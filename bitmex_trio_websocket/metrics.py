@@ -0,0 +1,202 @@
+"""Opt-in pipeline instrumentation."""
+from collections import Counter
+import logging
+from time import perf_counter_ns
+from typing import Callable, Optional
+
+import trio
+
+log = logging.getLogger(__name__)
+
+def _bucket(value: int) -> int:
+    # Four buckets per power of two. Values below 8 have a bucket each.
+    if value < 8:
+        return value
+    length = value.bit_length()
+    return ((length - 2) << 2) | ((value >> (length - 3)) & 3)
+
+def _bucket_bounds(index: int):
+    if index < 8:
+        return index, index + 1
+    shift = (index >> 2) - 1
+    lower = (4 | (index & 3)) << shift
+    return lower, lower + (1 << shift)
+
+class Histogram:
+    """
+    Log-linear histogram of non-negative integer values, like durations in nanoseconds.
+
+    Recording is O(1) and the memory use is fixed. Percentiles are accurate to within 25%.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 256
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int):
+        """Add a value to the histogram."""
+        self.buckets[_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'Histogram'):
+        """Add the values of another histogram to this one."""
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction: float) -> float:
+        """Approximate value below which the given fraction of values fall."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                lower, upper = _bucket_bounds(index)
+                return min((lower + upper) / 2, self.max)
+        return float(self.max)
+
+    def snapshot(self, scale: float = 1e-3) -> dict:
+        """Summary of the histogram. Values are multiplied by ``scale``. The default converts ns to µs."""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * scale if self.count else 0.0,
+            'p50': self.percentile(0.5) * scale,
+            'p90': self.percentile(0.9) * scale,
+            'p99': self.percentile(0.99) * scale,
+            'max': self.max * scale,
+        }
+
+class StageTimer:
+    """
+    Measures the time a pipeline section spends processing each message.
+
+    Time spent waiting on downstream sections is excluded, by wrapping the section output.
+    """
+    __slots__ = ('histogram', '_start', '_downstream')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self._start = 0
+        self._downstream = 0
+
+    def start(self):
+        self._start = perf_counter_ns()
+        self._downstream = 0
+
+    def stop(self):
+        self.histogram.record(perf_counter_ns() - self._start - self._downstream)
+
+    def wrap(self, output):
+        """Wrap a section output, so the time spent sending is excluded from the measurement."""
+        async def timed_output(item):
+            start = perf_counter_ns()
+            await output(item)
+            self._downstream += perf_counter_ns() - start
+        return timed_output
+
+class Metrics:
+    """
+    Counters and timings for a websocket pipeline.
+
+    The following is measured:
+
+    * Messages and rows received, by table and action.
+    * Per message processing time for each stage. ``receive`` is the time from the receive stamp
+      of a frame until the parser takes it, ``parser`` and ``storage`` is the time spent in those
+      sections, and ``delivery`` is the time spent handing each message to listeners.
+    * Depth of the outbound message queues of all connections, and the backlog of each listener.
+    * Send latency of outbound operations, by priority class.
+    * Exchange to client latency, when a latency tracker is attached.
+
+    :param callback: Optional callable that receives a snapshot every ``interval`` seconds.
+    :param float interval: Export interval in seconds.
+    """
+    STAGES = ('receive', 'parser', 'storage', 'delivery')
+
+    def __init__(self, callback: Optional[Callable[[dict], None]] = None, interval: float = 10):
+        self.callback = callback
+        self.interval = interval
+        self.messages = Counter()
+        self.rows = Counter()
+        self.stages = {stage: Histogram() for stage in self.STAGES}
+        self._send_channels = ()
+        self._dispatcher = None
+        self._parser = None
+        self._reconnect_stats = None
+        self._schedulers = ()
+        self._latency = None
+
+    def timer(self, stage: str) -> StageTimer:
+        """Returns a timer that records to the given stage."""
+        return StageTimer(self.stages[stage])
+
+    def count(self, table: str, action: str, rows: int):
+        """Count a message and its rows."""
+        self.messages[table, action] += 1
+        self.rows[table, action] += rows
+
+    def attach(self, send_channels=(), dispatcher=None, parser=None, reconnect_stats=None, schedulers=(),
+               latency=None):
+        """Attach the pipeline parts that are polled for queue depths when taking a snapshot."""
+        self._send_channels = tuple(send_channels)
+        self._dispatcher = dispatcher
+        self._parser = parser
+        self._reconnect_stats = reconnect_stats
+        self._schedulers = tuple(schedulers)
+        self._latency = latency
+
+    def snapshot(self) -> dict:
+        """Returns the current state of all metrics. Timings are in microseconds."""
+        messages, rows = {}, {}
+        for (table, action), count in self.messages.items():
+            messages.setdefault(table, {})[action] = count
+        for (table, action), count in self.rows.items():
+            rows.setdefault(table, {})[action] = count
+        snapshot = {
+            'messages': messages,
+            'rows': rows,
+            'stages': {stage: histogram.snapshot() for stage, histogram in self.stages.items()},
+            'send_queue': 0,
+            'listeners': [],
+            'skipped_frames': 0,
+        }
+        for send_channel in self._send_channels:
+            snapshot['send_queue'] += send_channel.statistics().current_buffer_used
+        if self._schedulers:
+            latency = {}
+            for scheduler in self._schedulers:
+                snapshot['send_queue'] += scheduler.backlog
+                for cls, histogram in scheduler.latency.items():
+                    latency.setdefault(cls, Histogram()).merge(histogram)
+            snapshot['send_latency'] = {cls: histogram.snapshot() for cls, histogram in latency.items()}
+        if self._dispatcher is not None:
+            snapshot['listeners'] = [
+                {'table': listener.table, 'symbols': listener.symbols, 'backlog': listener.backlog,
+                 'dropped': listener.dropped, 'conflated': listener.conflated}
+                for listener in self._dispatcher.listeners
+            ]
+        if self._parser is not None:
+            snapshot['skipped_frames'] = self._parser.skipped
+        if self._reconnect_stats is not None:
+            snapshot['reconnects'] = self._reconnect_stats.snapshot()
+        if self._latency is not None:
+            snapshot['latency'] = self._latency.snapshot()
+        return snapshot
+
+    async def export(self):
+        """Periodically pass snapshots to the callback. Runs until cancelled."""
+        while True:
+            await trio.sleep(self.interval)
+            try:
+                self.callback(self.snapshot())
+            except Exception: # pylint: disable=broad-except
+                log.exception('Metrics callback failed.')
@@ -0,0 +1,198 @@
+"""Price level order book for the orderBookL2 table."""
+from itertools import islice
+from typing import Iterable, Mapping, Optional, Tuple
+
+from sortedcontainers import SortedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A (price, size) pair
+Level = Tuple[float, float]
+
+class OrderBook:
+    """
+    Order book for a single symbol, keeping price ordered levels for each side.
+
+    Levels are stored in a SortedDict keyed by price, so inserting, updating and deleting a level
+    is O(log n) and reading the top of the book is O(1). BitMEX identifies levels by ``id`` and
+    leaves out the price on some update and delete messages, so the price of each level id is
+    remembered as well.
+
+    :meth:`snapshot` returns a read only copy of the book in O(1). The levels are shared with the
+    snapshot, and each side is copied the first time it is written after a snapshot, so the cost of
+    a snapshot is paid at most once per side, no matter how many snapshots are taken in between.
+    ``sequence`` is the storage sequence number of the last message applied to the book.
+
+    When ``deltas`` is a dict, every change to a price level is recorded in it, as
+    ``(side, price) -> new size``, with a size of 0 for removed levels. ``reset`` is set when the
+    book is cleared. Both are consumed by :class:`~bitmex_trio_websocket.deltas.BookDeltas`.
+
+    When ``analytics`` is set, every change to the size of a level is reported to it. See
+    :class:`~bitmex_trio_websocket.analytics.BookAnalytics`.
+    """
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.bids = SortedDict()
+        self.asks = SortedDict()
+        self.sequence = 0
+        self.frozen = False
+        self.deltas = None
+        self.reset = False
+        self.analytics = None
+        self._prices = {}
+        # Current snapshot, while the book is unchanged, and the sides it shares with snapshots.
+        self._snapshot = None
+        self._shared = set()
+
+    def _side(self, side: str) -> SortedDict:
+        return self.bids if side == 'Buy' else self.asks
+
+    def _writable(self, side: str) -> SortedDict:
+        """The levels of a side, copied first if they are shared with a snapshot."""
+        self._snapshot = None
+        if side in self._shared:
+            self._shared.discard(side)
+            if side == 'Buy':
+                self.bids = self.bids.copy()
+            else:
+                self.asks = self.asks.copy()
+        return self._side(side)
+
+    def snapshot(self) -> 'OrderBook':
+        """
+        A read only copy of the book, that is safe to hold across awaits. Taking a snapshot is
+        O(1). Taking another snapshot of an unchanged book returns the same snapshot.
+        """
+        if self._snapshot is None:
+            snapshot = OrderBook.__new__(OrderBook)
+            snapshot.symbol = self.symbol
+            snapshot.bids = self.bids
+            snapshot.asks = self.asks
+            snapshot.sequence = self.sequence
+            snapshot.frozen = True
+            snapshot.deltas = None
+            snapshot.reset = False
+            snapshot.analytics = None
+            snapshot._prices = None
+            snapshot._snapshot = snapshot
+            snapshot._shared = set()
+            self._shared = {'Buy', 'Sell'}
+            self._snapshot = snapshot
+        return self._snapshot
+
+    def _check_writable(self):
+        if self.frozen:
+            raise TypeError('Order book snapshots are read only.')
+
+    def clear(self):
+        """Remove all levels from the book."""
+        self._check_writable()
+        # New sides, rather than clearing, so snapshots are left intact.
+        self.bids = SortedDict()
+        self.asks = SortedDict()
+        self._prices.clear()
+        self._snapshot = None
+        self._shared.clear()
+        if self.deltas is not None:
+            self.deltas.clear()
+            self.reset = True
+        if self.analytics is not None:
+            self.analytics.reset()
+
+    def insert(self, items: Iterable[Mapping]):
+        """Insert orderBookL2 rows into the book."""
+        self._check_writable()
+        deltas = self.deltas
+        analytics = self.analytics
+        for item in items:
+            levels = self._writable(item['side'])
+            if analytics is not None:
+                analytics.change(item['side'], item['price'], levels.get(item['price'], 0), item['size'])
+            levels[item['price']] = item['size']
+            self._prices[item['id']] = item['price']
+            if deltas is not None:
+                deltas[item['side'], item['price']] = item['size']
+
+    def update(self, items: Iterable[Mapping]):
+        """Update the size of existing levels. Unknown levels are ignored."""
+        self._check_writable()
+        for item in items:
+            try:
+                price = self._prices[item['id']]
+            except KeyError:
+                continue
+            if price in self._side(item['side']) and 'size' in item:
+                levels = self._writable(item['side'])
+                if self.analytics is not None:
+                    self.analytics.change(item['side'], price, levels[price], item['size'])
+                levels[price] = item['size']
+                if self.deltas is not None:
+                    self.deltas[item['side'], price] = item['size']
+
+    def delete(self, items: Iterable[Mapping]):
+        """Remove levels from the book. Unknown levels are ignored."""
+        self._check_writable()
+        for item in items:
+            price = self._prices.pop(item['id'], None)
+            if price is not None:
+                size = self._writable(item['side']).pop(price, None)
+                if self.analytics is not None and size is not None:
+                    self.analytics.change(item['side'], price, size, 0)
+                if self.deltas is not None:
+                    self.deltas[item['side'], price] = 0
+
+    @property
+    def best_bid(self) -> Optional[Level]:
+        """The highest bid as a (price, size) tuple, or ``None`` if there are no bids."""
+        return self.bids.peekitem(-1) if self.bids else None
+
+    @property
+    def best_ask(self) -> Optional[Level]:
+        """The lowest ask as a (price, size) tuple, or ``None`` if there are no asks."""
+        return self.asks.peekitem(0) if self.asks else None
+
+    @property
+    def spread(self) -> Optional[float]:
+        """Difference between the best ask and the best bid."""
+        if not self.bids or not self.asks:
+            return None
+        return self.asks.keys()[0] - self.bids.keys()[-1]
+
+    @property
+    def mid(self) -> Optional[float]:
+        """Mid price between the best bid and best ask."""
+        if not self.bids or not self.asks:
+            return None
+        return (self.asks.keys()[0] + self.bids.keys()[-1]) / 2
+
+    def _from_top(self, side: str):
+        """Price and size iterators, starting from the top of the book."""
+        if side == 'Buy':
+            return reversed(self.bids.keys()), reversed(self.bids.values())
+        return iter(self.asks.keys()), iter(self.asks.values())
+
+    def depth(self, side: str, n: Optional[int] = None) -> Iterable[Level]:
+        """Iterate (price, size) pairs from the top of the book, down to ``n`` levels."""
+        return islice(zip(*self._from_top(side)), n)
+
+    def to_numpy(self, side: str, n: Optional[int] = None):
+        """
+        Export up to ``n`` levels from the top of the book as a pair of contiguous float64 NumPy
+        arrays ``(prices, sizes)``. Requires NumPy.
+        """
+        if numpy is None:
+            raise RuntimeError('NumPy is required for array export. Install with `pip install numpy`.')
+        levels = self._side(side)
+        count = len(levels) if n is None else min(n, len(levels))
+        prices, sizes = self._from_top(side)
+        return (numpy.fromiter(prices, numpy.float64, count),
+                numpy.fromiter(sizes, numpy.float64, count))
+
+    def __len__(self):
+        return len(self.bids) + len(self.asks)
+
+    def __repr__(self):
+        return f'<OrderBook {self.symbol} bid={self.best_bid} ask={self.best_ask}>'
@@ -0,0 +1,178 @@
+"""Prioritized, rate limited scheduling of outbound operations."""
+from collections import deque
+import logging
+from typing import List, Mapping, Optional
+
+from async_generator import aclosing
+from slurry.sections.abc import Section
+import trio
+
+from .metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+# Priority classes, from highest to lowest priority
+HEARTBEAT = 'heartbeat'
+ORDER = 'order'
+SUBSCRIPTION = 'subscription'
+PRIORITIES = (HEARTBEAT, ORDER, SUBSCRIPTION)
+
+# Operations that are merged when queued back to back
+BATCHED_OPS = ('subscribe', 'unsubscribe')
+
+def priority(op: Mapping) -> str:
+    """The priority class of an operation."""
+    name = op.get('op')
+    if name in BATCHED_OPS:
+        return SUBSCRIPTION
+    if name == 'ping':
+        return HEARTBEAT
+    return ORDER
+
+def _args(op: Mapping) -> List:
+    args = op.get('args', [])
+    return list(args) if isinstance(args, list) else [args]
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, on the trio clock.
+
+    The bucket holds up to ``burst`` tokens, and is refilled with ``rate`` tokens per second.
+
+    :param float rate: Tokens per second.
+    :param int burst: Capacity of the bucket.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = None
+
+    def _refill(self):
+        now = trio.current_time()
+        if self._updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Take a token, waiting for one if the bucket is empty."""
+        self._refill()
+        if self.tokens < 1:
+            await trio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+class OutboundScheduler(Section):
+    """
+    Sends operations to the websocket in priority order, with an optional rate limit.
+
+    Operations are queued in one of three priority classes:
+
+    * ``'heartbeat'`` - Pings, and the ``heartbeat`` operation sent by the scheduler itself, like
+      the dead mans switch refresh.
+    * ``'order'`` - Other operations that affect orders or the session, like ``cancelAllAfter`` or
+      ``authKeyExpires``.
+    * ``'subscription'`` - Subscribe and unsubscribe operations.
+
+    The next operation is always taken from the highest class with queued operations, so a burst
+    of subscription changes can't delay the dead mans switch. Subscribe or unsubscribe operations
+    queued back to back are merged into a single operation, with the arguments of all of them.
+
+    If ``rate`` is given, every operation sent, after merging, takes a token from a token bucket.
+    The operation is chosen once a token is available, so an operation queued while waiting goes
+    ahead of lower priority operations.
+
+    The time from queueing an operation until it is handed to the websocket section is recorded
+    per priority class in ``latency``, in nanoseconds.
+
+    :param float rate: Maximum sustained rate, in operations per second. Unlimited if ``None``.
+    :param int burst: Number of operations that can be sent back to back, before ``rate`` applies.
+    :param heartbeat: Optional operation to send every ``heartbeat_interval`` seconds.
+    :param float heartbeat_interval: Heartbeat interval in seconds.
+    """
+    def __init__(self, *, rate: Optional[float] = None, burst: int = 10, heartbeat: Optional[Mapping] = None,
+                 heartbeat_interval: float = 15):
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.latency = {cls: Histogram() for cls in PRIORITIES}
+        # Number of operations merged into a preceding operation
+        self.merged = 0
+        # Entries are (time queued, operation) tuples.
+        self._queues = {cls: deque() for cls in PRIORITIES}
+        self._ready = trio.lowlevel.ParkingLot()
+        self._exhausted = False
+
+    @property
+    def backlog(self) -> int:
+        """Number of queued operations."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def put(self, op: Mapping, cls: Optional[str] = None):
+        """Queue an operation, in the given priority class or the class of the operation."""
+        self._queues[cls or priority(op)].append((trio.current_time(), op))
+        if self._ready:
+            self._ready.unpark_all()
+
+    def _next(self):
+        """Takes the next operation, merged with any queued operations of the same kind."""
+        for cls in PRIORITIES:
+            queue = self._queues[cls]
+            if queue:
+                break
+        queued, op = queue.popleft()
+        times = [queued]
+        name = op.get('op')
+        if name in BATCHED_OPS and queue and queue[0][1].get('op') == name:
+            args = _args(op)
+            seen = set(args)
+            while queue and queue[0][1].get('op') == name:
+                queued, other = queue.popleft()
+                times.append(queued)
+                for arg in _args(other):
+                    if arg not in seen:
+                        seen.add(arg)
+                        args.append(arg)
+            self.merged += len(times) - 1
+            op = dict(op, args=args)
+        return cls, times, op
+
+    async def _receive(self, input):
+        async with aclosing(input) as agen:
+            async for op in agen:
+                self.put(op)
+        self._exhausted = True
+        self._ready.unpark_all()
+
+    async def _heartbeats(self):
+        while True:
+            # Don't pile up heartbeats while the connection is slow.
+            if not any(op is self.heartbeat for _, op in self._queues[HEARTBEAT]):
+                self.put(self.heartbeat, HEARTBEAT)
+            await trio.sleep(self.heartbeat_interval)
+
+    async def pump(self, input, output):
+        async with trio.open_nursery() as nursery:
+            if input is not None:
+                nursery.start_soon(self._receive, input)
+            else:
+                self._exhausted = True
+            if self.heartbeat is not None:
+                nursery.start_soon(self._heartbeats)
+            while True:
+                while not self.backlog:
+                    if self._exhausted and self.heartbeat is None:
+                        return
+                    await self._ready.park()
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                cls, times, op = self._next()
+                await output(op)
+                now = trio.current_time()
+                histogram = self.latency[cls]
+                for queued in times:
+                    histogram.record(int((now - queued) * 1e9))
@@ -1,34 +1,126 @@
 import logging
+from collections import Counter
+from time import monotonic_ns
+from typing import Callable, Optional
 
 from async_generator import aclosing
 from slurry.sections.abc import Section
-from trio import Event
+from trio.lowlevel import ParkingLot
 
+from .codec import get_backend, route
 from .exceptions import BitMEXWebsocketApiError
+from .latency import Frame, LatencyTracker
+from .metrics import Metrics
 
 log = logging.getLogger(__name__)
 
 class Parser(Section):
-    def __init__(self) -> None:
-        self._connected = Event()
-    
+    """
+    Decodes raw websocket frames and handles control messages.
+
+    Data frames are routed on their table before they are decoded. If ``wants`` is given, frames
+    for tables where ``wants(table)`` is false are dropped without decoding.
+
+    Subscribe and unsubscribe acknowledgements are tracked in ``topics``, so :meth:`subscribed`
+    can be used as ``wants``, to only drop frames of tables without a live subscription.
+
+    Frames are either raw frames, or :class:`~bitmex_trio_websocket.latency.Frame` tuples stamped
+    with the receive time, which are passed to ``latency`` after decoding.
+
+    :param wants: Optional predicate that decides if a table is of interest.
+    :param str json_backend: Name of the JSON backend to use. Defaults to the fastest installed.
+    :param metrics: Optional metrics collector.
+    :param latency: Optional latency tracker.
+    """
+    def __init__(self, wants: Optional[Callable[[str], bool]] = None, json_backend: Optional[str] = None,
+                 metrics: Optional[Metrics] = None, latency: Optional[LatencyTracker] = None) -> None:
+        # Number of welcome messages received. There is one per connection.
+        self.connections = 0
+        self._welcomed = ParkingLot()
+        self.wants = wants
+        self._loads = get_backend(json_backend).loads
+        self.metrics = metrics
+        self.latency = latency
+        self.skipped = 0
+        self.topics = set()
+        self._tables = Counter()
+
     async def pump(self, input, output):
-        async for message in input:
-            if 'info' in message:
-                self._connected.set()
-                log.debug('Connected to BitMEX realtime api.')
-            elif 'subscribe' in message:
-                if message['success']:
-                    log.debug('Subscribed to %s.', message["subscribe"])
+        loads = self._loads
+        wants = self.wants
+        latency = self.latency
+        timer = receive = None
+        if self.metrics is not None:
+            timer = self.metrics.timer('parser')
+            output = timer.wrap(output)
+            receive = self.metrics.stages['receive']
+        async with aclosing(input) as agen:
+            async for frame in agen:
+                if timer is not None:
+                    timer.start()
+                if frame.__class__ is Frame:
+                    stamp = frame
+                    frame = frame.data
+                    if receive is not None:
+                        receive.record(monotonic_ns() - stamp.received)
                 else:
-                    log.error('Unable to subscribe to %s. Error: "%s" Please check and restart.',
-                                message["request"]["args"][0], message["error"])
-            elif 'action' in message:
-                await output(message)
-            elif 'request' in message and 'op' in message['request'] and message['request']['op'] == 'cancelAllAfter':
-                log.debug('Dead mans switch reset. All open orders will be cancelled at %s.', message['cancelTime'])
-            elif 'error' in message:
-                log.error('%s - Request: %s', message['error'], message['request'])
-                raise BitMEXWebsocketApiError(message['status'], message['error'])
+                    stamp = None
+
+                # Fast path for data frames.
+                routing = route(frame)
+                if routing is not None:
+                    if wants is None or wants(routing[0]):
+                        message = loads(frame)
+                        if latency is not None and stamp is not None:
+                            latency.observe(routing[0], message, stamp.received, stamp.connection)
+                        await output(message)
+                    else:
+                        self.skipped += 1
+                else:
+                    await self._control(loads(frame), output)
+
+                if timer is not None:
+                    timer.stop()
+
+    def subscribed(self, table: str) -> bool:
+        """Returns ``True`` if any topic of a table is subscribed, according to the acknowledgements."""
+        return self._tables[table] > 0
+
+    async def connected(self, count: int = 1):
+        """Waits until ``count`` connections have received the welcome message."""
+        while self.connections < count:
+            await self._welcomed.park()
+
+    async def _control(self, message, output):
+        """Handles messages that are not recognized as data frames before decoding."""
+        if 'action' in message:
+            await output(message)
+        elif 'info' in message:
+            self.connections += 1
+            self._welcomed.unpark_all()
+            log.debug('Connected to BitMEX realtime api.')
+        elif 'reconnect' in message:
+            # Sent by the reconnecting websocket section, before frames from a new connection.
+            await output(message)
+        elif 'subscribe' in message:
+            if message['success']:
+                log.debug('Subscribed to %s.', message["subscribe"])
+                # Subscriptions are restored after a reconnect, so the topic may be known already.
+                if message['subscribe'] not in self.topics:
+                    self.topics.add(message['subscribe'])
+                    self._tables[message['subscribe'].partition(':')[0]] += 1
             else:
-                log.warning('Received unknown message type: %s', message)
+                log.error('Unable to subscribe to %s. Error: "%s" Please check and restart.',
+                            message["request"]["args"][0], message["error"])
+        elif 'unsubscribe' in message:
+            log.debug('Unsubscribed from %s.', message['unsubscribe'])
+            if message['unsubscribe'] in self.topics:
+                self.topics.discard(message['unsubscribe'])
+                self._tables[message['unsubscribe'].partition(':')[0]] -= 1
+        elif 'request' in message and 'op' in message['request'] and message['request']['op'] == 'cancelAllAfter':
+            log.debug('Dead mans switch reset. All open orders will be cancelled at %s.', message['cancelTime'])
+        elif 'error' in message:
+            log.error('%s - Request: %s', message['error'], message['request'])
+            raise BitMEXWebsocketApiError(message['status'], message['error'])
+        else:
+            log.warning('Received unknown message type: %s', message)
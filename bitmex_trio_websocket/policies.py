@@ -0,0 +1,41 @@
+"""Retention and key policies for storage tables."""
+from typing import Mapping, Optional, Sequence, Tuple, Union
+
+class TablePolicy:
+    """
+    Retention and key policy of a storage table.
+
+    :param max_rows: Maximum number of rows kept. The rows with the lowest keys are removed first.
+        Defaults to :attr:`Storage.MAX_TABLE_LEN <bitmex_trio_websocket.storage.Storage.MAX_TABLE_LEN>`.
+        Pass ``math.inf`` for no limit.
+    :param float max_age: Remove rows once their ``timestamp`` is more than ``max_age`` seconds
+        older than the newest row inserted into the table. Suited to insert only tables, like
+        trade, quote and liquidation.
+    :param keys: Key columns of the table, instead of the keys sent with the partial. Applies
+        from the next partial.
+    :param bool latest_only: Only keep the latest row of each symbol. Short for ``keys=['symbol']``.
+    """
+    __slots__ = ('max_rows', 'max_age', 'keys', 'latest_only')
+
+    def __init__(self, *, max_rows: Optional[float] = None, max_age: Optional[float] = None,
+                 keys: Optional[Sequence[str]] = None, latest_only: bool = False):
+        if max_rows is not None and max_rows < 1:
+            raise ValueError('max_rows must be at least 1')
+        if max_age is not None and max_age <= 0:
+            raise ValueError('max_age must be positive')
+        if latest_only and keys is not None:
+            raise ValueError('latest_only can\'t be combined with keys')
+        if keys is not None and not keys:
+            raise ValueError('keys must name at least one column')
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.keys: Optional[Tuple[str, ...]] = ('symbol',) if latest_only else (tuple(keys) if keys else None)
+        self.latest_only = latest_only
+
+    def __repr__(self):
+        return (f'TablePolicy(max_rows={self.max_rows}, max_age={self.max_age}, keys={self.keys}, '
+                f'latest_only={self.latest_only})')
+
+def table_policy(policy: Union[TablePolicy, Mapping]) -> TablePolicy:
+    """Returns a policy, or builds one from a mapping of :class:`TablePolicy` arguments."""
+    return policy if isinstance(policy, TablePolicy) else TablePolicy(**policy)
@@ -0,0 +1,218 @@
+"""Websocket section that reconnects and resubscribes when the connection drops."""
+import logging
+from time import monotonic
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from slurry.sections.abc import Section
+import trio
+from trio_websocket import (CloseReason, ConnectionClosed, ConnectionTimeout, DisconnectionTimeout,
+                            HandshakeError, connect_websocket_url)
+
+from .codec import route
+
+log = logging.getLogger(__name__)
+
+CONN_TIMEOUT = 60 # connect & disconnect timeout, in seconds
+MESSAGE_QUEUE_SIZE = 1
+MAX_MESSAGE_SIZE = 2 ** 20 # 1 MiB
+
+class ReconnectStats:
+    """
+    Connection statistics for a reconnecting websocket.
+
+    ``last_reconnect_time`` is the time from the connection dropping, until the new connection is
+    open and resubscribed. ``last_gap`` is the time between the last frame received on the old
+    connection, and the first data frame received on the new connection. ``total_gap`` is the sum
+    of all gaps. All times are in seconds.
+    """
+    def __init__(self):
+        self.connects = 0
+        self.disconnects = 0
+        self.failed_attempts = 0
+        self.last_reconnect_time = None
+        self.last_gap = None
+        self.total_gap = 0.0
+        self.last_close_reason = None
+
+    @property
+    def reconnects(self) -> int:
+        """Number of successful reconnects."""
+        return max(self.connects - 1, 0)
+
+    def snapshot(self) -> dict:
+        """Returns the statistics as a dict."""
+        return {
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'disconnects': self.disconnects,
+            'failed_attempts': self.failed_attempts,
+            'last_reconnect_time': self.last_reconnect_time,
+            'last_gap': self.last_gap,
+            'total_gap': self.total_gap,
+        }
+
+class ReconnectingWebsocket(Section):
+    """
+    Websocket client section, that reconnects with exponential backoff when the connection drops.
+
+    Unlike the ``slurry_websocket.Websocket`` section, the input is expected to be unencoded
+    operations, so subscriptions can be tracked. The section knows which topics are subscribed on
+    the current connection, so subscribe and unsubscribe operations are trimmed to the topics that
+    change. Operations received while disconnected are dropped, since the subscriptions are
+    restored from ``topics`` in a single batched subscribe, as soon as a new connection is open.
+
+    Headers are requested from ``headers`` before each connection attempt, so authentication
+    signatures can be renewed. After a reconnect, a ``{"reconnect": {...}}`` control frame is sent
+    downstream, before any frames from the new connection.
+
+    If the very first connection attempt fails, the error is raised, like it would be without
+    reconnecting.
+
+    :param str url: Websocket url.
+    :param headers: Callable that returns extra headers for a connection attempt.
+    :param topics: Callable that returns the topics to subscribe to on a new connection.
+    :param dumps: Function used to encode operations.
+    :param float backoff: Initial delay between reconnect attempts, in seconds. Doubled after
+        each failed attempt.
+    :param float max_backoff: Maximum delay between reconnect attempts, in seconds.
+    """
+    def __init__(self, url: str, *, dumps: Callable[[object], str],
+                 headers: Optional[Callable[[], Optional[List[Tuple[str, str]]]]] = None,
+                 topics: Optional[Callable[[], Iterable[str]]] = None,
+                 backoff: float = 0.1, max_backoff: float = 10,
+                 connect_timeout: float = CONN_TIMEOUT, disconnect_timeout: float = CONN_TIMEOUT,
+                 message_queue_size: int = MESSAGE_QUEUE_SIZE, max_message_size: int = MAX_MESSAGE_SIZE):
+        super().__init__()
+        self.url = url
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        self.disconnect_timeout = disconnect_timeout
+        self.message_queue_size = message_queue_size
+        self.max_message_size = max_message_size
+        self.stats = ReconnectStats()
+        self._dumps = dumps
+        self._headers = headers or (lambda: None)
+        self._topics = topics or (lambda: ())
+        self._connection = None
+        self._subscribed = set()
+        self._lock = trio.Lock()
+        self._closed = None
+
+    @property
+    def closed(self) -> Optional[CloseReason]:
+        """
+        The reason why the websocket was closed, or ``None`` while the section is running, even
+        if it is currently reconnecting.
+        """
+        return self._closed
+
+    def _trim(self, op):
+        """Trims subscribe and unsubscribe operations to the topics that change."""
+        if op.get('op') not in ('subscribe', 'unsubscribe'):
+            return op
+        args = op.get('args', [])
+        args = args if isinstance(args, list) else [args]
+        if op['op'] == 'subscribe':
+            args = [topic for topic in args if topic not in self._subscribed]
+            self._subscribed.update(args)
+        else:
+            args = [topic for topic in args if topic in self._subscribed]
+            self._subscribed.difference_update(args)
+        return dict(op, args=args) if args else None
+
+    async def _forward(self, input):
+        """Sends operations on the current connection."""
+        async for op in input:
+            async with self._lock:
+                if self._connection is None:
+                    log.debug('Not connected. Dropping operation: %s', op)
+                    continue
+                op = self._trim(op)
+                if op is None:
+                    continue
+                try:
+                    await self._connection.send_message(self._dumps(op))
+                except ConnectionClosed:
+                    log.debug('Connection closed. Dropping operation: %s', op)
+
+    async def _resubscribe(self, connection):
+        """Makes the connection current, and restores subscriptions in a single operation."""
+        async with self._lock:
+            self._subscribed = set(self._topics())
+            self._connection = connection
+            if self._subscribed:
+                log.debug('Resubscribing to: %s', ', '.join(sorted(self._subscribed)))
+                await connection.send_message(self._dumps({'op': 'subscribe', 'args': sorted(self._subscribed)}))
+
+    async def pump(self, input, output):
+        stats = self.stats
+        delay = self.backoff
+        disconnected = None
+        gap_start = None
+        last_frame = None
+        async with trio.open_nursery() as nursery:
+            if input is not None:
+                nursery.start_soon(self._forward, input)
+            while True:
+                try:
+                    async with trio.open_nursery() as connection_nursery:
+                        try:
+                            with trio.fail_after(self.connect_timeout):
+                                connection = await connect_websocket_url(
+                                    connection_nursery, self.url, extra_headers=self._headers(),
+                                    message_queue_size=self.message_queue_size,
+                                    max_message_size=self.max_message_size)
+                        except trio.TooSlowError:
+                            raise ConnectionTimeout from None
+                        except OSError as ose:
+                            raise HandshakeError from ose
+                        try:
+                            await self._resubscribe(connection)
+                            stats.connects += 1
+                            delay = self.backoff
+                            waiting = disconnected is not None
+                            if waiting:
+                                stats.last_reconnect_time = monotonic() - disconnected
+                                log.info('Reconnected in %.3fs.', stats.last_reconnect_time)
+                                await output(self._dumps({'reconnect': {
+                                    'reconnects': stats.reconnects,
+                                    'reconnect_time': stats.last_reconnect_time,
+                                    'tables': sorted({topic.partition(':')[0] for topic in self._subscribed}),
+                                }}))
+                            while True:
+                                frame = await connection.get_message()
+                                last_frame = monotonic()
+                                if waiting and route(frame) is not None:
+                                    waiting = False
+                                    stats.last_gap = last_frame - gap_start
+                                    stats.total_gap += stats.last_gap
+                                await output(frame)
+                        except ConnectionClosed as closed:
+                            stats.disconnects += 1
+                            stats.last_close_reason = closed.reason
+                            log.warning('BitMEXWebsocket connection lost (%d) %s. Reconnecting.',
+                                        closed.reason.code, closed.reason.name)
+                            disconnected = monotonic()
+                            gap_start = last_frame if last_frame is not None else disconnected
+                        except trio.BrokenResourceError:
+                            # The pipeline has been closed from the outside. Disconnect gracefully.
+                            log.debug('Reconnecting websocket pipeline closed.')
+                            try:
+                                with trio.fail_after(self.disconnect_timeout):
+                                    await connection.aclose()
+                            except trio.TooSlowError:
+                                raise DisconnectionTimeout from None
+                            self._closed = connection.closed
+                            nursery.cancel_scope.cancel()
+                            return
+                        finally:
+                            self._connection = None
+                            connection_nursery.cancel_scope.cancel()
+                except (HandshakeError, ConnectionTimeout) as error:
+                    if not stats.connects:
+                        raise
+                    stats.failed_attempts += 1
+                    log.warning('Reconnect attempt failed: %s. Retrying in %.1fs.', type(error).__name__, delay)
+                await trio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
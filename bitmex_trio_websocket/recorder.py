@@ -0,0 +1,228 @@
+"""Recording and replay of raw websocket frames."""
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Container, Iterator, Mapping, Optional, Tuple, Union
+import zlib
+
+from async_generator import aclosing, asynccontextmanager
+from slurry import Pipeline
+from slurry.sections.abc import Section
+import trio
+
+from .codec import get_backend, route
+from .latency import Frame, epoch_ns
+from .parser import Parser
+from .storage import Storage
+
+log = logging.getLogger(__name__)
+
+# File layout
+#
+# header:  magic (4s) version (B) flags (B) reserved (2x)
+# record:  receive time in ns since the epoch (q), frame length (I), frame
+#
+# The high bit of the frame length is set for binary frames. Compressed logs store records in
+# independently zlib compressed blocks, each prefixed by the compressed length (I), so a log
+# stays readable up to the last complete block, if the writer stops unexpectedly.
+MAGIC = b'BTWS'
+VERSION = 1
+FLAG_COMPRESSED = 0x01
+HEADER = struct.Struct('<4sBB2x')
+RECORD = struct.Struct('<qI')
+BLOCK = struct.Struct('<I')
+BINARY = 0x80000000
+BLOCK_SIZE = 2 ** 16
+
+class Recorder(Section):
+    """
+    Pass-through section, that appends each raw frame to a log file, with the time it was received.
+
+    Frames stamped by :class:`~bitmex_trio_websocket.latency.ReceiveStamp` are recorded with their
+    receive stamp, and passed on stamped.
+
+    :param path: Log file path. Frames are appended, if the file exists.
+    :param bool compress: Compress the log with zlib.
+    """
+    def __init__(self, path: Union[str, os.PathLike], *, compress: bool = False):
+        self.path = path
+        self.compress = compress
+        self.frames = 0
+        self._file = None
+        self._block = bytearray()
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION, FLAG_COMPRESSED if self.compress else 0))
+        else:
+            with open(self.path, 'rb') as existing:
+                flags = _read_header(existing.read(HEADER.size))
+            if bool(flags & FLAG_COMPRESSED) != self.compress:
+                self._file.close()
+                raise ValueError(f'Cannot append to {self.path}. Compression setting does not match.')
+
+    def _flush_block(self):
+        if self._block:
+            compressed = zlib.compress(self._block)
+            self._file.write(BLOCK.pack(len(compressed)))
+            self._file.write(compressed)
+            self._block.clear()
+
+    def write(self, frame: Union[str, bytes], timestamp: Optional[int] = None):
+        """Append a single frame to the log."""
+        if timestamp is None:
+            timestamp = time.time_ns()
+        if isinstance(frame, str):
+            data = frame.encode()
+            length = len(data)
+        else:
+            data = frame
+            length = len(data) | BINARY
+        if self.compress:
+            self._block += RECORD.pack(timestamp, length)
+            self._block += data
+            if len(self._block) >= BLOCK_SIZE:
+                self._flush_block()
+        else:
+            self._file.write(RECORD.pack(timestamp, length))
+            self._file.write(data)
+        self.frames += 1
+
+    def close(self):
+        """Flush and close the log file."""
+        if self._file is not None:
+            if self.compress:
+                self._flush_block()
+            self._file.close()
+            self._file = None
+
+    async def pump(self, input, output):
+        self._open()
+        try:
+            async with aclosing(input) as agen:
+                async for frame in agen:
+                    if frame.__class__ is Frame:
+                        self.write(frame.data, epoch_ns(frame.received))
+                    else:
+                        self.write(frame)
+                    await output(frame)
+        finally:
+            self.close()
+            log.debug('Recorded %d frames to %s.', self.frames, self.path)
+
+def _read_header(data) -> int:
+    if len(data) < HEADER.size:
+        raise ValueError('Not a frame log.')
+    magic, version, flags = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a frame log.')
+    if version != VERSION:
+        raise ValueError(f'Unsupported frame log version: {version}')
+    return flags
+
+def _iter_records(buffer, offset: int, end: int) -> Iterator[Tuple[int, Union[str, bytes]]]:
+    unpack_from = RECORD.unpack_from
+    record_size = RECORD.size
+    while offset + record_size <= end:
+        timestamp, length = unpack_from(buffer, offset)
+        offset += record_size
+        size = length & ~BINARY
+        if offset + size > end:
+            break # Truncated record
+        frame = buffer[offset:offset + size]
+        offset += size
+        yield timestamp, frame if length & BINARY else frame.decode()
+
+def read_frames(path: Union[str, os.PathLike]) -> Iterator[Tuple[int, Union[str, bytes]]]:
+    """
+    Iterate ``(timestamp, frame)`` pairs from a frame log, using a memory mapped file.
+
+    Timestamps are the receive time in nanoseconds since the epoch. A truncated trailing record or
+    block is ignored.
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size <= HEADER.size:
+            _read_header(file.read(HEADER.size))
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            flags = _read_header(buffer[:HEADER.size])
+            end = len(buffer)
+            if not flags & FLAG_COMPRESSED:
+                yield from _iter_records(buffer, HEADER.size, end)
+                return
+            offset = HEADER.size
+            while offset + BLOCK.size <= end:
+                size, = BLOCK.unpack_from(buffer, offset)
+                offset += BLOCK.size
+                if offset + size > end:
+                    break # Truncated block
+                block = zlib.decompress(buffer[offset:offset + size])
+                offset += size
+                yield from _iter_records(block, 0, len(block))
+
+def read_messages(path: Union[str, os.PathLike], *, tables: Optional[Container[str]] = None,
+                  json_backend: Optional[str] = None) -> Iterator[Mapping]:
+    """
+    Iterate the decoded data messages of a frame log, and the ``reconnect`` control messages.
+
+    Frames for tables not in ``tables`` are skipped without decoding. Together with
+    :meth:`Storage.apply_many <bitmex_trio_websocket.storage.Storage.apply_many>`, a log can be
+    replayed synchronously, without trio, for instance
+    ``storage.apply_many(read_messages(path), changes=False)``.
+    """
+    loads = get_backend(json_backend).loads
+    for _, frame in read_frames(path):
+        routing = route(frame)
+        if routing is not None:
+            if tables is None or routing[0] in tables:
+                yield loads(frame)
+            continue
+        message = loads(frame)
+        if 'table' in message and 'action' in message:
+            if tables is None or message['table'] in tables:
+                yield message
+        elif 'reconnect' in message:
+            yield message
+
+class Replay(Section):
+    """
+    Source section, that outputs frames from a frame log.
+
+    :param path: Log file path.
+    :param speed: Replay speed relative to the recorded speed. If ``None`` (default), frames are
+        output as fast as possible.
+    """
+    def __init__(self, path: Union[str, os.PathLike], *, speed: Optional[float] = None):
+        self.path = path
+        self.speed = speed
+
+    async def pump(self, input, output):
+        frames = read_frames(self.path)
+        if self.speed is None:
+            for _, frame in frames:
+                await output(frame)
+            return
+        start = None
+        for timestamp, frame in frames:
+            if start is None:
+                start = (trio.current_time(), timestamp)
+            else:
+                await trio.sleep_until(start[0] + (timestamp - start[1]) / 1e9 / self.speed)
+            await output(frame)
+
+@asynccontextmanager
+async def open_replay(path: Union[str, os.PathLike], *, speed: Optional[float] = None, storage: Storage = None):
+    """
+    Replays a frame log through a parser and storage engine.
+
+    Returns a pipeline context. Tap the pipeline to receive storage output as
+    :class:`~bitmex_trio_websocket.storage.Batch` tuples of ``(rows, symbol, table, action)``.
+    Supply a storage object, to inspect the table state during or after the replay.
+    """
+    if storage is None:
+        storage = Storage()
+    async with Pipeline.create(Replay(path, speed=speed), Parser(), storage) as pipeline:
+        yield pipeline
@@ -0,0 +1,108 @@
+"""Compact table rows built from the schema sent with each partial."""
+from collections.abc import MutableMapping
+from sys import intern
+from typing import Mapping
+
+# Column types with a small set of distinct, often repeated, string values. Values of these types
+# are interned, so every row shares a single copy.
+INTERNED_TYPES = ('symbol', 'timestamp')
+
+class Record(MutableMapping):
+    """
+    Base class for compact table rows.
+
+    Columns from the table schema are stored in slots, instead of a per row dict. Columns that are
+    not in the schema are kept in a dict, which is only created when needed. Records behave like
+    the dicts they replace, so they can be read with ``row['price']``, ``row.get('price')``,
+    ``'price' in row``, and converted with ``dict(row)``.
+    """
+    __slots__ = ('_extra',)
+    # Column name -> slot descriptor
+    _columns = {}
+    # Column names of interned columns
+    _interned = frozenset()
+
+    def __init__(self, row: Mapping = ()):
+        self._extra = None
+        self.update(row)
+
+    def __getitem__(self, key):
+        column = self._columns.get(key)
+        if column is not None:
+            try:
+                return column.__get__(self)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        column = self._columns.get(key)
+        if column is not None:
+            if key in self._interned and type(value) is str:
+                value = intern(value)
+            column.__set__(self, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        column = self._columns.get(key)
+        if column is not None:
+            try:
+                column.__delete__(self)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        column = self._columns.get(key)
+        if column is not None:
+            try:
+                column.__get__(self)
+            except AttributeError:
+                return False
+            return True
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key, column in self._columns.items():
+            try:
+                column.__get__(self)
+            except AttributeError:
+                continue
+            yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def update(self, other=(), **kwargs):
+        """Update the record from a mapping, like :meth:`dict.update`."""
+        setitem = self.__setitem__
+        for key, value in (other.items() if hasattr(other, 'items') else other):
+            setitem(key, value)
+        for key, value in kwargs.items():
+            setitem(key, value)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+def record_class(table: str, types: Mapping[str, str]) -> type:
+    """
+    Creates a record class for a table from the ``types`` schema of a partial message.
+
+    :param str table: Table name.
+    :param types: Mapping of column name to BitMEX column type.
+    """
+    slots = tuple(f'_c{index}' for index in range(len(types)))
+    cls = type(f'{table}Record', (Record,), {'__slots__': slots})
+    cls._columns = {name: getattr(cls, slot) for name, slot in zip(types, slots)}
+    cls._interned = frozenset(name for name, type_ in types.items() if type_ in INTERNED_TYPES)
+    return cls
@@ -0,0 +1,74 @@
+"""Assignment of subscriptions to connections."""
+from typing import Callable, Iterable, Mapping, Optional
+
+# Tables that require authentication
+PRIVATE_TABLES = ('affiliate', 'execution', 'order', 'margin', 'position', 'privateNotifications', 'transact',
+                  'wallet')
+# Tables with enough traffic to deserve their own connection per symbol
+DEDICATED_TABLES = ('orderBookL2', 'orderBookL2_25', 'orderBook10')
+
+class ShardRouter:
+    """
+    Assigns ``(table, symbol)`` subscriptions to one of a number of connections.
+
+    The assignment of a subscription is sticky, until it is released. The following rules are
+    applied in order:
+
+    1. If ``rule`` is given and returns a connection index for the subscription, it is used.
+    2. Tables in ``pinned`` are assigned to the given connection. By default all private tables are
+       pinned to the first connection.
+    3. Subscriptions to ``dedicated`` tables are spread over the connections that have no pinned
+       tables, to the connection with the fewest subscriptions. With enough connections each
+       symbol gets a connection of its own.
+    4. Everything else goes to the first connection.
+
+    :param int connections: Number of connections.
+    :param dedicated: Tables that are spread over the connections.
+    :param pinned: Mapping of table name to connection index.
+    :param rule: Optional callable ``rule(table, symbol)`` that returns a connection index, or
+        ``None`` to fall back to the other rules.
+    """
+    def __init__(self, connections: int, *, dedicated: Iterable[str] = DEDICATED_TABLES,
+                 pinned: Optional[Mapping[str, int]] = None,
+                 rule: Optional[Callable[[str, Optional[str]], Optional[int]]] = None):
+        if connections < 1:
+            raise ValueError('connections must be at least 1')
+        self.connections = connections
+        self.dedicated = frozenset(dedicated)
+        self.pinned = dict(pinned) if pinned is not None else {table: 0 for table in PRIVATE_TABLES}
+        self.rule = rule
+        self._assigned = {}
+        self._load = [0] * connections
+        # Connections without pinned tables, that dedicated tables are spread over.
+        self._spread = [index for index in range(connections) if index not in set(self.pinned.values())] or \
+            list(range(connections))
+
+    def assign(self, table: str, symbol: Optional[str] = None) -> int:
+        """Returns the connection index for a subscription, assigning one if needed."""
+        key = (table, symbol)
+        if key in self._assigned:
+            return self._assigned[key]
+        index = self.rule(table, symbol) if self.rule is not None else None
+        if index is None:
+            if table in self.pinned:
+                index = self.pinned[table]
+            elif table in self.dedicated:
+                index = min(self._spread, key=self._load.__getitem__)
+            else:
+                index = 0
+        if not 0 <= index < self.connections:
+            raise ValueError(f'Connection index {index} for {table}:{symbol} is out of range.')
+        self._assigned[key] = index
+        self._load[index] += 1
+        return index
+
+    def release(self, table: str, symbol: Optional[str] = None) -> Optional[int]:
+        """Removes the assignment of a subscription. Returns the connection index it had."""
+        index = self._assigned.pop((table, symbol), None)
+        if index is not None:
+            self._load[index] -= 1
+        return index
+
+    def shard(self, table: str, symbol: Optional[str] = None) -> Optional[int]:
+        """The connection index currently assigned to a subscription, if any."""
+        return self._assigned.get((table, symbol))
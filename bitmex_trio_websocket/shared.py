@@ -0,0 +1,255 @@
+"""
+Order books in shared memory, for consumers in other processes.
+
+A single ingest process runs the websocket pipeline and publishes the top levels of each order
+book to a named shared memory block. Consumer processes on the same host attach to the block and
+read consistent snapshots, without a connection or JSON decoding of their own.
+
+Each book slot is guarded by a seqlock. The writer makes the sequence number odd before it writes
+a book and even again afterwards. A reader copies the book and retries if the sequence number was
+odd, or changed while it was reading. Readers never block the writer.
+"""
+from array import array
+from collections import namedtuple
+from functools import partial
+from itertools import islice
+import logging
+import struct
+from time import monotonic, time_ns
+from typing import Optional, Sequence, Tuple
+
+from async_generator import aclosing
+from slurry.sections.abc import Section
+import trio
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+
+from .orderbook import OrderBook
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'BTSB'
+VERSION = 1
+# magic, version, depth, symbol count
+HEADER = struct.Struct('<4sHHI')
+HEADER_SIZE = 64
+SYMBOL_SIZE = 32
+SEQUENCE = struct.Struct('<Q')
+# timestamp, bid count, ask count
+SLOT = struct.Struct('<qII')
+SLOT_HEADER_SIZE = 32
+
+# Names of the blocks created by this process, which the resource tracker already knows.
+_created = set()
+
+# A consistent copy of a book. Levels are (price, size) tuples from the top of the book.
+BookSnapshot = namedtuple('BookSnapshot', ['symbol', 'sequence', 'timestamp', 'bids', 'asks'])
+
+def _require_shared_memory():
+    if SharedMemory is None:
+        raise RuntimeError('Shared memory requires Python 3.8 or newer.')
+
+def _layout(depth: int, count: int) -> Tuple[int, int]:
+    """Returns the size of a book slot and the total size of the shared memory block."""
+    slot = SLOT_HEADER_SIZE + 4 * 8 * depth
+    slot = (slot + 63) // 64 * 64
+    return slot, HEADER_SIZE + SYMBOL_SIZE * count + slot * count
+
+class _SharedBooksBase:
+    def __init__(self, shm, depth: int, symbols: Sequence[str]):
+        self._shm = shm
+        self.name = shm.name
+        self.depth = depth
+        self.symbols = tuple(symbols)
+        slot, _ = _layout(depth, len(self.symbols))
+        start = HEADER_SIZE + SYMBOL_SIZE * len(self.symbols)
+        self._offsets = {symbol: start + slot * index for index, symbol in enumerate(self.symbols)}
+        self._buffer = shm.buf
+        self._doubles = shm.buf.cast('B').cast('d')
+
+    def _levels(self, offset: int):
+        """Index of the bid prices, bid sizes, ask prices and ask sizes of a slot, in doubles."""
+        first = (offset + SLOT_HEADER_SIZE) // 8
+        return (first, first + self.depth, first + 2 * self.depth, first + 3 * self.depth)
+
+    def __contains__(self, symbol):
+        return symbol in self._offsets
+
+    def close(self):
+        """Detach from the shared memory block."""
+        self._doubles.release()
+        self._buffer = self._doubles = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SharedBooks(_SharedBooksBase):
+    """
+    Writer side of the shared order books. Created by the ingest process, which owns the shared
+    memory block and removes it when closed.
+
+    :param str name: Name of the shared memory block. Consumers attach by this name.
+    :param symbols: Symbols to publish books for.
+    :param int depth: Number of levels published per side.
+    """
+    def __init__(self, name: str, symbols: Sequence[str], depth: int = 25):
+        _require_shared_memory()
+        _, size = _layout(depth, len(symbols))
+        super().__init__(SharedMemory(name=name, create=True, size=size), depth, symbols)
+        _created.add(self._shm._name)
+        self._sequences = dict.fromkeys(self.symbols, 0)
+        HEADER.pack_into(self._buffer, 0, MAGIC, VERSION, depth, len(self.symbols))
+        for index, symbol in enumerate(self.symbols):
+            encoded = symbol.encode()
+            if len(encoded) > SYMBOL_SIZE:
+                raise ValueError(f'Symbol too long: {symbol}')
+            struct.pack_into(f'{SYMBOL_SIZE}s', self._buffer, HEADER_SIZE + SYMBOL_SIZE * index, encoded)
+
+    def publish(self, symbol: str, book: OrderBook):
+        """Write the top levels of a book to its slot."""
+        offset = self._offsets[symbol]
+        buffer, doubles, depth = self._buffer, self._doubles, self.depth
+        sequence = self._sequences[symbol] + 1
+        SEQUENCE.pack_into(buffer, offset, sequence)
+        bid_prices, bid_sizes, ask_prices, ask_sizes = self._levels(offset)
+        bids = min(len(book.bids), depth)
+        asks = min(len(book.asks), depth)
+        prices, sizes = book._from_top('Buy') # pylint: disable=protected-access
+        doubles[bid_prices:bid_prices + bids] = array('d', islice(prices, bids))
+        doubles[bid_sizes:bid_sizes + bids] = array('d', islice(sizes, bids))
+        prices, sizes = book._from_top('Sell') # pylint: disable=protected-access
+        doubles[ask_prices:ask_prices + asks] = array('d', islice(prices, asks))
+        doubles[ask_sizes:ask_sizes + asks] = array('d', islice(sizes, asks))
+        SLOT.pack_into(buffer, offset + SEQUENCE.size, time_ns(), bids, asks)
+        self._sequences[symbol] = sequence + 1
+        SEQUENCE.pack_into(buffer, offset, sequence + 1)
+
+    def close(self):
+        """Detach from and remove the shared memory block."""
+        shm = self._shm
+        super().close()
+        shm.unlink()
+        _created.discard(shm._name)
+
+class SharedBooksReader(_SharedBooksBase):
+    """
+    Reader side of the shared order books, for consumer processes.
+
+    :param str name: Name of the shared memory block created by :class:`SharedBooks`.
+    :param float timeout: Seconds to retry reading a book that is being written, before
+        :meth:`snapshot` raises :class:`TimeoutError`, for instance because the writer died in the
+        middle of a write.
+    """
+    # Number of retries between checks of the timeout
+    CHECK_INTERVAL = 1000
+
+    def __init__(self, name: str, timeout: float = 1.0):
+        _require_shared_memory()
+        try:
+            shm = SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13, attaching registers the block with the resource tracker, which
+            # would remove it when this process exits. The writer owns the block. A block created
+            # by this process is only registered once, so it stays registered for the writer.
+            shm = SharedMemory(name=name)
+            if shm._name not in _created:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        self.timeout = timeout
+        magic, version, depth, count = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            shm.close()
+            raise ValueError(f'{name} is not a shared order book block.')
+        symbols = [struct.unpack_from(f'{SYMBOL_SIZE}s', shm.buf, HEADER_SIZE + SYMBOL_SIZE * index)[0]
+                   .rstrip(b'\0').decode() for index in range(count)]
+        super().__init__(shm, depth, symbols)
+
+    def sequence(self, symbol: str) -> int:
+        """The current sequence number of a book. It increases by two for every update."""
+        return SEQUENCE.unpack_from(self._buffer, self._offsets[symbol])[0]
+
+    def snapshot(self, symbol: str, depth: Optional[int] = None) -> BookSnapshot:
+        """Read a consistent copy of the top ``depth`` levels of a book."""
+        offset = self._offsets[symbol]
+        buffer, doubles = self._buffer, self._doubles
+        bid_prices, bid_sizes, ask_prices, ask_sizes = self._levels(offset)
+        depth = self.depth if depth is None else min(depth, self.depth)
+        retries = 0
+        deadline = None
+        while True:
+            retries += 1
+            if retries % self.CHECK_INTERVAL == 0:
+                if deadline is None:
+                    deadline = monotonic() + self.timeout
+                elif monotonic() > deadline:
+                    raise TimeoutError(f'The {symbol} book was not readable within {self.timeout}s. '
+                                       'Is the writer alive?')
+            sequence = SEQUENCE.unpack_from(buffer, offset)[0]
+            if sequence & 1:
+                continue
+            timestamp, bids, asks = SLOT.unpack_from(buffer, offset + SEQUENCE.size)
+            bids, asks = min(bids, depth), min(asks, depth)
+            snapshot = BookSnapshot(
+                symbol, sequence, timestamp,
+                list(zip(doubles[bid_prices:bid_prices + bids].tolist(), doubles[bid_sizes:bid_sizes + bids].tolist())),
+                list(zip(doubles[ask_prices:ask_prices + asks].tolist(), doubles[ask_sizes:ask_sizes + asks].tolist())),
+            )
+            if SEQUENCE.unpack_from(buffer, offset)[0] == sequence:
+                return snapshot
+
+    def top(self, symbol: str) -> Tuple[Optional[Tuple[float, float]], Optional[Tuple[float, float]]]:
+        """The best bid and best ask of a book, as (price, size) tuples, or ``None`` for an empty side."""
+        snapshot = self.snapshot(symbol, 1)
+        return (snapshot.bids[0] if snapshot.bids else None, snapshot.asks[0] if snapshot.asks else None)
+
+class BookPublisher(Section):
+    """
+    Publishes order books to shared memory, once for every message that storage applies to them.
+    Storage output is passed through unchanged.
+
+    :param shared: The shared books to publish to.
+    :param order_book: Function that returns the order book of a symbol. Usually
+        :meth:`Storage.order_book`.
+    """
+    def __init__(self, shared: SharedBooks, order_book):
+        self.shared = shared
+        self._order_book = order_book
+
+    async def pump(self, input, output):
+        shared = self.shared
+        async with aclosing(input) as agen:
+            async for batch in agen:
+                if batch.table == 'orderBookL2' and batch.symbol in shared:
+                    shared.publish(batch.symbol, self._order_book(batch.symbol))
+                await output(batch)
+
+async def run_ingest(network: str, symbols: Sequence[str], *, name: str, depth: int = 25, **kwargs):
+    """
+    Run an ingest process, that subscribes to the order books of ``symbols`` and publishes them to
+    shared memory under ``name``, until cancelled. Keyword arguments are passed to
+    :func:`~bitmex_trio_websocket.open_bitmex_websocket`.
+    """
+    from .websocket import open_bitmex_websocket # pylint: disable=import-outside-toplevel
+
+    async def drain(bws, symbol):
+        # The books are published by storage. The rows themselves are not needed here.
+        async with aclosing(bws.listen('orderBookL2', symbol, max_buffer_size=1, overflow='drop_oldest')) as agen:
+            async for _ in agen:
+                pass
+
+    with SharedBooks(name, symbols, depth) as shared:
+        async with open_bitmex_websocket(network, publish=shared, **kwargs) as bws:
+            async with trio.open_nursery() as nursery:
+                for symbol in symbols:
+                    nursery.start_soon(drain, bws, symbol)
+
+def ingest(network: str, symbols: Sequence[str], *, name: str, depth: int = 25, **kwargs):
+    """Blocking version of :func:`run_ingest`, for use as a ``multiprocessing.Process`` target."""
+    trio.run(partial(run_ingest, network, symbols, name=name, depth=depth, **kwargs))
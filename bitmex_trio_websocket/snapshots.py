@@ -0,0 +1,37 @@
+"""Read only snapshots of storage tables."""
+from collections.abc import Mapping
+
+class TableSnapshot(Mapping):
+    """
+    A read only view of a storage table, as it was when the snapshot was taken. Maps storage keys
+    to rows, in key order.
+
+    The snapshot shares the table and its rows with storage, until storage writes to them. Storage
+    then copies the table, and each row the first time it is changed, so the snapshot never
+    changes and is safe to hold across awaits. The rows must not be modified.
+
+    :param str table: Table name.
+    :param int sequence: Storage sequence number of the last message applied to the table.
+    :param rows: The rows of the table, by storage key.
+    """
+    __slots__ = ('table', 'sequence', '_rows')
+
+    def __init__(self, table: str, sequence: int, rows):
+        self.table = table
+        self.sequence = sequence
+        self._rows = rows
+
+    def __getitem__(self, key):
+        return self._rows[key]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __repr__(self):
+        return f'<TableSnapshot {self.table} sequence={self.sequence} rows={len(self._rows)}>'
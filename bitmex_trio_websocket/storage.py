@@ -1,7 +1,10 @@
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
 import decimal
 import logging
-from typing import Mapping, Union, Iterable
+from sys import getsizeof
+from time import monotonic
+from typing import Callable, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Union
 
 # Type alias for a table record
 TableItem = Mapping[str, Union[int, float, str]]
@@ -9,149 +12,651 @@ TableItem = Mapping[str, Union[int, float, str]]
 from async_generator import aclosing
 from slurry.sections.abc import Section
 from sortedcontainers import SortedDict
-import pendulum
+import trio
+
+from .analytics import ANALYTICS_TABLE, DEFAULT_BANDS, BookAnalytics
+from .history import History, RingBuffer, parse_timestamp
+from .indexes import Index
+from .orderbook import OrderBook
+from .policies import TablePolicy, table_policy
+from .records import record_class
+from .snapshots import TableSnapshot
 
 logger = logging.getLogger(__name__)
 
+# Approximate size of a table entry, for the hash table slot and the sorted key list slot.
+ENTRY_BYTES = 48
+
+class Batch(NamedTuple):
+    """
+    The rows of a table changed by a single websocket message.
+
+    ``symbol`` is set when all rows belong to the same symbol, and is ``None`` when the rows may
+    belong to different symbols, or the table has no symbols. For an orderBookL2 partial, ``rows``
+    holds a single item, the complete book of the symbol.
+    """
+    rows: List[TableItem]
+    symbol: Optional[str]
+    table: str
+    action: str
+
+def _row_bytes(row: TableItem) -> int:
+    """Approximate size of a row, its values and its table entry."""
+    return getsizeof(row) + sum(getsizeof(value) for value in row.values()) + ENTRY_BYTES
+
+def _copy_item(item):
+    """A copy of a storage item, that isn't changed by later messages."""
+    if isinstance(item, defaultdict):
+        # A complete order book, of side -> id -> level.
+        return {side: SortedDict((id_, type(level)(level)) for id_, level in levels.items())
+                for side, levels in item.items()}
+    if isinstance(item, MutableMapping):
+        return type(item)(item)
+    return item
+
 class Storage(Section):
     """
-    This is a async sans io storage engine for the BitMEX websocket api.
+    This is a sans io storage engine for the BitMEX websocket api.
+
+    :meth:`apply` applies a single message synchronously and returns the changed rows, one
+    :class:`Batch` per message, or more after a partial or a resynchronization. :meth:`apply_many`
+    applies a sequence of messages in a tight loop. As a pipeline section, :meth:`pump` applies the
+    messages it receives and sends the batches downstream.
+
+    Every message is numbered, in :attr:`sequence`. :meth:`snapshot` returns a read only, copy on
+    write snapshot of a table or order book in O(1), tagged with the sequence number of the last
+    message applied to it.
+
+    :param bool compact: Store rows as compact records, built from the schema in each partial,
+        instead of dicts. See :class:`~bitmex_trio_websocket.records.Record`.
+    :param history: Optional mapping of table name to capacity. Keeps a columnar ring buffer
+        history of that many rows per symbol for each table. See :meth:`keep_history`.
+    :param indexes: Optional mapping of table name to the secondary indexes of the table. Each
+        index is a column name, or a sequence of column names. See :meth:`add_index`.
+    :param policies: Optional mapping of table name to a
+        :class:`~bitmex_trio_websocket.policies.TablePolicy`, or a mapping of its arguments. See
+        :meth:`set_policy`.
     """
 
-    # Don't grow a table larger than this amount. Helps cap memory usage.
+    # Don't grow a table larger than this amount, unless its policy says otherwise. Helps cap
+    # memory usage.
     MAX_TABLE_LEN = 200
-    # This allows global override of table keys. 
+    # This allows global override of table keys, for tables without a policy.
     # Depending on the use case, some table have keys that may be inconvinient.
     # For instance the quote table has keys ['timestamp','symbol'] which means
     # that it keeps a historical record of quotes, up to the max table length.
     # If you are only interested in the latest quote, you may override the key
-    # to be simply ['symbol'].
+    # to be simply ['symbol']. Prefer a per instance policy, see set_policy.
     TABLE_KEYS = {}
+    # Closed orders are kept for this many seconds. Filled orders can be reopened by amending
+    # leavesQty within a minute. After that we can delete them.
+    ORDER_RETENTION = 60
+    # Interval in seconds between scheduled evictions of closed orders.
+    EVICTION_INTERVAL = 5
+    # Rows received before the partial of their table are held back, up to this many per table.
+    PENDING_LIMIT = 10000
 
-    def __init__(self):
+    def __init__(self, compact: bool = False, history: Optional[Mapping[str, int]] = None,
+                 indexes: Optional[Mapping[str, Iterable[Union[str, Sequence[str]]]]] = None,
+                 policies: Optional[Mapping[str, Union[TablePolicy, Mapping]]] = None):
         self.data = defaultdict(SortedDict)
         # Special storage for orderBookL2
         # dict[symbol][side][id]
         self.data['orderBookL2'] = defaultdict(lambda: defaultdict(SortedDict))
+        # Price ordered view of orderBookL2
+        # dict[symbol] -> OrderBook
+        self.books = {}
         self.keys = defaultdict(list)
+        self.compact = compact
+        # Record class per table, when compact
+        self.records = {}
+        # Ring buffer history per table
+        self.history = {}
+        for table, capacity in (history or {}).items():
+            self.keep_history(table, capacity)
+        # Secondary indexes per table, by indexed columns
+        self.indexes = {}
+        for table, columns in (indexes or {}).items():
+            for index in columns:
+                self.add_index(table, *((index,) if isinstance(index, str) else index))
+        # Retention and key policy per table
+        self.policies = {}
+        # Tables with a maximum age map to (timestamp, key) entries in order of insertion, and to
+        # the timestamp of the latest entry of each key. The newest timestamp inserted per table.
+        self._ages = {}
+        self._aged = {}
+        self._newest = {}
+        for table, policy in (policies or {}).items():
+            self.set_policy(table, policy)
+        # Number of messages applied, and the sequence number of the last message per table
+        self.sequence = 0
+        self.versions = {}
+        # Current snapshot per table, while the table is shared with it
+        self._snapshots = {}
+        # Keys of rows that have been copied since the last snapshot of each table
+        self._owned = {}
+        # Tables that are resynchronizing after a reconnect, mapped to the symbol scopes that
+        # have been resynchronized so far.
+        self._resync = {}
+        # Closed order keys mapped to the monotonic time they were closed, oldest first.
+        self._closed_orders = OrderedDict()
+        # Symbol scopes of the partials received per table. A scope of None covers all symbols.
+        self._partials = {}
+        # Rows received before the partial of their table, as (action, row), in order of arrival.
+        self._pending = {}
+        # Number of rows held back before the partial, and the number of those discarded, by table.
+        self.buffered = Counter()
+        self.discarded = Counter()
+        # Number of registrations for the analytics of each order book
+        self._analytics = Counter()
+        # table -> hooks that derive batches from the batches of the table
+        self._hooks = {}
+        # Optional metrics collector
+        self.metrics = None
 
     async def pump(self, input, output):
-        """Updates the storage from parsed websocket messages"""
+        """Updates the storage from parsed websocket messages, and sends the changes downstream."""
+        timer = None
+        if self.metrics is not None:
+            timer = self.metrics.timer('storage')
+            output = timer.wrap(output)
+        apply = self.apply
         async with aclosing(input) as agen:
             async for message in agen:
-                table = message['table'] if 'table' in message else None
-                action = message['action'] if 'action' in message else None
-
-                logger.debug('Received %s message for table %s.', action, table)
-
-                # There are four possible actions from the WS:
-                # 'partial' - full table image
-                # 'insert'  - new row
-                # 'update'  - update row
-                # 'delete'  - delete row
-                if action == 'partial':
-                    logger.debug('%s: partial', table)
-                    # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. Some tables don't have keys. For those, we can use the attributes
-                    # field to generate a key.
-                    if table in Storage.TABLE_KEYS:
-                        self.keys[table] = Storage.TABLE_KEYS[table]
-                    elif message['keys']:
-                        self.keys[table] = message['keys']
+                if timer is not None:
+                    timer.start()
+
+                for batch in apply(message):
+                    await output(batch)
+
+                if timer is not None:
+                    timer.stop()
+
+    def apply(self, message: Mapping) -> List[Batch]:
+        """
+        Applies a parsed websocket message to the storage, and returns the changes as a list of
+        :class:`Batch` items. This is the synchronous core of the storage engine, that :meth:`pump`
+        wraps. It can be used without trio, for instance to replay recorded messages.
+
+        Messages without a table are ignored, except for the ``reconnect`` control message, which
+        starts a :meth:`resync`.
+
+        The batches hold the live rows of the storage, so they show the state after the latest
+        message. Use :meth:`apply_many` to keep the changes of each message. Batches derived by
+        hooks, see :meth:`add_hook`, follow the batches they were derived from.
+        """
+        table = message['table'] if 'table' in message else None
+        if table is None:
+            if 'reconnect' in message:
+                self.resync(message['reconnect'].get('tables'))
+            return []
+        if self.metrics is not None:
+            self.metrics.count(table, message.get('action'), len(message['data']) if 'data' in message else 0)
+        changes = []
+        self._apply(message, changes)
+        if self._hooks:
+            for index in range(len(changes)):
+                hooks = self._hooks.get(changes[index].table)
+                if hooks:
+                    for hook in hooks:
+                        changes.extend(hook(changes[index]))
+        return changes
+
+    def apply_many(self, messages: Iterable[Mapping], changes: bool = True) -> List[Batch]:
+        """
+        Applies parsed websocket messages in order. Returns the changes of all messages, as a flat
+        list of :class:`Batch` items, or an empty list if ``changes`` is false, which saves memory
+        when only the final state is of interest. The rows of each batch are copied after its
+        message is applied, so they aren't changed by later messages.
+        """
+        apply = self.apply
+        if not changes:
+            for message in messages:
+                apply(message)
+            return []
+        batches = []
+        for message in messages:
+            for batch in apply(message):
+                batches.append(batch._replace(rows=[_copy_item(row) for row in batch.rows]))
+        return batches
+
+    def _apply(self, message, changes: List[Batch]):
+        """Applies a table message and appends the changed rows to ``changes``."""
+        output = changes.append
+        table = message['table'] if 'table' in message else None
+        action = message['action'] if 'action' in message else None
+        if action in ('insert', 'update', 'delete'):
+            data = self._pending_rows(table, action, message['data'])
+            if data is not message['data']:
+                if not data:
+                    return
+                message = dict(message, data=data)
+
+        self.sequence += 1
+        self.versions[table] = self.sequence
+        if table == 'orderBookL2' and message['data']:
+            self.order_book(message['data'][0]['symbol']).sequence = self.sequence
+
+        # There are four possible actions from the WS:
+        # 'partial' - full table image
+        # 'insert'  - new row
+        # 'update'  - update row
+        # 'delete'  - delete row
+        if action == 'partial':
+            logger.debug('%s: partial', table)
+            # Keys are communicated on partials to let you know how to uniquely identify
+            # an item. Some tables don't have keys. For those, we can use the attributes
+            # field to generate a key.
+            keys = self.keys.get(table)
+            policy = self.policies.get(table)
+            if policy is not None and policy.keys is not None:
+                self.keys[table] = list(policy.keys)
+            elif table in Storage.TABLE_KEYS:
+                self.keys[table] = Storage.TABLE_KEYS[table]
+            elif message['keys']:
+                self.keys[table] = message['keys']
+            else:
+                self.keys[table] = list(message['attributes'].keys())
+            if keys is not None and list(keys) != list(self.keys[table]) and self.data[table]:
+                self._rekey(table)
+            if self.compact and message.get('types'):
+                self.records[table] = record_class(table, message['types'])
+            data = self._rows(table, message['data'])
+            scope = (message.get('filter') or {}).get('symbol')
+            if self._stale(table, scope):
+                # Resynchronizing after a reconnect. Only send the differences.
+                self._resync_partial(table, scope, data, not message['keys'], changes)
+            else:
+                if table in self.history:
+                    history = self.history[table]
+                    for symbol in {item['symbol'] for item in data}:
+                        history.buffer(symbol).clear()
+                    history.append(data)
+
+                # A partial is a complete image of the book, so start from scratch.
+                if table == 'orderBookL2' and data:
+                    self.order_book(data[0]['symbol']).clear()
+                    self.data[table].pop(data[0]['symbol'], None)
+
+                # Insert data
+                self.insert(table, data)
+                # Generate inserted items
+                if table =='orderBookL2':
+                    # For the orderBook we send the complete book, since sending each item
+                    # in turn doesn't make much sense, for such a big table.
+                    symbol = data[0]['symbol']
+                    output(Batch([self.data[table][symbol]], symbol, table, action))
+                elif data:
+                    output(Batch(data, None, table, action))
+
+            # Apply the rows that arrived before the partial.
+            self._partials.setdefault(table, set()).add(scope)
+            for replay in self._replay(table, scope):
+                self._apply(replay, changes)
+
+        elif action == 'insert':
+            logger.debug('%s: inserting %s', table, message["data"])
+
+            # Insert items
+            data = self._rows(table, message['data'])
+            self.insert(table, data)
+            if table in self.history:
+                self.history[table].append(data)
+            # Check if table length exceeded
+            self._limit_table_size(table)
+            # Generate inserted items
+            if data:
+                output(Batch(data, self._symbol(table, data), table, action))
+
+        elif action == 'update':
+            logger.debug('%s: updating %s', table, message["data"])
+            if table == 'orderBookL2' and message['data']:
+                self.order_book(message['data'][0]['symbol']).update(message['data'])
+            updated = []
+            for update in message['data']:
+                try:
+                    if table == 'orderBookL2':
+                        item = self.data[table][update['symbol']][update['side']][update['id']]
+                        item.update(update)
                     else:
-                        self.keys[table] = list(message['attributes'].keys())
-
-                    # Insert data
-                    self.insert(table, message['data'])
-                    # Generate inserted items
-                    if table =='orderBookL2':
-                        # For the orderBook we send the complete book, since sending each item
-                        # in turn doesn't make much sense, for such a big table.
-                        symbol = message['data'][0]['symbol']
-                        await output((self.data[table][symbol], symbol, table, action))
+                        key = self.make_key(table, update)
+                        item = self.data[table][key]
+                        # Update this item.
+                        item = self._update_row(table, key, item, update)
+                        if table == 'order':
+                            self._track_order(key, item)
+
+                    updated.append(item)
+                except KeyError:
+                    continue # No item found to update. Could happen before push
+            # Send back the updated items
+            if updated:
+                output(Batch(updated, self._symbol(table, updated), table, action))
+
+        elif action == 'delete':
+            logger.debug('%s: deleting %s', table, message["data"])
+            if table == 'orderBookL2' and message['data']:
+                self.order_book(message['data'][0]['symbol']).delete(message['data'])
+            for item in message['data']:
+                # Locate the item in the collection and remove it.
+                try:
+                    if table == 'orderBookL2':
+                        del self.data[table][item['symbol']][item['side']][item['id']]
                     else:
-                        # For all other tables, generate each individual item
-                        for item in message['data']:
-                            if 'symbol' in item:
-                                await output((item, item['symbol'], table, action))
-                            else:
-                                await output((item, None, table, action))
-
-                elif action == 'insert':
-                    logger.debug('%s: inserting %s', table, message["data"])
-
-                    # Check if table length exceeded
-                    self._limit_table_size(table)
-                    # Insert items
-                    self.insert(table, message['data'])
-                    # Generate inserted items
-                    for item in message['data']:
-                        if 'symbol' in item:
-                            await output((item, item['symbol'], table, action))
-                        else:
-                            await output((item, None, table, action))
-
-
-                elif action == 'update':
-                    logger.debug('%s: updating %s', table, message["data"])
-                    for update in message['data']:
-                        try:
-                            if table == 'orderBookL2':
-                                item = self.data[table][update['symbol']][update['side']][update['id']]
-                            else:
-                                item = self.data[table][self.make_key(table, update)]
-
-                            # Update this item.
-                            item.update(update)
-
-                            # Send back the updated item
-                            if 'symbol' in item:
-                                await output((item, item['symbol'], table, action))
-                            else:
-                                await output((item, None, table, action))
-                        except KeyError:
-                            continue # No item found to update. Could happen before push
-
-                elif action == 'delete':
-                    logger.debug('%s: deleting %s', table, message["data"])
-                    for item in message['data']:
-                        # Locate the item in the collection and remove it.
-                        try:
-                            if table == 'orderBookL2':
-                                del self.data[table][item['symbol']][item['side']][item['id']]
-                            else:
-                                del self.data[table][self.make_key(table, item)]
-                        except KeyError:
-                            pass # Item not found
-                    # Send back the deletion fragment
-                    for item in message['data']:
-                        if 'symbol' in item:
-                            await output((item, item['symbol'], table, action))
-                        else:
-                            await output((item, None, table, action))
-
-                else:
-                    raise Exception(f'Unknown action: {action}')
+                        key = self.make_key(table, item)
+                        self._unindex(table, key, self._table(table).pop(key))
+                        self._disown(table, key)
+                        if table == 'order':
+                            self._closed_orders.pop(key, None)
+                except KeyError:
+                    pass # Item not found
+            # Send back the deletion fragments
+            if message['data']:
+                output(Batch(message['data'], self._symbol(table, message['data']), table, action))
+
+        else:
+            raise Exception(f'Unknown action: {action}')
+
+        if table == 'orderBookL2' and message['data']:
+            analytics = self.order_book(message['data'][0]['symbol']).analytics
+            if analytics is not None and analytics.refresh(self.sequence):
+                output(Batch([analytics.metrics], analytics.book.symbol, ANALYTICS_TABLE, 'update'))
     
+    def _pending_rows(self, table: str, action: str, data: List[TableItem]) -> List[TableItem]:
+        """
+        Holds back the rows of a message, that arrived before the partial of their table and
+        symbol. Returns the rows that can be applied, which is ``data`` itself if all can.
+        """
+        scopes = self._partials.get(table)
+        if scopes is not None:
+            if None in scopes:
+                return data
+            held = [row for row in data if row.get('symbol') not in scopes]
+            if not held:
+                return data
+            ready = [row for row in data if row.get('symbol') in scopes]
+        else:
+            held, ready = data, []
+        pending = self._pending.setdefault(table, deque())
+        pending.extend((action, row) for row in held)
+        self.buffered[table] += len(held)
+        while len(pending) > self.PENDING_LIMIT:
+            pending.popleft()
+            self.discarded[table] += 1
+        logger.debug('%s: holding back %d rows until the partial.', table, len(held))
+        return ready
+
+    def _replay(self, table: str, scope: Optional[str]):
+        """
+        Takes the held back rows of a table and symbol scope, after its partial has been applied,
+        and returns them as messages, in order of arrival. Inserts of rows the partial already
+        contains, and rows that are older than the row in the partial, by timestamp, are discarded.
+        """
+        pending = self._pending.get(table)
+        if not pending:
+            return []
+        rows, kept = [], deque()
+        for action, row in pending:
+            (rows if scope is None or row.get('symbol') == scope else kept).append((action, row))
+        if kept:
+            self._pending[table] = kept
+        else:
+            del self._pending[table]
+        messages = []
+        for action, row in rows:
+            if action == 'insert':
+                if self._current(table, row) is not None:
+                    self.discarded[table] += 1
+                    continue
+            elif action == 'update' and 'timestamp' in row:
+                current = self._current(table, row)
+                if current is not None and 'timestamp' in current and row['timestamp'] < current['timestamp']:
+                    self.discarded[table] += 1
+                    continue
+            if messages and messages[-1]['action'] == action:
+                messages[-1]['data'].append(row)
+            else:
+                messages.append({'table': table, 'action': action, 'data': [row]})
+        logger.debug('%s: replaying %d held back rows.', table, sum(len(message['data']) for message in messages))
+        return messages
+
+    def _current(self, table: str, row: TableItem) -> Optional[TableItem]:
+        """The stored row with the same key as a row, if any."""
+        try:
+            if table == 'orderBookL2':
+                return self.data[table][row['symbol']][row['side']].get(row['id'])
+            return self.data[table].get(self.make_key(table, row))
+        except KeyError:
+            return None
+
+    def _rekey(self, table: str):
+        """
+        Rebuilds a table under its current key columns, with its indexes and age index. Rows are
+        visited in the order of their old keys, so a later row replaces an earlier row with the
+        same new key. Rows without the key columns are dropped.
+        """
+        rows = SortedDict()
+        for row in self.data[table].values():
+            try:
+                rows[self.make_key(table, row)] = row
+            except KeyError:
+                continue
+        self.data[table] = rows
+        # Rows may still be shared with a snapshot of the old table.
+        self._snapshots.pop(table, None)
+        if table in self._owned:
+            self._owned[table] = set()
+        indexes = self.indexes.get(table)
+        if indexes:
+            for columns in indexes:
+                index = indexes[columns] = Index(columns)
+                for key, row in rows.items():
+                    index.add(key, row)
+        if table in self._ages:
+            self._ages[table] = deque()
+            self._aged[table] = {}
+            self._track_age(table, rows.values())
+
+    def _track_age(self, table: str, data: Iterable[TableItem]):
+        """Adds inserted rows to the age index of a table with a maximum age."""
+        ages, aged = self._ages[table], self._aged[table]
+        newest = self._newest.get(table, 0)
+        for item in data:
+            timestamp = item.get('timestamp')
+            if timestamp:
+                timestamp = parse_timestamp(timestamp)
+                key = self.make_key(table, item)
+                ages.append((timestamp, key))
+                aged[key] = timestamp
+                if timestamp > newest:
+                    newest = timestamp
+        self._newest[table] = newest
+
+    def _evict_aged(self, table: str, max_age: float):
+        """
+        Deletes the rows of a table that are more than ``max_age`` seconds older than the newest row
+        inserted. Only the evicted rows, and rows that were replaced or updated, are visited.
+        """
+        ages, aged = self._ages[table], self._aged[table]
+        cutoff = self._newest.get(table, 0) - int(max_age * 1e9)
+        rows = None
+        while ages and ages[0][0] < cutoff:
+            timestamp, key = ages.popleft()
+            if aged.get(key) != timestamp:
+                continue # Replaced by a newer row
+            row = self.data[table].get(key)
+            if row is not None and row.get('timestamp'):
+                # The row may have been updated since it was inserted.
+                current = parse_timestamp(row['timestamp'])
+                if current >= cutoff:
+                    ages.append((current, key))
+                    aged[key] = current
+                    continue
+            del aged[key]
+            if row is not None:
+                if rows is None:
+                    rows = self._table(table)
+                del rows[key]
+                self._unindex(table, key, row)
+                self._disown(table, key)
+
     def _limit_table_size(self, table):
         """Limit the max length of the table to avoid excessive memory usage."""
         if table == 'order':
-            # Trim closed orders that are older than a minute - Filled orders
-            # can be reopened by amending leavesQty within a minute. After that
-            # we can delete them.
-            outdated_keys = [
-                k for k, i in self.data[table].items()
-                if i['leavesQty'] <= 0 and pendulum.now().diff(pendulum.parse(i['timestamp'])).in_seconds() > 60
-            ]
-            for key in outdated_keys:
-                del self.data[table][key]
+            self.evict()
         elif table == 'orderBookL2':
             # Don't trim the order book because we'll lose valuable state if we do.
             pass
-        elif len(self.data[table]) > self.MAX_TABLE_LEN:
-            # Delete the first half of the keys
-            del self.data[table].keys()[:(self.MAX_TABLE_LEN // 2)]
+        else:
+            policy = self.policies.get(table)
+            max_rows = self.MAX_TABLE_LEN
+            if policy is not None:
+                if policy.max_age is not None:
+                    self._evict_aged(table, policy.max_age)
+                if policy.max_rows is not None:
+                    max_rows = policy.max_rows
+            if len(self.data[table]) <= max_rows:
+                return
+            # Delete the oldest keys in excess of the limit
+            rows = self._table(table)
+            excess = len(rows) - max_rows
+            if table in self.indexes:
+                for key in rows.keys()[:excess]:
+                    self._unindex(table, key, rows[key])
+            del rows.keys()[:excess]
     
+    def resync(self, tables: Optional[Iterable[str]] = None):
+        """
+        Marks the current state as stale, after a reconnect. The next partial for each table and
+        symbol is compared to the stale state, and only the differences are applied and sent
+        downstream, as inserts, updates and deletes. Rows that did not change are not sent.
+
+        :param tables: Tables to resynchronize. Defaults to all tables.
+        """
+        self._resync.update((table, set()) for table, rows in self.data.items()
+                            if rows and (tables is None or table in tables))
+
+    def _stale(self, table: str, scope: Optional[str]) -> bool:
+        """Returns ``True`` if a partial for the table and symbol scope should be resynchronized."""
+        if table not in self._resync or scope in self._resync[table]:
+            return False
+        if table == 'orderBookL2':
+            return bool(self.data[table].get(scope))
+        return any(self._scoped(table, scope))
+
+    def _scoped(self, table: str, scope: Optional[str]):
+        """Iterate the (key, row) pairs of a table, that are within a symbol scope."""
+        for key, row in self.data[table].items():
+            if scope is None or row.get('symbol') == scope:
+                yield key, row
+
+    def _resync_partial(self, table: str, scope: Optional[str], data, append_only: bool, changes: List[Batch]):
+        """
+        Applies a partial as the differences against the stale state. For tables without keys, like
+        trade and quote, rows are never updated or deleted, so only new rows are inserted.
+        """
+        self._resync[table].add(scope)
+        inserts, updates, deletes = [], [], []
+        if table == 'orderBookL2':
+            sides = self.data[table][scope]
+            new = {(row['side'], row['id']): row for row in data}
+            for side, levels in sides.items():
+                for level_id in [level_id for level_id in levels if (side, level_id) not in new]:
+                    deletes.append(levels.pop(level_id))
+            for (side, level_id), row in new.items():
+                level = sides[side].get(level_id)
+                if level is None:
+                    sides[side][level_id] = row
+                    inserts.append(row)
+                elif any(level.get(name) != value for name, value in row.items()):
+                    level.update(row)
+                    updates.append(level)
+            book = self.order_book(scope)
+            book.clear()
+            book.insert(level for levels in sides.values() for level in levels.values())
+        else:
+            rows = self._table(table)
+            new = {self.make_key(table, row): row for row in data}
+            if not append_only:
+                for key in [key for key, _ in self._scoped(table, scope) if key not in new]:
+                    deletes.append(rows.pop(key))
+                    self._unindex(table, key, deletes[-1])
+            for key, row in new.items():
+                item = rows.get(key)
+                if item is None:
+                    rows[key] = row
+                    self._index(table, key, row)
+                    inserts.append(row)
+                elif not append_only and any(item.get(name) != value for name, value in row.items()):
+                    updates.append(self._update_row(table, key, item, row))
+            if table == 'order':
+                for item in deletes:
+                    self._closed_orders.pop(self.make_key(table, item), None)
+                for item in inserts + updates:
+                    self._track_order(self.make_key(table, item), item)
+            if table in self.history:
+                self.history[table].append(inserts)
+            if table in self._ages:
+                self._track_age(table, inserts)
+        logger.debug('%s: resynchronized %s. %d inserts, %d updates, %d deletes.', table, scope or 'all symbols',
+                     len(inserts), len(updates), len(deletes))
+        for action, items in (('delete', deletes), ('insert', inserts), ('update', updates)):
+            if items:
+                changes.append(Batch(items, self._symbol(table, items), table, action))
+
+    @staticmethod
+    def _symbol(table: str, rows: List[TableItem]) -> Optional[str]:
+        """The symbol of a batch. Only orderBookL2 messages are known to hold a single symbol."""
+        return rows[0]['symbol'] if table == 'orderBookL2' else None
+
+    def _rows(self, table: str, data: Iterable[TableItem]) -> Iterable[TableItem]:
+        """Converts rows to compact records, if the table has a record class."""
+        record = self.records.get(table)
+        if record is None:
+            return data
+        return [record(row) for row in data]
+
+    def _track_order(self, key: tuple, item: TableItem):
+        """Adds closed orders to the eviction index, and removes orders that were reopened."""
+        if item.get('leavesQty', 1) <= 0:
+            if key not in self._closed_orders:
+                self._closed_orders[key] = monotonic()
+        else:
+            self._closed_orders.pop(key, None)
+
+    def evict(self, now: Optional[float] = None) -> int:
+        """
+        Deletes closed orders that have been closed for longer than :attr:`ORDER_RETENTION`
+        seconds. Only the evicted orders are visited. Returns the number of evicted orders.
+
+        :param float now: Monotonic time to evict relative to. Defaults to the current time.
+        """
+        closed = self._closed_orders
+        if not closed:
+            return 0
+        cutoff = (monotonic() if now is None else now) - self.ORDER_RETENTION
+        evicted = 0
+        while closed:
+            key, closed_at = next(iter(closed.items()))
+            if closed_at > cutoff:
+                break
+            del closed[key]
+            row = self._table('order').pop(key, None)
+            if row is not None:
+                self._unindex('order', key, row)
+                self._disown('order', key)
+            evicted += 1
+        if evicted:
+            self.sequence += 1
+            self.versions['order'] = self.sequence
+        return evicted
+
+    async def evict_periodically(self):
+        """Evicts closed orders every :attr:`EVICTION_INTERVAL` seconds. Runs until cancelled."""
+        while True:
+            await trio.sleep(self.EVICTION_INTERVAL)
+            self.evict()
+
     def insert(self, table: str, data: Iterable[TableItem]):
         """Inserts a sequence of table items into the given table"""
         if table == 'orderBookL2':
@@ -159,9 +664,300 @@ class Storage(Section):
                 raise RuntimeError('Order book update contained multiple symbols')
             for item in data:
                 self.data[table][item['symbol']][item['side']][item['id']] = item
+            if data:
+                self.order_book(data[0]['symbol']).insert(data)
+        elif table in self.indexes:
+            rows = self._table(table)
+            for item in data:
+                key = self.make_key(table, item)
+                if key in rows:
+                    self._unindex(table, key, rows[key])
+                rows[key] = item
+                self._index(table, key, item)
+                if table == 'order':
+                    self._track_order(key, item)
+        elif table == 'order':
+            rows = self._table(table)
+            for item in data:
+                key = self.make_key(table, item)
+                rows[key] = item
+                self._track_order(key, item)
         else:
-            self.data[table].update((self.make_key(table, item), item) for item in data)
+            self._table(table).update((self.make_key(table, item), item) for item in data)
+        if table in self._ages:
+            self._track_age(table, data)
+
+    def snapshot(self, table: str, symbol: Optional[str] = None) -> Union[TableSnapshot, OrderBook]:
+        """
+        Returns a read only snapshot of a table, or of the order book of a symbol for orderBookL2.
+        Snapshots are O(1) to take and safe to hold across awaits. Storage copies a table or book
+        side the first time it is written after a snapshot, and copies each row of a table the
+        first time it is updated. Snapshots of an unchanged table or book are the same object.
+
+        :param str symbol: Symbol of the order book. Required for orderBookL2.
+        """
+        if table == 'orderBookL2':
+            if symbol is None:
+                raise ValueError('orderBookL2 snapshots require a symbol.')
+            return self.order_book(symbol).snapshot()
+        snapshot = self._snapshots.get(table)
+        if snapshot is None:
+            snapshot = self._snapshots[table] = TableSnapshot(table, self.versions.get(table, 0), self.data[table])
+            self._owned[table] = set()
+        return snapshot
+
+    def _table(self, table: str) -> SortedDict:
+        """The rows of a table for writing, copied first if the table is shared with a snapshot."""
+        if table in self._snapshots:
+            del self._snapshots[table]
+            self.data[table] = self.data[table].copy()
+        return self.data[table]
+
+    def _disown(self, table: str, key: tuple):
+        owned = self._owned.get(table)
+        if owned is not None:
+            owned.discard(key)
+
+    def set_policy(self, table: str, policy: Union[TablePolicy, Mapping]):
+        """
+        Sets the retention and key policy of a table, for instance
+        ``set_policy('quote', TablePolicy(latest_only=True))``. A mapping of
+        :class:`~bitmex_trio_websocket.policies.TablePolicy` arguments is accepted as well. Key
+        changes apply from the next partial of the table, which rebuilds the rows already stored
+        under the new keys. Rows are trimmed to ``max_rows`` and
+        ``max_age`` as rows are inserted.
+
+        The order book and order tables are retained by storage, and can't have a policy.
+        """
+        if table in ('orderBookL2', 'order'):
+            raise ValueError(f'{table} is retained by storage, and can\'t have a policy.')
+        policy = table_policy(policy)
+        self.policies[table] = policy
+        if policy.max_age is None:
+            self._ages.pop(table, None)
+            self._aged.pop(table, None)
+        elif table not in self._ages:
+            self._ages[table] = deque()
+            self._aged[table] = {}
+            self._track_age(table, self.data[table].values() if table in self.data else ())
+
+    def memory_usage(self, sample: int = 100) -> dict:
+        """
+        Approximate memory usage per table and symbol, for instance to size hosts and to catch
+        unbounded growth. Returns a mapping of table name to ``{'rows': int, 'bytes': int,
+        'symbols': {symbol: {'rows': int, 'bytes': int}}}``. Rows without a symbol are counted under
+        the ``None`` symbol. Order book bytes include the price ordered book, and tables with a
+        history include the ring buffers, in ``history_bytes``.
+
+        The size of a row is estimated from up to ``sample`` rows per table and symbol, as the size
+        of the row, its values and its key, plus the table entry. Values shared between rows, like
+        interned symbols, are counted for every row, while allocator overhead is not.
+        """
+        usage = {}
+        for table, rows in self.data.items():
+            if not rows:
+                continue
+            if table == 'orderBookL2':
+                groups = {symbol: [item for levels in sides.values() for item in levels.items()]
+                          for symbol, sides in rows.items()}
+            else:
+                groups = {}
+                for item in rows.items():
+                    groups.setdefault(item[1].get('symbol'), []).append(item)
+            symbols = {}
+            for symbol, group in groups.items():
+                if not group:
+                    continue
+                step = max(1, len(group) // sample)
+                sampled = group[::step][:sample]
+                size = sum(getsizeof(key) + _row_bytes(row) for key, row in sampled) / len(sampled)
+                total = int(size * len(group))
+                if table == 'orderBookL2' and symbol in self.books:
+                    book = self.books[symbol]
+                    # A price and size per level, and a price per level id.
+                    total += len(book) * (ENTRY_BYTES + 2 * getsizeof(0.0)) + len(book._prices) * ENTRY_BYTES
+                symbols[symbol] = {'rows': len(group), 'bytes': total}
+            usage[table] = {'rows': sum(entry['rows'] for entry in symbols.values()),
+                            'bytes': sum(entry['bytes'] for entry in symbols.values()),
+                            'symbols': symbols}
+        for table, history in self.history.items():
+            entry = usage.setdefault(table, {'rows': 0, 'bytes': 0, 'symbols': {}})
+            entry['history_bytes'] = sum(buffer.nbytes for buffer in history.buffers.values())
+        return usage
+
+    def add_index(self, table: str, *columns: str) -> Index:
+        """
+        Add a secondary index on one or more columns of a table, for instance
+        ``add_index('order', 'clOrdID')``. The index is built from the rows already in the table,
+        and is maintained as rows are inserted, updated and deleted. See :meth:`query`.
+        """
+        if table == 'orderBookL2':
+            raise ValueError('orderBookL2 can\'t be indexed. Use order_book(symbol) instead.')
+        indexes = self.indexes.setdefault(table, {})
+        if columns not in indexes:
+            index = indexes[columns] = Index(columns)
+            for key, row in self.data[table].items():
+                index.add(key, row)
+        return indexes[columns]
+
+    def _index(self, table: str, key: tuple, row: TableItem):
+        for index in self.indexes.get(table, {}).values():
+            index.add(key, row)
+
+    def _unindex(self, table: str, key: tuple, row: TableItem):
+        for index in self.indexes.get(table, {}).values():
+            index.remove(key, row)
+
+    def _update_row(self, table: str, key: tuple, item: TableItem, update: TableItem) -> TableItem:
+        """
+        Updates a row, and moves it in the indexes on the columns that change. A row that may be
+        shared with a snapshot is copied first. Returns the updated row.
+        """
+        owned = self._owned.get(table)
+        if owned is not None and key not in owned:
+            item = type(item)(item)
+            self._table(table)[key] = item
+            owned.add(key)
+        indexes = self.indexes.get(table)
+        if not indexes:
+            item.update(update)
+            return item
+        affected = [index for index in indexes.values() if index.affected(update)]
+        for index in affected:
+            index.remove(key, item)
+        item.update(update)
+        for index in affected:
+            index.add(key, item)
+        return item
+
+    def query(self, table: str, where: Optional[Callable[[TableItem], bool]] = None,
+              **criteria) -> List[TableItem]:
+        """
+        Returns the rows of a table where the given columns equal the given values, and ``where``
+        returns true, if given. For instance ``query('order', symbol='XBTUSD', ordStatus='New')``.
+
+        The index that covers the most criteria is used to find candidate rows, and only those are
+        checked against the remaining criteria. Without a matching index, the table is scanned.
+        """
+        rows = self.data[table]
+        best = None
+        for columns, index in self.indexes.get(table, {}).items():
+            if best is not None and len(columns) <= len(best.columns):
+                continue
+            if all(column in criteria for column in columns):
+                best = index
+        if best is None:
+            candidates = rows.values()
+        else:
+            candidates = [rows[key] for key in best.lookup(tuple(criteria[column] for column in best.columns))]
+            criteria = {column: value for column, value in criteria.items() if column not in best.columns}
+        return [row for row in candidates
+                if all(row.get(column) == value for column, value in criteria.items())
+                and (where is None or where(row))]
+
+    def lookup(self, table: str, **criteria) -> Optional[TableItem]:
+        """
+        Returns the first row of a table matching the criteria, or ``None``. For instance
+        ``lookup('order', clOrdID='my-order-1')``. See :meth:`query`.
+        """
+        rows = self.query(table, **criteria)
+        return rows[0] if rows else None
     
+    def keep_history(self, table: str, capacity: int):
+        """
+        Keep a ring buffer history of the last ``capacity`` rows per symbol for a table. Supported
+        tables are trade, quote and liquidation. See :meth:`ring_buffer`.
+        """
+        self.history[table] = History(table, capacity)
+
+    def ring_buffer(self, table: str, symbol: str) -> RingBuffer:
+        """
+        Returns the ring buffer history for a table and symbol. ``ring_buffer('trade',
+        'XBTUSD').last(100)`` returns the last 100 trades as zero-copy NumPy arrays.
+        """
+        return self.history[table].buffer(symbol)
+
+    def track_analytics(self, symbol: str, levels: int = 10,
+                        bands: Sequence[float] = DEFAULT_BANDS) -> BookAnalytics:
+        """
+        Keep the :class:`~bitmex_trio_websocket.analytics.BookMetrics` of the order book of a symbol
+        up to date. After each orderBookL2 message that changes them, the metrics are sent
+        downstream under :data:`~bitmex_trio_websocket.analytics.ANALYTICS_TABLE`. Registrations are
+        counted, so every call must be paired with a call to :meth:`untrack_analytics`.
+
+        :param int levels: Number of levels per side used for the imbalance.
+        :param bands: Depth bands, in basis points from the mid price.
+        :raises ValueError: If the book is already tracked with other parameters.
+        """
+        book = self.order_book(symbol)
+        analytics = book.analytics
+        if analytics is None:
+            analytics = book.analytics = BookAnalytics(book, levels, bands)
+            if book:
+                analytics.refresh(book.sequence)
+        elif (analytics.levels, analytics.bands) != (levels, tuple(sorted(bands))):
+            raise ValueError(f'Analytics of {symbol} are already tracked with levels={analytics.levels} '
+                             f'and bands={analytics.bands}.')
+        self._analytics[symbol] += 1
+        return analytics
+
+    def untrack_analytics(self, symbol: str):
+        """Stop keeping the analytics of an order book, when there are no more registrations."""
+        self._analytics[symbol] -= 1
+        if self._analytics[symbol] <= 0:
+            del self._analytics[symbol]
+            self.order_book(symbol).analytics = None
+
+    def add_hook(self, table: str, hook: Callable[[Batch], Iterable[Batch]]):
+        """
+        Add a hook, that is called with each batch of a table, right after the message is applied,
+        and returns batches derived from it, like candles or book deltas. Derived batches are sent
+        downstream with the storage output. Adding a hook twice has no effect.
+        """
+        hooks = self._hooks.get(table, ())
+        if hook not in hooks:
+            self._hooks[table] = hooks + (hook,)
+
+    def remove_hook(self, table: str, hook: Callable[[Batch], Iterable[Batch]]):
+        """Remove a hook added with :meth:`add_hook`."""
+        hooks = tuple(other for other in self._hooks.get(table, ()) if other != hook)
+        if hooks:
+            self._hooks[table] = hooks
+        else:
+            self._hooks.pop(table, None)
+
+    def analyzing(self, table: str) -> bool:
+        """Returns ``True`` if order book messages are needed for analytics."""
+        return table == 'orderBookL2' and bool(self._analytics)
+
+    def order_book(self, symbol: str) -> OrderBook:
+        """Returns the price ordered order book for a symbol."""
+        try:
+            return self.books[symbol]
+        except KeyError:
+            book = self.books[symbol] = OrderBook(symbol)
+            return book
+
+    def item_key(self, table: str, item: TableItem) -> Optional[tuple]:
+        """
+        Creates a storage key tuple for any item output by the storage engine. Unlike
+        :meth:`make_key` this includes orderBookL2 levels, which are keyed by (symbol, side, id).
+        Returns ``None`` for items that are not table rows, such as a complete order book, or items
+        of tables that storage has no keys for.
+        """
+        try:
+            if table == 'orderBookL2':
+                # A complete book is a defaultdict, so check for a level without indexing it.
+                if 'id' not in item:
+                    return None
+                return (item['symbol'], item['side'], item['id'])
+            # Checked first, since keys is a defaultdict.
+            if table not in self.keys:
+                return None
+            return self.make_key(table, item)
+        except KeyError:
+            return None
+
     def make_key(self, table: str, match_data: TableItem) -> tuple:
         """Creates a storage key tuple from a table item"""
         if table == 'orderBookL2':
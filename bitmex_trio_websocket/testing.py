@@ -0,0 +1,376 @@
+"""
+A local stand-in for the BitMEX realtime api.
+
+The server speaks enough of the BitMEX websocket protocol to run the client against it offline:
+the welcome message, subscribe and unsubscribe acknowledgements, ``partial`` images followed by
+synthetic ``insert``, ``update`` and ``delete`` messages, authentication and ``cancelAllAfter``.
+Synthetic load is generated for each subscription at a configurable rate.
+"""
+from datetime import datetime, timezone
+import logging
+import math
+import random
+import time
+from typing import Mapping, Optional, Sequence
+
+from async_generator import asynccontextmanager
+import trio
+from trio_websocket import ConnectionClosed, serve_websocket
+
+from .auth import generate_signature
+from .codec import get_backend
+
+log = logging.getLogger(__name__)
+
+# Messages per second, for each subscription
+DEFAULT_RATES = {
+    'orderBookL2': 100,
+    'trade': 10,
+    'quote': 20,
+    'instrument': 1,
+    'order': 1,
+}
+# Rows per message
+DEFAULT_ROWS = {
+    'orderBookL2': 3,
+}
+PRIVATE_TABLES = {'order'}
+
+# Keys, attributes and types sent with each partial.
+SCHEMAS = {
+    'orderBookL2': (
+        ['symbol', 'id', 'side'],
+        {'symbol': 'parted', 'id': 'sorted'},
+        {'symbol': 'symbol', 'id': 'long', 'side': 'symbol', 'size': 'long', 'price': 'float',
+         'timestamp': 'timestamp'},
+    ),
+    'trade': (
+        [],
+        {'timestamp': 'sorted', 'symbol': 'grouped'},
+        {'timestamp': 'timestamp', 'symbol': 'symbol', 'side': 'symbol', 'size': 'long', 'price': 'float',
+         'tickDirection': 'symbol', 'trdMatchID': 'guid', 'grossValue': 'long', 'homeNotional': 'float',
+         'foreignNotional': 'float'},
+    ),
+    'quote': (
+        [],
+        {'timestamp': 'sorted', 'symbol': 'grouped'},
+        {'timestamp': 'timestamp', 'symbol': 'symbol', 'bidSize': 'long', 'bidPrice': 'float',
+         'askPrice': 'float', 'askSize': 'long'},
+    ),
+    'instrument': (
+        ['symbol'],
+        {'symbol': 'unique'},
+        {'symbol': 'symbol', 'state': 'symbol', 'lastPrice': 'float', 'markPrice': 'float',
+         'timestamp': 'timestamp'},
+    ),
+    'order': (
+        ['orderID'],
+        {'orderID': 'grouped', 'account': 'grouped', 'ordStatus': 'grouped', 'workingIndicator': 'grouped'},
+        {'orderID': 'guid', 'clOrdID': 'symbol', 'account': 'long', 'symbol': 'symbol', 'side': 'symbol',
+         'orderQty': 'long', 'price': 'float', 'ordStatus': 'symbol', 'workingIndicator': 'boolean',
+         'leavesQty': 'long', 'cumQty': 'long', 'timestamp': 'timestamp'},
+    ),
+}
+
+def timestamp(now: Optional[float] = None) -> str:
+    """BitMEX style timestamp, with microsecond resolution."""
+    if now is None:
+        now = time.time()
+    return datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+class Market:
+    """Synthetic market state for a set of symbols."""
+    def __init__(self, symbols: Sequence[str], *, depth: int = 25, seed: int = 0):
+        self.symbols = list(symbols)
+        self.depth = depth
+        self.random = random.Random(seed)
+        self.prices = {symbol: 10000.0 * (i + 1) for i, symbol in enumerate(self.symbols)}
+        self.books = {symbol: {} for symbol in self.symbols}
+        self.orders = {}
+        self._sequence = 0
+        for symbol in self.symbols:
+            for level in range(1, depth + 1):
+                self._level(symbol, 'Buy', self.prices[symbol] - level * 0.5)
+                self._level(symbol, 'Sell', self.prices[symbol] + level * 0.5)
+
+    def _level(self, symbol, side, price):
+        index = self.symbols.index(symbol)
+        level_id = 8800000000 * (index + 1) - int(price * 100)
+        level = {'symbol': symbol, 'id': level_id, 'side': side, 'size': self.random.randint(1, 10000),
+                 'price': price, 'timestamp': timestamp()}
+        self.books[symbol][level_id] = level
+        return level
+
+    def _guid(self):
+        self._sequence += 1
+        return f'00000000-0000-0000-0000-{self._sequence:012d}'
+
+    def partial(self, table: str, symbol: str) -> list:
+        """Rows for the partial image of a table."""
+        if table == 'orderBookL2':
+            return [dict(level) for level in self.books[symbol].values()]
+        if table == 'instrument':
+            return [self._instrument(symbol)]
+        if table == 'order':
+            return [dict(order) for order in self.orders.values() if order['symbol'] == symbol]
+        if table in ('trade', 'quote'):
+            return [getattr(self, f'_{table}')(symbol)]
+        return []
+
+    def _instrument(self, symbol):
+        return {'symbol': symbol, 'state': 'Open', 'lastPrice': self.prices[symbol],
+                'markPrice': self.prices[symbol], 'timestamp': timestamp()}
+
+    def _trade(self, symbol):
+        self.prices[symbol] += self.random.choice((-0.5, 0, 0.5))
+        size = self.random.randint(1, 1000)
+        return {'timestamp': timestamp(), 'symbol': symbol, 'side': self.random.choice(('Buy', 'Sell')),
+                'size': size, 'price': self.prices[symbol], 'tickDirection': 'ZeroPlusTick',
+                'trdMatchID': self._guid(), 'grossValue': size * 100, 'homeNotional': size / self.prices[symbol],
+                'foreignNotional': size}
+
+    def _quote(self, symbol):
+        price = self.prices[symbol]
+        return {'timestamp': timestamp(), 'symbol': symbol, 'bidSize': self.random.randint(1, 10000),
+                'bidPrice': price - 0.5, 'askPrice': price + 0.5, 'askSize': self.random.randint(1, 10000)}
+
+    def _book(self, symbol, rows):
+        book = self.books[symbol]
+        roll = self.random.random()
+        if roll < 0.05 and len(book) > 2:
+            level = book.pop(self.random.choice(list(book)))
+            return 'delete', [{'symbol': symbol, 'id': level['id'], 'side': level['side'],
+                               'price': level['price'], 'timestamp': timestamp()}]
+        if roll < 0.1:
+            side = self.random.choice(('Buy', 'Sell'))
+            prices = [level['price'] for level in book.values() if level['side'] == side]
+            if side == 'Buy':
+                price = min(prices, default=self.prices[symbol]) - 0.5
+            else:
+                price = max(prices, default=self.prices[symbol]) + 0.5
+            return 'insert', [dict(self._level(symbol, side, price))]
+        updates = []
+        for level_id in self.random.sample(list(book), min(rows, len(book))):
+            level = book[level_id]
+            level['size'] = self.random.randint(1, 10000)
+            level['timestamp'] = timestamp()
+            updates.append({'symbol': symbol, 'id': level_id, 'side': level['side'], 'size': level['size'],
+                            'price': level['price'], 'timestamp': level['timestamp']})
+        return 'update', updates
+
+    def _order(self, symbol):
+        live = [order for order in self.orders.values() if order['symbol'] == symbol and order['leavesQty'] > 0]
+        if not live or self.random.random() < 0.5:
+            quantity = self.random.randint(1, 100) * 100
+            order = {'orderID': self._guid(), 'clOrdID': f'client-{self._sequence}', 'account': 1,
+                     'symbol': symbol, 'side': self.random.choice(('Buy', 'Sell')), 'orderQty': quantity,
+                     'price': self.prices[symbol], 'ordStatus': 'New', 'workingIndicator': True,
+                     'leavesQty': quantity, 'cumQty': 0, 'timestamp': timestamp()}
+            self.orders[order['orderID']] = order
+            return 'insert', [dict(order)]
+        order = self.random.choice(live)
+        fill = min(order['leavesQty'], self.random.randint(1, 100) * 100)
+        order['leavesQty'] -= fill
+        order['cumQty'] += fill
+        order['ordStatus'] = 'Filled' if order['leavesQty'] == 0 else 'PartiallyFilled'
+        order['workingIndicator'] = order['leavesQty'] > 0
+        order['timestamp'] = timestamp()
+        return 'update', [{key: order[key] for key in
+                           ('orderID', 'symbol', 'leavesQty', 'cumQty', 'ordStatus', 'workingIndicator', 'timestamp')}]
+
+    def message(self, table: str, symbol: str, rows: int = 1) -> dict:
+        """Generate the next message for a table and symbol."""
+        if table == 'orderBookL2':
+            action, data = self._book(symbol, rows)
+        elif table == 'order':
+            action, data = self._order(symbol)
+        elif table == 'instrument':
+            self.prices[symbol] += self.random.choice((-0.5, 0, 0.5))
+            action, data = 'update', [{'symbol': symbol, 'lastPrice': self.prices[symbol], 'timestamp': timestamp()}]
+        else:
+            action, data = 'insert', [getattr(self, f'_{table}')(symbol) for _ in range(rows)]
+        return {'table': table, 'action': action, 'data': data}
+
+class BitMEXServer:
+    """
+    Local BitMEX realtime api server.
+
+    :param symbols: Symbols available on the server.
+    :param rates: Messages per second for each subscription, by table. Use ``math.inf`` to send as
+        fast as possible, and ``0`` to only send the partial.
+    :param rows: Rows per generated message, by table.
+    :param api_key: Api key accepted by the server. Connections with other keys are rejected.
+    :param api_secret: Api secret for the api key.
+    :param seed: Random seed for the synthetic market.
+    """
+    def __init__(self, *, symbols: Sequence[str] = ('XBTUSD', 'ETHUSD'),
+                 rates: Optional[Mapping[str, float]] = None,
+                 rows: Optional[Mapping[str, int]] = None,
+                 api_key: Optional[str] = None, api_secret: Optional[str] = None,
+                 seed: int = 0):
+        self.market = Market(symbols, seed=seed)
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.rows = {**DEFAULT_ROWS, **(rows or {})}
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.host = None
+        self.port = None
+        self.sessions = set()
+        self._dumps = get_backend().dumps
+        self._loads = get_backend().loads
+
+    @property
+    def url(self) -> str:
+        """The websocket url of the server."""
+        return f'ws://{self.host}:{self.port}/realtime'
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 0, *, task_status=trio.TASK_STATUS_IGNORED):
+        """Serve the api. Compatible with ``nursery.start``."""
+        async with trio.open_nursery() as nursery:
+            server = await nursery.start(serve_websocket, self._handler, host, port, None)
+            self.host = host
+            self.port = server.port
+            task_status.started(self)
+
+    async def disconnect(self, code: int = 1001, reason: str = 'Going away'):
+        """Close all client connections, for instance to test reconnects."""
+        for session in list(self.sessions):
+            await session.connection.aclose(code, reason)
+
+    def _authenticate(self, request) -> Optional[bool]:
+        headers = {name.decode().lower(): value.decode() for name, value in request.headers}
+        if 'api-key' not in headers:
+            return None
+        if self.api_key is None or headers['api-key'] != self.api_key:
+            return False
+        expires = headers.get('api-expires', '')
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        signature = generate_signature(self.api_secret, 'GET', '/realtime', int(expires), '')
+        return headers.get('api-signature') == signature
+
+    async def _handler(self, request):
+        authenticated = self._authenticate(request)
+        if authenticated is False:
+            await request.reject(401, body=b'{"error":{"message":"Invalid API Key.","name":"HTTPError"}}')
+            return
+        connection = await request.accept()
+        session = _Session(self, connection, authenticated=bool(authenticated))
+        self.sessions.add(session)
+        try:
+            await session.run()
+        finally:
+            self.sessions.discard(session)
+
+class _Session:
+    """A single client connection."""
+    def __init__(self, server: BitMEXServer, connection, *, authenticated: bool):
+        self.server = server
+        self.connection = connection
+        self.authenticated = authenticated
+        self.subscriptions = {}
+        self._nursery = None
+
+    async def send(self, message):
+        await self.connection.send_message(self.server._dumps(message)) # pylint: disable=protected-access
+
+    async def run(self):
+        try:
+            async with trio.open_nursery() as nursery:
+                self._nursery = nursery
+                await self.send({'info': 'Welcome to the BitMEX Realtime API.', 'version': 'local',
+                                 'timestamp': timestamp(), 'docs': 'https://www.bitmex.com/app/wsAPI',
+                                 'limit': {'remaining': 720}})
+                while True:
+                    frame = await self.connection.get_message()
+                    if frame == 'ping':
+                        await self.connection.send_message('pong')
+                        continue
+                    await self._request(self.server._loads(frame)) # pylint: disable=protected-access
+        except ConnectionClosed:
+            pass
+
+    async def _error(self, status, error, request):
+        await self.send({'status': status, 'error': error, 'meta': {}, 'request': request})
+
+    async def _request(self, request):
+        op = request.get('op')
+        args = request.get('args', [])
+        if op == 'subscribe':
+            for topic in args if isinstance(args, list) else [args]:
+                await self._subscribe(topic, request)
+        elif op == 'unsubscribe':
+            for topic in args if isinstance(args, list) else [args]:
+                scope = self.subscriptions.pop(topic, None)
+                if scope is not None:
+                    scope.cancel()
+                await self.send({'success': True, 'unsubscribe': topic, 'request': request})
+        elif op == 'cancelAllAfter':
+            if not self.authenticated:
+                await self._error(401, 'Not authenticated.', request)
+                return
+            now = time.time()
+            await self.send({'now': timestamp(now), 'cancelTime': timestamp(now + args / 1000), 'request': request})
+        else:
+            await self._error(400, f'Unknown or unsupported command: {op}', request)
+
+    async def _subscribe(self, topic, request):
+        table, _, symbol = topic.partition(':')
+        market = self.server.market
+        if table not in SCHEMAS:
+            await self._error(400, f'Unknown table: {table}', request)
+            return
+        if symbol and symbol not in market.symbols:
+            await self._error(400, f'Unknown or expired symbol: {symbol}', request)
+            return
+        if table in PRIVATE_TABLES and not self.authenticated:
+            await self._error(401, 'Access Token expired for subscription.', request)
+            return
+        if topic in self.subscriptions:
+            await self._error(400, f'You are already subscribed to this topic: {topic}', request)
+            return
+        await self.send({'success': True, 'subscribe': topic, 'request': request})
+
+        symbols = [symbol] if symbol else market.symbols
+        keys, attributes, types = SCHEMAS[table]
+        if table == 'orderBookL2':
+            # The client keeps a single symbol per order book image.
+            for book_symbol in symbols:
+                await self.send({'table': table, 'action': 'partial', 'keys': keys, 'types': types,
+                                 'attributes': attributes, 'filter': {'symbol': book_symbol},
+                                 'data': market.partial(table, book_symbol)})
+        else:
+            await self.send({'table': table, 'action': 'partial', 'keys': keys, 'types': types,
+                             'attributes': attributes, 'filter': {'symbol': symbol} if symbol else {},
+                             'data': [row for s in symbols for row in market.partial(table, s)]})
+
+        scope = trio.CancelScope()
+        self.subscriptions[topic] = scope
+        self._nursery.start_soon(self._produce, scope, table, symbols)
+
+    async def _produce(self, scope, table, symbols):
+        rate = self.server.rates.get(table, 0)
+        rows = self.server.rows.get(table, 1)
+        if not rate:
+            return
+        market = self.server.market
+        with scope:
+            deadline = trio.current_time()
+            while True:
+                for symbol in symbols:
+                    if rate != math.inf:
+                        deadline += 1 / rate
+                        await trio.sleep_until(deadline)
+                    await self.send(market.message(table, symbol, rows))
+
+@asynccontextmanager
+async def open_bitmex_server(host: str = '127.0.0.1', port: int = 0, **kwargs):
+    """
+    Run a local BitMEX server for the duration of the context. Keyword arguments are passed to
+    :class:`BitMEXServer`. The server url is available from the ``url`` attribute.
+    """
+    server = BitMEXServer(**kwargs)
+    async with trio.open_nursery() as nursery:
+        await nursery.start(server.serve, host, port)
+        yield server
+        nursery.cancel_scope.cancel()
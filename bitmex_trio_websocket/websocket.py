@@ -1,111 +1,398 @@
 # -*- coding: utf-8 -*-
 
 """BitMEX Websocket Connection."""
-from collections import Counter
+from collections import Counter, defaultdict
+from functools import partial
 import math
 import logging
-from typing import Optional, Sequence
+import os
+from typing import Mapping, Optional, Sequence, Union
 
 from async_generator import asynccontextmanager
 import trio
 from trio_websocket import ConnectionClosed
 from slurry import Pipeline
-from slurry.sections import Merge, Repeat
+from slurry.sections import Map, Merge
 from slurry_websocket import Websocket
 
+from .analytics import ANALYTICS_TABLE, DEFAULT_BANDS, METRIC_FIELDS, exceeds
 from .auth import generate_expires, generate_signature
+from .candles import CandleAggregator, candle_key, candle_table
+from .codec import get_backend
+from .deltas import DELTA_TABLE, BookDeltas
+from .dispatcher import Dispatcher
+from .latency import LatencyTracker, ReceiveStamp
+from .metrics import Metrics
+from .outbound import OutboundScheduler
 from .storage import Storage
 from .parser import Parser
+from .policies import TablePolicy
+from .reconnect import ReconnectingWebsocket, ReconnectStats
+from .recorder import Recorder
+from .shared import BookPublisher, SharedBooks
+from .sharding import ShardRouter
 
 log = logging.getLogger(__name__)
 
 class BitMEXWebsocket:
     def __init__(self):
         self.storage = Storage()
+        self._dispatcher = Dispatcher(key=self.storage.item_key)
+        self._candles = CandleAggregator()
+        self._deltas = BookDeltas(self.storage.order_book)
         self._pipeline = None
+        self._router = ShardRouter(1)
+        # Outbound channel, scheduler and websocket section for each connection
+        self._send_channels = []
+        self._schedulers = []
+        self._websockets = []
         self._send_channel = None
         self._subscriptions = Counter()
         self._websocket = None
         self._connectionclosed = None
+        self.metrics = None
+        self.latency = None
     
-    async def listen(self, table: str, *symbols: Optional[Sequence[str]]):
+    @property
+    def reconnect_stats(self) -> Optional[ReconnectStats]:
+        """
+        Connection and reconnect statistics of the first connection, when reconnecting is enabled.
+        The statistics of every connection are available from :attr:`websockets`.
+        """
+        return getattr(self._websocket, 'stats', None)
+
+    @property
+    def websockets(self):
+        """The websocket section of each connection."""
+        return tuple(self._websockets)
+
+    @property
+    def schedulers(self):
+        """The outbound scheduler of each connection, with its send latency per priority class."""
+        return tuple(self._schedulers)
+
+    def _closed(self):
+        """The close reason of the first closed connection, or ``None`` if all are open."""
+        for websocket in self._websockets:
+            if websocket.closed is not None:
+                return websocket.closed
+        return None
+
+    @property
+    def listeners(self):
+        """The currently attached listeners, with their queue backlog and drop counters."""
+        return self._dispatcher.listeners
+
+    async def listen(self, table: str, *symbols: Optional[Sequence[str]],
+                     max_buffer_size: float = math.inf, overflow: str = 'block', conflate: bool = False):
         """
         Subscribe to a channel and optionally one or more specific symbols.
         
         Returns an async generator that yields messages from the subscribed channel.
+
+        Items are queued for the listener, up to ``max_buffer_size`` items. When the queue is full,
+        the ``overflow`` policy applies. Options: ``'block'`` (default), ``'drop_oldest'``,
+        ``'conflate'``, ``'raise'``. See :class:`~bitmex_trio_websocket.dispatcher.Listener`.
+
+        If ``conflate`` is true, a queued row is replaced when a newer version of the same row
+        arrives, so the listener only yields the latest state of each row. This is useful for tables
+        like instrument and position, where intermediate updates are of no interest. Rows are
+        matched on their storage key, and quote rows are keyed by timestamp and symbol, so set a
+        ``{'quote': {'latest_only': True}}`` policy to conflate quotes per symbol.
         """
-        if self._websocket.closed is not None:
+        if self._closed() is not None:
             raise trio.BrokenResourceError('Connection is closed.')
 
         listeners = [(table,)] if not symbols else [(table, symbol) for symbol in symbols]
 
-        args = []
-        for listener in listeners:
-            if self._subscriptions[listener] == 0:
-                args.append(listener[0] if not symbols else ':'.join(listener))
-            self._subscriptions[listener] += 1
-        await self._send_channel.send({'op': 'subscribe', 'args': args})
+        # Attach before subscribing, so the partial can't slip past the listener.
+        registration = self._dispatcher.attach(table, symbols, max_buffer_size=max_buffer_size, overflow=overflow,
+                                              conflate=conflate)
+        try:
+            await self._subscribe(listeners)
 
-        async with self._pipeline.tap() as aiter:
-            async for item, item_symbol, item_table, _ in aiter:
-                # Lock list of listeners while sending
-                if item_table == table and (not symbols or item_symbol in symbols):
-                    yield item
+            async for item in registration:
+                yield item
+        finally:
+            self._dispatcher.detach(registration)
 
         log.debug('Listener detached from table: %s, symbol: %s', table, symbols)
+        await self._unsubscribe(listeners)
+
+    async def listen_batches(self, table: str, *symbols: Optional[Sequence[str]],
+                             max_buffer_size: float = math.inf, overflow: str = 'block'):
+        """
+        Subscribe to a channel and optionally one or more specific symbols.
+
+        Returns an async generator that yields a :class:`~bitmex_trio_websocket.storage.Batch`
+        ``(rows, symbol, table, action)`` for each websocket message, with all the rows of the
+        message that match the subscription. Listeners to specific symbols get a batch per symbol.
+        This saves the per row scheduling overhead of :meth:`listen`, for consumers that process
+        whole updates.
+
+        ``max_buffer_size`` and ``overflow`` work like for :meth:`listen`, but count batches rather
+        than rows. Batches can't be conflated.
+        """
+        if self._closed() is not None:
+            raise trio.BrokenResourceError('Connection is closed.')
+
+        listeners = [(table,)] if not symbols else [(table, symbol) for symbol in symbols]
+
+        registration = self._dispatcher.attach(table, symbols, max_buffer_size=max_buffer_size, overflow=overflow,
+                                              batches=True)
+        try:
+            await self._subscribe(listeners)
+
+            async for batch in registration:
+                yield batch
+        finally:
+            self._dispatcher.detach(registration)
+
+        log.debug('Batch listener detached from table: %s, symbol: %s', table, symbols)
+        await self._unsubscribe(listeners)
+
+    async def listen_book_deltas(self, symbol: str, *, max_buffer_size: float = math.inf, overflow: str = 'block'):
+        """
+        Subscribe to the order book of a symbol, as normalized price level deltas.
+
+        Returns an async generator that yields :class:`~bitmex_trio_websocket.deltas.BookDelta`
+        items. The first is a snapshot of the whole book, followed by a delta for every message
+        that changes the book, with the ``(side, price, size)`` of each changed price level. A
+        size of 0 means the level was removed. A new snapshot is sent after a partial, for
+        instance after a reconnect.
+
+        Sizes are absolute, so applying a delta twice is harmless. Sequence numbers increase by
+        one for each delta, so a gap means deltas were dropped, for instance by the ``overflow``
+        policy, and the consumer should resynchronize from :meth:`Storage.order_book`. Deltas can't
+        be conflated, since each holds different levels.
+        """
+        if self._closed() is not None:
+            raise trio.BrokenResourceError('Connection is closed.')
+        if overflow == 'conflate':
+            raise ValueError('Book deltas can\'t be conflated. Use \'drop_oldest\' and resynchronize on gaps.')
+
+        listeners = [('orderBookL2', symbol)]
+        self._deltas.register(symbol)
+        self.storage.add_hook('orderBookL2', self._deltas.derive)
+        registration = self._dispatcher.attach(DELTA_TABLE, [symbol], max_buffer_size=max_buffer_size,
+                                              overflow=overflow)
+        # If the book is already subscribed, start from its current state. The snapshot is taken
+        # right after attaching, so every delta the listener receives is newer.
+        initial = self._deltas.snapshot(symbol) if self.storage.order_book(symbol) else None
+        try:
+            await self._subscribe(listeners)
+
+            if initial is not None:
+                yield initial
+            async for delta in registration:
+                yield delta
+        finally:
+            self._dispatcher.detach(registration)
+            self._deltas.unregister(symbol)
+            if not self._deltas.active:
+                self.storage.remove_hook('orderBookL2', self._deltas.derive)
 
-        if self._websocket.closed:
+        log.debug('Book delta listener detached from symbol: %s', symbol)
+        await self._unsubscribe(listeners)
+
+    async def listen_book_analytics(self, symbol: str, *, threshold: Union[float, Mapping[str, float]] = 0,
+                                    levels: int = 10, bands: Sequence[float] = DEFAULT_BANDS,
+                                    max_buffer_size: float = math.inf, overflow: str = 'block'):
+        """
+        Subscribe to the order book of a symbol, as derived metrics.
+
+        Returns an async generator that yields :class:`~bitmex_trio_websocket.analytics.BookMetrics`
+        with the mid price, microprice, imbalance of the top ``levels`` levels, and the depth and
+        size weighted price within each of the ``bands``, in basis points from the mid price. The
+        metrics are maintained incrementally by storage, once per connection, no matter how many
+        listeners there are for the same symbol.
+
+        Metrics are only yielded when one of them moved by more than ``threshold`` since the last
+        metrics yielded. Pass a mapping, like ``{'microprice': 0.5, 'imbalance': 0.1}``, to only
+        compare the given metrics, with a threshold each.
+        """
+        if self._closed() is not None:
+            raise trio.BrokenResourceError('Connection is closed.')
+        if isinstance(threshold, Mapping) and not set(threshold) <= set(METRIC_FIELDS):
+            raise ValueError(f'threshold metrics must be some of: {", ".join(METRIC_FIELDS)}')
+
+        listeners = [('orderBookL2', symbol)]
+        analytics = self.storage.track_analytics(symbol, levels, bands)
+        registration = self._dispatcher.attach(ANALYTICS_TABLE, [symbol], max_buffer_size=max_buffer_size,
+                                              overflow=overflow)
+        # If the book is already subscribed, start from its current metrics.
+        last = analytics.metrics
+        try:
+            await self._subscribe(listeners)
+
+            if last is not None:
+                yield last
+            async for metrics in registration:
+                if exceeds(last, metrics, threshold):
+                    last = metrics
+                    yield metrics
+        finally:
+            self._dispatcher.detach(registration)
+            self.storage.untrack_analytics(symbol)
+
+        log.debug('Book analytics listener detached from symbol: %s', symbol)
+        await self._unsubscribe(listeners)
+
+    async def listen_candles(self, symbol: str, interval: float, *, closed_only: bool = False,
+                             max_buffer_size: float = math.inf, overflow: str = 'block', conflate: bool = False):
+        """
+        Aggregate trades of a symbol into OHLCV candles of an arbitrary interval.
+
+        Returns an async generator that yields a :class:`~bitmex_trio_websocket.candles.Candle`
+        every time the current candle is updated by a trade, and once more when it is closed. Use
+        ``closed_only`` to only receive closed candles. Candles are aggregated once per connection,
+        no matter how many listeners there are for the same symbol and interval.
+
+        :param float interval: Candle interval in seconds.
+        """
+        if self._closed() is not None:
+            raise trio.BrokenResourceError('Connection is closed.')
+
+        listeners = [('trade', symbol)]
+        self._candles.register(symbol, interval)
+        self.storage.add_hook('trade', self._candles.derive)
+        self._candles.start(self._pipeline.nursery, self._dispatcher.publish)
+        registration = self._dispatcher.attach(candle_table(interval), [symbol], max_buffer_size=max_buffer_size,
+                                              overflow=overflow, conflate=conflate, key=candle_key)
+        try:
+            await self._subscribe(listeners)
+
+            async for candle in registration:
+                if candle.closed or not closed_only:
+                    yield candle
+        finally:
+            self._dispatcher.detach(registration)
+            self._candles.unregister(symbol, interval)
+            if not self._candles.active:
+                self.storage.remove_hook('trade', self._candles.derive)
+
+        log.debug('Candle listener detached from symbol: %s, interval: %s', symbol, interval)
+        await self._unsubscribe(listeners)
+
+    async def _subscribe(self, listeners):
+        """
+        Subscribe to (table,) or (table, symbol) channels, that are not already subscribed. Each
+        channel is subscribed on the connection it is assigned to.
+        """
+        args = defaultdict(list)
+        for listener in listeners:
+            if self._subscriptions[listener] == 0:
+                args[self._router.assign(*listener)].append(':'.join(listener))
+            self._subscriptions[listener] += 1
+        for index, topics in args.items():
+            await self._send_channels[index].send({'op': 'subscribe', 'args': topics})
+
+    async def _unsubscribe(self, listeners):
+        """Unsubscribe from channels that have no more listeners."""
+        if self._closed():
             return
 
-        args = []
+        args = defaultdict(list)
         for listener in listeners:
             self._subscriptions[listener] -= 1
             if self._subscriptions[listener] == 0:
-                log.debug('No more listeners on table: %s, symbol: %s. Unsubscribing.', table, symbols)
-                args.append(listener[0] if not symbols else ':'.join(listener))
-        if args:
-            await self._send_channel.send({'op': 'unsubscribe', 'args': args})
+                log.debug('No more listeners on %s. Unsubscribing.', ':'.join(listener))
+                args[self._router.release(*listener)].append(':'.join(listener))
+        for index, topics in args.items():
+            await self._send_channels[index].send({'op': 'unsubscribe', 'args': topics})
+
+    def _topics(self, index: int = 0):
+        """Topics with at least one listener, that are assigned to a connection."""
+        return [':'.join(listener) for listener, count in self._subscriptions.items()
+                if count > 0 and self._router.shard(*listener) == index]
 
     @asynccontextmanager
-    async def _connect(self, network, api_key, api_secret, dead_mans_switch):
+    async def _connect(self, network, api_key, api_secret, dead_mans_switch, json_backend=None, record=None,
+                       url=None, metrics=None, compact=False, history=None, reconnect=False, connections=1,
+                       publish=None, indexes=None, rate_limit=None, rate_burst=10, latency=False,
+                       policies=None):
         """Open a BitMEX websocket connection."""
         try:
-            if network == 'mainnet':
-                url = 'wss://ws.bitmex.com/realtime'
-            else:
-                url = 'wss://ws.testnet.bitmex.com/realtime'
-
-            log.debug('Generating authentication headers.')
-            # To auth to the WS using an API key, we generate a signature of a nonce and
-            # the WS API endpoint.
-            headers = None
-            if api_key and api_secret:
-                nonce = generate_expires()
-                headers = [
-                    ('api-expires', str(nonce)),
-                    ('api-signature', generate_signature(api_secret, 'GET', '/realtime', nonce, '')),
-                    ('api-key', api_key)
-                ]
-
-            send_channel, receive_channel = trio.open_memory_channel(math.inf)
-            self._send_channel = send_channel
-
-            if dead_mans_switch:
-                sections = [Merge(receive_channel, Repeat(15, default={'op': 'cancelAllAfter', 'args': 60000}))]
-            else:
-                sections = [receive_channel]
-
-            self._websocket = Websocket(url, extra_headers=headers)
-            parser = Parser()
-            sections.append(self._websocket)
+            if url is None:
+                if network == 'mainnet':
+                    url = 'wss://ws.bitmex.com/realtime'
+                else:
+                    url = 'wss://ws.testnet.bitmex.com/realtime'
+
+            self._router = connections if isinstance(connections, ShardRouter) else ShardRouter(connections)
+
+            # Frames are encoded and decoded here rather than in the websocket section, so the
+            # parser can route raw frames before decoding them.
+            dumps = get_backend(json_backend).dumps
+            shards = []
+            # Frames are stamped with the receive time as they leave the websocket, when latency
+            # is tracked, frames are recorded or the receive stage is measured.
+            stamp = bool(latency) or record is not None or bool(metrics)
+            for index in range(self._router.connections):
+                send_channel, receive_channel = trio.open_memory_channel(math.inf)
+                self._send_channels.append(send_channel)
+
+                # The dead mans switch is refreshed on the first connection, with the private tables.
+                heartbeat = {'op': 'cancelAllAfter', 'args': 60000} if dead_mans_switch and index == 0 else None
+                scheduler = OutboundScheduler(rate=rate_limit, burst=rate_burst, heartbeat=heartbeat)
+                self._schedulers.append(scheduler)
+                shard = [receive_channel, scheduler]
+
+                if reconnect:
+                    # The reconnecting websocket encodes operations itself, since it needs to track
+                    # subscriptions. Headers are generated for each attempt, to renew the signature.
+                    websocket = ReconnectingWebsocket(url, dumps=dumps, topics=partial(self._topics, index),
+                                                      headers=lambda: _auth_headers(api_key, api_secret))
+                else:
+                    shard.append(Map(dumps))
+                    websocket = Websocket(url, extra_headers=_auth_headers(api_key, api_secret), parse_json=False)
+                shard.append(websocket)
+                if stamp:
+                    shard.append(ReceiveStamp(index))
+                self._websockets.append(websocket)
+                shards.append(shard)
+            self._send_channel = self._send_channels[0]
+            self._websocket = self._websockets[0]
+
+            # Raw frames from all connections are merged, before they are recorded and parsed.
+            sections = shards[0] if len(shards) == 1 else [Merge(*(tuple(shard) for shard in shards))]
+            if metrics:
+                self.metrics = metrics if isinstance(metrics, Metrics) else Metrics()
+                self.storage.metrics = self.metrics
+                self._dispatcher.metrics = self.metrics
+            self.storage.compact = compact
+            for table, capacity in (history or {}).items():
+                self.storage.keep_history(table, capacity)
+            for table, policy in (policies or {}).items():
+                self.storage.set_policy(table, policy)
+            for table, columns in (indexes or {}).items():
+                for index in columns:
+                    self.storage.add_index(table, *((index,) if isinstance(index, str) else index))
+            if latency:
+                self.latency = latency if isinstance(latency, LatencyTracker) else LatencyTracker()
+            # Frames are applied to storage while their table has a live subscription, even
+            # without listeners, since storage can be read directly.
+            parser = Parser(json_backend=json_backend, metrics=self.metrics, latency=self.latency)
+            parser.wants = parser.subscribed
+            if self.metrics is not None:
+                self.metrics.attach(self._send_channels, self._dispatcher, parser, self.reconnect_stats,
+                                    self._schedulers, self.latency)
+            if record is not None:
+                sections.append(record if isinstance(record, Recorder) else Recorder(record))
             sections.append(parser)
             sections.append(self.storage)
+            if publish is not None:
+                sections.append(BookPublisher(publish, self.storage.order_book))
+            sections.append(self._dispatcher)
 
             async with Pipeline.create(*sections) as pipeline:
                 self._pipeline = pipeline
                 # Force the websocket to connect
                 pipeline._enabled.set()
-                await parser._connected.wait()
+                pipeline.nursery.start_soon(self.storage.evict_periodically)
+                if self.metrics is not None and self.metrics.callback is not None:
+                    pipeline.nursery.start_soon(self.metrics.export)
+                await parser.connected(len(self._websockets))
                 log.info('BitMEXWebsocket open.')
                 yield self
                 log.debug('BitMEXWebsocket context exit. Cancelling running tasks.')
@@ -119,13 +406,41 @@ class BitMEXWebsocket:
 
         log.info('BitMEXWebsocket closed.')  
 
+def _auth_headers(api_key, api_secret):
+    """Authentication headers for the websocket handshake, or ``None`` if there is no api key."""
+    if not (api_key and api_secret):
+        return None
+    log.debug('Generating authentication headers.')
+    # To auth to the WS using an API key, we generate a signature of a nonce and
+    # the WS API endpoint.
+    nonce = generate_expires()
+    return [
+        ('api-expires', str(nonce)),
+        ('api-signature', generate_signature(api_secret, 'GET', '/realtime', nonce, '')),
+        ('api-key', api_key)
+    ]
+
 @asynccontextmanager
-async def open_bitmex_websocket(network: str, api_key: str=None, api_secret: str=None, *, dead_mans_switch=False):
+async def open_bitmex_websocket(network: str, api_key: str=None, api_secret: str=None, *,
+                                dead_mans_switch=False, json_backend: str=None,
+                                record: Union[str, os.PathLike, Recorder]=None, url: str=None,
+                                metrics: Union[bool, Metrics]=False, compact: bool=False,
+                                history: Mapping[str, int]=None, reconnect: bool=False,
+                                connections: Union[int, ShardRouter]=1, publish: SharedBooks=None,
+                                indexes: Mapping[str, Sequence[Union[str, Sequence[str]]]]=None,
+                                rate_limit: float=None, rate_burst: int=10,
+                                latency: Union[bool, LatencyTracker]=False,
+                                policies: Mapping[str, Union[TablePolicy, Mapping]]=None):
     """Open a new BitMEX websocket connection context."""
     if network not in ('mainnet', 'testnet'):
         raise ValueError('network argument must be either \'mainnet\' or \'testnet\'')
     
     bitmex_websocket = BitMEXWebsocket()
     #pylint: disable=not-async-context-manager
-    async with bitmex_websocket._connect(network, api_key, api_secret, dead_mans_switch): 
+    async with bitmex_websocket._connect(network, api_key, api_secret, dead_mans_switch, json_backend=json_backend,
+                                         record=record, url=url, metrics=metrics,
+                                         compact=compact, history=history, reconnect=reconnect,
+                                         connections=connections, publish=publish, indexes=indexes,
+                                         rate_limit=rate_limit, rate_burst=rate_burst, latency=latency,
+                                         policies=policies):
         yield bitmex_websocket
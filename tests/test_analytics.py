@@ -0,0 +1,79 @@
+"""Tests for order book analytics."""
+import pytest
+import trio
+
+from bitmex_trio_websocket.analytics import ANALYTICS_TABLE, BookMetrics, exceeds
+from bitmex_trio_websocket.storage import Storage
+from bitmex_trio_websocket.testing import Market
+
+BANDS = (1, 5, 10)
+
+async def _run(storage, messages):
+    send_channel, receive_channel = trio.open_memory_channel(len(messages))
+    for message in messages:
+        send_channel.send_nowait(message)
+    await send_channel.aclose()
+    output = []
+
+    async def collect(batch):
+        output.append(batch)
+
+    await storage.pump(receive_channel, collect)
+    return [batch.rows[0] for batch in output if batch.table == ANALYTICS_TABLE]
+
+def _expected(book, levels):
+    """Metrics of a book, computed from scratch."""
+    (bid, bid_size), (ask, ask_size) = book.best_bid, book.best_ask
+    mid = (bid + ask) / 2
+    top_bids = sum(size for _, size in book.depth('Buy', levels))
+    top_asks = sum(size for _, size in book.depth('Sell', levels))
+    bid_depth, ask_depth, bid_price, ask_price = [], [], [], []
+    for band in BANDS:
+        bids = [(price, size) for price, size in book.depth('Buy') if price >= mid * (1 - band / 10000)]
+        asks = [(price, size) for price, size in book.depth('Sell') if price <= mid * (1 + band / 10000)]
+        for levels_in_band, depth, prices in ((bids, bid_depth, bid_price), (asks, ask_depth, ask_price)):
+            total = sum(size for _, size in levels_in_band)
+            depth.append(total)
+            prices.append(sum(price * size for price, size in levels_in_band) / total if total else None)
+    return (mid, (bid * ask_size + ask * bid_size) / (bid_size + ask_size),
+            (top_bids - top_asks) / (top_bids + top_asks), bid_depth, ask_depth, bid_price, ask_price)
+
+async def test_incremental_metrics():
+    market = Market(['XBTUSD'], depth=100, seed=1)
+    storage = Storage()
+    storage.track_analytics('XBTUSD', levels=5, bands=BANDS)
+    messages = [{'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+                 'data': market.partial('orderBookL2', 'XBTUSD')}]
+    messages.extend(market.message('orderBookL2', 'XBTUSD', 5) for _ in range(300))
+    updates = await _run(storage, messages)
+    # Messages that only change levels outside the bands and the top levels don't change the metrics.
+    assert 100 < len(updates) < len(messages)
+
+    book = storage.order_book('XBTUSD')
+    metrics = book.analytics.metrics
+    assert metrics.sequence == storage.sequence
+    mid, microprice, imbalance, bid_depth, ask_depth, bid_price, ask_price = _expected(book, 5)
+    # The top of the book moved, and with it the band edges.
+    assert mid != updates[0].mid
+    assert metrics.mid == mid
+    assert metrics.microprice == pytest.approx(microprice)
+    assert metrics.imbalance == pytest.approx(imbalance)
+    assert metrics.bid_depth == pytest.approx(bid_depth)
+    assert metrics.ask_depth == pytest.approx(ask_depth)
+    assert metrics.bid_price == pytest.approx(bid_price)
+    assert metrics.ask_price == pytest.approx(ask_price)
+
+    with pytest.raises(ValueError):
+        storage.track_analytics('XBTUSD', levels=10)
+    storage.untrack_analytics('XBTUSD')
+    assert book.analytics is None
+
+def test_exceeds():
+    previous = BookMetrics('XBTUSD', 1, 100.0, 100.2, 0.1, (10.0,), (20.0,), (99.9,), (100.1,))
+    current = previous._replace(sequence=2, microprice=100.3, ask_depth=(25.0,))
+    assert exceeds(None, current)
+    assert exceeds(previous, current)
+    assert not exceeds(previous, current, 5)
+    assert exceeds(previous, current, 1)
+    assert not exceeds(previous, current, {'microprice': 0.5, 'imbalance': 0.05})
+    assert exceeds(previous, current._replace(imbalance=None), {'imbalance': 0.05})
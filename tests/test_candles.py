@@ -0,0 +1,77 @@
+"""Tests for candle aggregation."""
+import trio
+
+from bitmex_trio_websocket.candles import CandleAggregator, candle_key, candle_table
+from bitmex_trio_websocket.dispatcher import Dispatcher
+from bitmex_trio_websocket.storage import Batch, Storage
+
+def _trade(second, price, size):
+    return Batch([{'timestamp': f'2021-01-01T00:00:{second:06.3f}Z', 'symbol': 'XBTUSD', 'price': price,
+                   'size': size}], None, 'trade', 'insert')
+
+async def _pump(section, items):
+    send_channel, receive_channel = trio.open_memory_channel(len(items))
+    for item in items:
+        send_channel.send_nowait(item)
+    await send_channel.aclose()
+    output = []
+
+    async def collect(item):
+        output.append(item)
+
+    await section.pump(receive_channel, collect)
+    return output
+
+def test_aggregate_trades():
+    aggregator = CandleAggregator()
+    aggregator.register('XBTUSD', 5)
+    aggregator.register('XBTUSD', 60)
+    items = [_trade(1, 100.0, 10), _trade(2.5, 102.0, 30), _trade(4.999, 99.0, 10), _trade(5, 101.0, 50),
+             _trade(3, 90.0, 1)]
+    output = [batch for item in items for batch in aggregator.derive(item)]
+
+    closed = [batch for batch in output if batch.action == 'close']
+    assert len(closed) == 1
+    (candle,), _, table, _ = closed[0]
+    assert table == candle_table(5) == 'candle:5s'
+    assert (candle.open, candle.high, candle.low, candle.close) == (100.0, 102.0, 99.0, 99.0)
+    assert candle.volume == 50 and candle.trades == 3
+    assert candle.vwap == (100.0 * 10 + 102.0 * 30 + 99.0 * 10) / 50
+    assert candle.end - candle.start == 5_000_000_000
+
+    minute = aggregator.candle('XBTUSD', 60)
+    assert minute.trades == 5 and minute.low == 90.0 and not minute.closed
+    # The late trade at 3s was after the 5s candle was closed.
+    assert aggregator.late == 1
+
+async def test_conflate_candles():
+    aggregator = CandleAggregator()
+    aggregator.register('XBTUSD', 5)
+    output = [batch for item in [_trade(1, 100.0, 10), _trade(2, 101.0, 10), _trade(6, 102.0, 10),
+                                 _trade(7, 103.0, 10)] for batch in aggregator.derive(item)]
+    dispatcher = Dispatcher(key=Storage().item_key)
+    listener = dispatcher.attach(candle_table(5), ['XBTUSD'], conflate=True, key=candle_key)
+    await _pump(dispatcher, output)
+    dispatcher.close()
+    # Updates of a candle are conflated, but the closed candle isn't replaced by the next one.
+    candles = [candle async for candle in listener]
+    assert [(candle.close, candle.closed) for candle in candles] == [(101.0, True), (103.0, False)]
+
+async def test_close_expired(autojump_clock):
+    aggregator = CandleAggregator(grace=0)
+    aggregator.register('XBTUSD', 5)
+    aggregator.derive(_trade(1, 100.0, 10))
+    closed = []
+
+    async def collect(batch):
+        closed.append(batch)
+
+    async with trio.open_nursery() as nursery:
+        aggregator.start(nursery, collect)
+        aggregator.start(nursery, collect)
+        # The candle of 2021 ended long ago, by the local clock.
+        await trio.sleep(1)
+        assert [batch.action for batch in closed] == ['close']
+        # The timer stops once no intervals are registered.
+        aggregator.unregister('XBTUSD', 5)
+    assert not aggregator.active
@@ -0,0 +1,55 @@
+"""Tests for order book deltas."""
+from bitmex_trio_websocket.deltas import DELTA_TABLE, BookDeltas
+from bitmex_trio_websocket.storage import Storage
+from bitmex_trio_websocket.testing import Market
+
+def _level(level_id, side, price, size):
+    return {'symbol': 'XBTUSD', 'id': level_id, 'side': side, 'price': price, 'size': size}
+
+def _run(storage, deltas, messages):
+    storage.add_hook('orderBookL2', deltas.derive)
+    return [batch.rows[0] for batch in storage.apply_many(messages) if batch.table == DELTA_TABLE]
+
+def test_book_deltas():
+    storage = Storage()
+    deltas = BookDeltas(storage.order_book)
+    deltas.register('XBTUSD')
+    items = _run(storage, deltas, [
+        {'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+         'data': [_level(1, 'Buy', 99.0, 10), _level(2, 'Sell', 101.0, 20)]},
+        {'table': 'orderBookL2', 'action': 'update', 'data': [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'size': 5}]},
+        {'table': 'orderBookL2', 'action': 'insert', 'data': [_level(3, 'Buy', 98.0, 7)]},
+        # Deletes don't carry a price.
+        {'table': 'orderBookL2', 'action': 'delete', 'data': [{'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell'}]},
+    ])
+    assert [(delta.sequence, delta.snapshot) for delta in items] == [(1, True), (2, False), (3, False), (4, False)]
+    assert items[0].levels == [('Buy', 99.0, 10), ('Sell', 101.0, 20)]
+    assert items[1].levels == [('Buy', 99.0, 5)]
+    assert items[2].levels == [('Buy', 98.0, 7)]
+    assert items[3].levels == [('Sell', 101.0, 0)]
+    assert deltas.snapshot('XBTUSD') == (
+        'XBTUSD', 4, True, [('Buy', 99.0, 5), ('Buy', 98.0, 7)])
+
+    deltas.unregister('XBTUSD')
+    assert storage.order_book('XBTUSD').deltas is None
+
+def test_deltas_reproduce_book():
+    market = Market(['XBTUSD'])
+    storage = Storage()
+    deltas = BookDeltas(storage.order_book)
+    deltas.register('XBTUSD')
+    messages = [{'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+                 'data': market.partial('orderBookL2', 'XBTUSD')}]
+    messages.extend(market.message('orderBookL2', 'XBTUSD', 5) for _ in range(200))
+    book = {}
+    for delta in _run(storage, deltas, messages):
+        if delta.snapshot:
+            book.clear()
+        for side, price, size in delta.levels:
+            if size:
+                book[side, price] = size
+            else:
+                book.pop((side, price), None)
+    expected = storage.order_book('XBTUSD')
+    assert book == {**{('Buy', price): size for price, size in expected.depth('Buy')},
+                    **{('Sell', price): size for price, size in expected.depth('Sell')}}
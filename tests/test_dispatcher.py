@@ -0,0 +1,124 @@
+"""Tests for the listener dispatcher."""
+import pytest
+import trio
+
+from bitmex_trio_websocket.dispatcher import Dispatcher, Listener
+from bitmex_trio_websocket.exceptions import BitMEXWebsocketOverflowError
+from bitmex_trio_websocket.storage import Batch
+
+async def _run(dispatcher, items):
+    send_channel, receive_channel = trio.open_memory_channel(len(items))
+    for item in items:
+        send_channel.send_nowait(item)
+    await send_channel.aclose()
+    await dispatcher.pump(receive_channel, None)
+
+async def test_routing_by_table_and_symbol():
+    dispatcher = Dispatcher()
+    everything = dispatcher.attach('trade')
+    xbt = dispatcher.attach('trade', ['XBTUSD'])
+    multi = dispatcher.attach('trade', ['XBTUSD', 'ETHUSD'])
+    quotes = dispatcher.attach('quote', ['XBTUSD'])
+
+    await _run(dispatcher, [
+        Batch([{'n': 1}], 'XBTUSD', 'trade', 'insert'),
+        Batch([{'n': 2}], 'ETHUSD', 'trade', 'insert'),
+        Batch([{'n': 3}], 'XBTUSD', 'quote', 'insert'),
+        Batch([{'n': 4}], None, 'trade', 'insert'),
+    ])
+
+    async def drain(listener):
+        return [item['n'] async for item in listener]
+
+    assert await drain(everything) == [1, 2, 4]
+    assert await drain(xbt) == [1]
+    assert await drain(multi) == [1, 2]
+    assert await drain(quotes) == [3]
+
+async def test_detach():
+    dispatcher = Dispatcher()
+    first = dispatcher.attach('trade', ['XBTUSD'])
+    second = dispatcher.attach('trade', ['XBTUSD'])
+    dispatcher.detach(first)
+    assert dispatcher._routes[('trade', 'XBTUSD')] == (second,)
+    await _run(dispatcher, [Batch([{'n': 1}], 'XBTUSD', 'trade', 'insert')])
+    assert [item async for item in second] == [{'n': 1}]
+
+async def test_batches():
+    dispatcher = Dispatcher()
+    rows = dispatcher.attach('trade', ['XBTUSD'])
+    everything = dispatcher.attach('trade', batches=True)
+    xbt = dispatcher.attach('trade', ['XBTUSD'], batches=True)
+    batch = Batch([{'symbol': 'XBTUSD', 'n': 1}, {'symbol': 'ETHUSD', 'n': 2}, {'symbol': 'XBTUSD', 'n': 3}],
+                  None, 'trade', 'insert')
+    await _run(dispatcher, [batch])
+    assert [item['n'] async for item in rows] == [1, 3]
+    assert [item async for item in everything] == [batch]
+    # Rows of a batch without a symbol are grouped by symbol, for listeners of specific symbols.
+    (part,) = [item async for item in xbt]
+    assert part.symbol == 'XBTUSD' and [row['n'] for row in part.rows] == [1, 3]
+
+def test_conflate_batches():
+    with pytest.raises(ValueError):
+        Listener('quote', (), conflate=True, key=_key, batches=True)
+
+def _key(table, item):
+    return (item['symbol'],)
+
+async def test_drop_oldest():
+    listener = Listener('quote', (), max_buffer_size=2, overflow='drop_oldest')
+    for n in range(4):
+        listener.put_nowait(n)
+    listener.close()
+    assert [item async for item in listener] == [2, 3]
+    assert listener.dropped == 2
+
+async def test_conflate():
+    listener = Listener('quote', (), max_buffer_size=2, overflow='conflate', key=_key)
+    for symbol, n in [('XBTUSD', 1), ('ETHUSD', 2), ('XBTUSD', 3), ('XRPUSD', 4)]:
+        listener.put_nowait({'symbol': symbol, 'n': n})
+    listener.close()
+    # XBTUSD 3 replaces XBTUSD 1 in place. XRPUSD 4 has no pending key, so the oldest item is dropped.
+    assert [item['n'] async for item in listener] == [2, 4]
+    assert listener.conflated == 1
+    assert listener.dropped == 1
+
+async def test_conflate_latest_value():
+    listener = Listener('instrument', (), conflate=True, key=_key)
+    for symbol, n in [('XBTUSD', 1), ('ETHUSD', 2), ('XBTUSD', 3), ('XBTUSD', 4)]:
+        listener.put_nowait({'symbol': symbol, 'n': n})
+    assert listener.backlog == 2
+    assert (await listener.__anext__())['n'] == 4
+    # Once consumed, the next version of the row is queued again.
+    listener.put_nowait({'symbol': 'XBTUSD', 'n': 5})
+    listener.close()
+    assert [item['n'] async for item in listener] == [2, 5]
+    assert listener.conflated == 2
+    assert listener.dropped == 0
+
+async def test_raise():
+    listener = Listener('quote', (), max_buffer_size=1, overflow='raise')
+    listener.put_nowait(1)
+    listener.put_nowait(2)
+    with pytest.raises(BitMEXWebsocketOverflowError):
+        await listener.__anext__()
+
+async def test_block():
+    listener = Listener('quote', (), max_buffer_size=1, overflow='block')
+    received = []
+    async with trio.open_nursery() as nursery:
+        async def producer():
+            for n in range(3):
+                await listener.put(n)
+            listener.close()
+        nursery.start_soon(producer)
+        await trio.sleep(0.01)
+        assert listener.backlog == 1
+        async for item in listener:
+            received.append(item)
+    assert received == [0, 1, 2]
+    assert listener.dropped == 0
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        Listener('quote', (), overflow='ignore')
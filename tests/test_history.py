@@ -0,0 +1,56 @@
+"""Tests for the ring buffer history."""
+from datetime import datetime, timezone
+
+import pytest
+import trio
+
+from bitmex_trio_websocket.history import RingBuffer, parse_timestamp
+from bitmex_trio_websocket.storage import Storage
+
+def test_parse_timestamp():
+    for value in ('2021-03-04T05:06:07.890Z', '2020-02-29T23:59:59.000Z', '2021-01-01T00:00:00.123456Z'):
+        expected = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+        assert parse_timestamp(value) == int(expected.timestamp()) * 1_000_000_000 + expected.microsecond * 1000
+
+def test_ring_buffer_wraps():
+    buffer = RingBuffer(4, {'price': 'd'})
+    assert buffer.column('price').tolist() == []
+    for n in range(3):
+        buffer.append({'price': n})
+    assert buffer.column('price').tolist() == [0, 1, 2]
+    for n in range(3, 10):
+        buffer.append({'price': n})
+    assert len(buffer) == 4
+    assert buffer.column('price').tolist() == [6, 7, 8, 9]
+    assert buffer.column('price', 2).tolist() == [8, 9]
+
+def test_numpy_views():
+    pytest.importorskip('numpy')
+    buffer = RingBuffer(3, {'price': 'd', 'side': 'b'})
+    for n in range(5):
+        buffer.append({'price': n, 'side': 1})
+    last = buffer.last(2)
+    assert last['price'].tolist() == [3, 4]
+    assert last['side'].dtype.itemsize == 1
+    # The arrays are views of the buffer, not copies.
+    assert last['price'].base is not None
+
+async def test_storage_history():
+    storage = Storage(history={'trade': 2})
+    send_channel, receive_channel = trio.open_memory_channel(10)
+    def trade(second, price, side='Buy'):
+        return {'timestamp': f'2021-01-01T00:00:0{second}.000Z', 'symbol': 'XBTUSD', 'side': side,
+                'size': 1, 'price': price}
+    send_channel.send_nowait({'table': 'trade', 'action': 'partial', 'keys': [],
+                              'attributes': {'timestamp': 'sorted', 'symbol': 'grouped'}, 'data': [trade(1, 100.0)]})
+    send_channel.send_nowait({'table': 'trade', 'action': 'insert', 'data': [trade(2, 101.0, 'Sell'), trade(3, 102.0)]})
+    await send_channel.aclose()
+
+    async def output(item):
+        pass
+
+    await storage.pump(receive_channel, output)
+    buffer = storage.ring_buffer('trade', 'XBTUSD')
+    assert buffer.column('price').tolist() == [101.0, 102.0]
+    assert buffer.column('side').tolist() == [-1, 1]
+    assert buffer.column('timestamp').tolist() == [1609459202_000_000_000, 1609459203_000_000_000]
@@ -0,0 +1,59 @@
+"""Tests for latency tracking."""
+from time import gmtime, strftime
+
+from async_generator import aclosing
+import pytest
+
+from bitmex_trio_websocket import open_bitmex_websocket
+from bitmex_trio_websocket.latency import LatencyTracker, epoch_ns
+from bitmex_trio_websocket.testing import open_bitmex_server
+
+def _message(epoch, action='insert'):
+    seconds, nanoseconds = divmod(epoch, 1_000_000_000)
+    milliseconds = nanoseconds // 1_000_000
+    timestamp = strftime('%Y-%m-%dT%H:%M:%S', gmtime(seconds)) + f'.{milliseconds:03d}Z'
+    return {'table': 'trade', 'action': action, 'data': [{'symbol': 'XBTUSD', 'timestamp': timestamp}]}
+
+def test_latency_and_offset():
+    tracker = LatencyTracker(window=10)
+    # BitMEX timestamps have millisecond resolution.
+    received = 5_000_000_000 - epoch_ns(5_000_000_000) % 1_000_000
+    now = epoch_ns(received)
+
+    tracker.observe('trade', _message(now - 2_000_000), received, connection=1)
+    tracker.observe('trade', _message(now - 5_000_000), received)
+    # Partials hold old rows.
+    tracker.observe('trade', _message(now - 10 ** 9, 'partial'), received)
+    assert tracker.tables['trade'].count == 2
+    assert tracker.tables['trade'].max == 5_000_000
+    assert tracker.connections[1].count == 1
+    assert tracker.offset == pytest.approx(0.002)
+
+    # A local clock that is behind the exchange clock shows up as a negative offset, and the
+    # latencies are shifted up by it.
+    tracker.observe('trade', _message(now + 3_000_000), received)
+    assert tracker.offset == pytest.approx(-0.003)
+    assert tracker.tables['trade'].max == 5_000_000
+
+    # The offset follows the clock, once the window has passed.
+    later = received + 25 * 10 ** 9
+    tracker.observe('trade', _message(now + 25 * 10 ** 9 - 1_000_000), later)
+    assert tracker.offset == pytest.approx(-0.003)
+    tracker.observe('trade', _message(now + 36 * 10 ** 9 - 1_000_000), later + 11 * 10 ** 9)
+    assert tracker.offset == pytest.approx(0.001)
+    assert tracker.staleness('quote') is None
+
+async def test_listen_latency():
+    async with open_bitmex_server(rates={'trade': 1000}) as server, \
+            open_bitmex_websocket('testnet', url=server.url, latency=True) as bws:
+        count = 0
+        async with aclosing(bws.listen('trade', 'XBTUSD')) as agen:
+            async for _ in agen:
+                count += 1
+                if count == 20:
+                    break
+        snapshot = bws.latency.snapshot()
+    assert snapshot['tables']['trade']['count'] >= 19
+    assert snapshot['offset'] is not None
+    assert 0 <= bws.latency.staleness('trade') < 1
+    assert bws.latency.staleness(connection=0) == pytest.approx(bws.latency.staleness(), abs=0.1)
@@ -0,0 +1,48 @@
+"""Tests for pipeline instrumentation."""
+from async_generator import aclosing
+import pytest
+import trio
+
+from bitmex_trio_websocket import open_bitmex_websocket
+from bitmex_trio_websocket.metrics import Histogram, Metrics
+from bitmex_trio_websocket.testing import open_bitmex_server
+
+def test_histogram():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value)
+    assert histogram.count == 1000
+    assert histogram.max == 1000
+    assert histogram.percentile(0.5) == pytest.approx(500, rel=0.25)
+    assert histogram.percentile(0.99) == pytest.approx(990, rel=0.25)
+    assert histogram.snapshot(scale=1)['mean'] == 500.5
+
+async def test_snapshot():
+    snapshots = []
+    metrics = Metrics(callback=snapshots.append, interval=0.01)
+    async with open_bitmex_server(rates={'trade': 1000}) as server, \
+            open_bitmex_websocket('testnet', url=server.url, metrics=metrics) as bws:
+        count = 0
+        async with aclosing(bws.listen('trade', 'XBTUSD')) as agen:
+            async for _ in agen:
+                count += 1
+                if count == 20:
+                    snapshot = bws.metrics.snapshot()
+                    break
+    assert snapshot['messages']['trade']['partial'] == 1
+    assert snapshot['rows']['trade']['insert'] >= 19
+    assert snapshot['stages']['storage']['count'] >= 20
+    assert snapshot['stages']['receive']['count'] >= 20
+    assert snapshot['listeners'][0]['table'] == 'trade'
+    assert snapshot['send_latency']['subscription']['count'] == 1
+    assert snapshots
+
+def test_send_queue():
+    metrics = Metrics()
+    channels = [trio.open_memory_channel(10)[0] for _ in range(2)]
+    metrics.attach(channels)
+    for index, channel in enumerate(channels):
+        for _ in range(index + 1):
+            channel.send_nowait({'op': 'subscribe', 'args': ['trade']})
+    # The outbound queues of all connections are counted.
+    assert metrics.snapshot()['send_queue'] == 3
@@ -0,0 +1,54 @@
+"""Tests for the price level order book."""
+import pytest
+import trio
+
+from bitmex_trio_websocket.orderbook import OrderBook
+from bitmex_trio_websocket.storage import Storage
+
+LEVELS = [
+    {'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell', 'size': 10, 'price': 101.0},
+    {'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell', 'size': 20, 'price': 100.5},
+    {'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy', 'size': 30, 'price': 100.0},
+    {'symbol': 'XBTUSD', 'id': 4, 'side': 'Buy', 'size': 40, 'price': 99.5},
+]
+
+def test_top_of_book():
+    book = OrderBook('XBTUSD')
+    book.insert(LEVELS)
+    assert book.best_bid == (100.0, 30)
+    assert book.best_ask == (100.5, 20)
+    assert book.spread == 0.5
+    assert book.mid == 100.25
+
+    book.update([{'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy', 'size': 5}])
+    assert book.best_bid == (100.0, 5)
+
+    book.delete([{'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell'}])
+    assert book.best_ask == (101.0, 10)
+    assert list(book.depth('Buy')) == [(100.0, 5), (99.5, 40)]
+
+def test_to_numpy():
+    numpy = pytest.importorskip('numpy')
+    book = OrderBook('XBTUSD')
+    book.insert(LEVELS)
+    prices, sizes = book.to_numpy('Buy', 5)
+    assert prices.dtype == numpy.float64
+    assert prices.tolist() == [100.0, 99.5]
+    assert sizes.tolist() == [30.0, 40.0]
+    prices, sizes = book.to_numpy('Sell', 1)
+    assert prices.tolist() == [100.5]
+
+async def test_storage_maintains_book():
+    storage = Storage()
+    send_channel, receive_channel = trio.open_memory_channel(10)
+    send_channel.send_nowait({'table': 'orderBookL2', 'action': 'partial',
+                              'keys': ['symbol', 'id', 'side'], 'data': [dict(l) for l in LEVELS]})
+    send_channel.send_nowait({'table': 'orderBookL2', 'action': 'delete',
+                              'data': [{'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy'}]})
+    await send_channel.aclose()
+
+    async def output(item):
+        pass
+
+    await storage.pump(receive_channel, output)
+    assert storage.order_book('XBTUSD').best_bid == (99.5, 40)
@@ -0,0 +1,67 @@
+"""Tests for the outbound scheduler."""
+import pytest
+import trio
+
+from bitmex_trio_websocket.outbound import OutboundScheduler, TokenBucket
+
+async def _run(scheduler, ops, duration=None):
+    # Queue everything up front, like a burst that arrives while the websocket is busy.
+    for op in ops:
+        scheduler.put(op)
+    send_channel, receive_channel = trio.open_memory_channel(0)
+    await send_channel.aclose()
+    sent = []
+
+    async def collect(op):
+        sent.append((trio.current_time(), op))
+
+    with trio.move_on_after(duration if duration is not None else float('inf')):
+        await scheduler.pump(receive_channel, collect)
+    return sent
+
+async def test_priority_and_batching():
+    scheduler = OutboundScheduler()
+    sent = await _run(scheduler, [
+        {'op': 'subscribe', 'args': ['trade:XBTUSD']},
+        {'op': 'subscribe', 'args': ['quote:XBTUSD', 'trade:XBTUSD']},
+        {'op': 'unsubscribe', 'args': ['instrument']},
+        {'op': 'subscribe', 'args': 'trade:ETHUSD'},
+        {'op': 'cancelAllAfter', 'args': 60000},
+    ])
+    assert [op for _, op in sent] == [
+        {'op': 'cancelAllAfter', 'args': 60000},
+        {'op': 'subscribe', 'args': ['trade:XBTUSD', 'quote:XBTUSD']},
+        {'op': 'unsubscribe', 'args': ['instrument']},
+        {'op': 'subscribe', 'args': 'trade:ETHUSD'},
+    ]
+    assert scheduler.merged == 1
+    assert scheduler.latency['order'].count == 1
+    assert scheduler.latency['subscription'].count == 4
+    assert scheduler.backlog == 0
+
+async def test_rate_limit(autojump_clock):
+    scheduler = OutboundScheduler(rate=2, burst=2)
+    start = trio.current_time()
+    sent = await _run(scheduler, [{'op': 'cancelAllAfter', 'args': timeout} for timeout in range(6)])
+    times = [time - start for time, _ in sent]
+    assert times[:2] == [0, 0]
+    assert times[2:] == pytest.approx([0.5, 1.0, 1.5, 2.0])
+    # Queued operations wait for their turn.
+    assert scheduler.latency['order'].max == pytest.approx(2e9)
+
+async def test_heartbeat_overtakes_subscriptions(autojump_clock):
+    heartbeat = {'op': 'cancelAllAfter', 'args': 60000}
+    scheduler = OutboundScheduler(rate=1, burst=1, heartbeat=heartbeat, heartbeat_interval=15)
+    ops = [{'op': op, 'args': [f'trade:{index}']} for index in range(20) for op in ('subscribe', 'unsubscribe')]
+    sent = await _run(scheduler, ops, duration=20)
+    heartbeats = [time for time, op in sent if op is heartbeat]
+    assert len(heartbeats) == 2
+    # The second heartbeat waits for at most one token, despite the queued subscriptions.
+    assert heartbeats[1] - heartbeats[0] <= 16
+    assert scheduler.latency['heartbeat'].max <= 1e9
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+    with pytest.raises(ValueError):
+        TokenBucket(1, burst=0)
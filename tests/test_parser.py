@@ -0,0 +1,70 @@
+"""Tests for frame decoding and routing."""
+import json
+
+import pytest
+import trio
+
+from bitmex_trio_websocket.codec import get_backend, route
+from bitmex_trio_websocket.exceptions import BitMEXWebsocketApiError
+from bitmex_trio_websocket.parser import Parser
+
+TRADE = '{"table":"trade","action":"insert","data":[{"symbol":"XBTUSD","price":100.5}]}'
+
+async def _parse(parser, frames):
+    send_channel, receive_channel = trio.open_memory_channel(len(frames))
+    for frame in frames:
+        send_channel.send_nowait(frame)
+    await send_channel.aclose()
+    messages = []
+
+    async def output(message):
+        messages.append(message)
+
+    await parser.pump(receive_channel, output)
+    return messages
+
+def test_route():
+    assert route(TRADE) == ('trade', 'insert')
+    assert route(TRADE.encode()) == ('trade', 'insert')
+    assert route('{"info":"Welcome"}') is None
+    assert route('{"table":"trade"}') is None
+
+@pytest.mark.parametrize('name', ['orjson', 'ujson', 'json'])
+def test_backends(name):
+    try:
+        backend = get_backend(name)
+    except ImportError:
+        pytest.skip(f'{name} not installed')
+    assert backend.loads(TRADE) == json.loads(TRADE)
+    assert json.loads(backend.dumps({'op': 'subscribe', 'args': ['trade']})) == {'op': 'subscribe', 'args': ['trade']}
+    with pytest.raises(ValueError):
+        get_backend('yaml')
+
+async def test_parser_skips_unwanted_tables():
+    parser = Parser(wants=lambda table: table == 'trade')
+    messages = await _parse(parser, [
+        '{"info":"Welcome to the BitMEX Realtime API."}',
+        TRADE,
+        '{"table":"quote","action":"insert","data":[]}',
+    ])
+    assert parser.connections == 1
+    assert messages == [json.loads(TRADE)]
+    assert parser.skipped == 1
+
+async def test_parser_error():
+    with pytest.raises(BitMEXWebsocketApiError):
+        await _parse(Parser(), ['{"status":400,"error":"Unknown table","request":{"op":"subscribe"}}'])
+
+async def test_parser_tracks_subscriptions():
+    parser = Parser()
+    parser.wants = parser.subscribed
+    messages = await _parse(parser, [
+        '{"success":true,"subscribe":"trade:XBTUSD","request":{"op":"subscribe","args":["trade:XBTUSD"]}}',
+        TRADE,
+        '{"table":"quote","action":"insert","data":[]}',
+        '{"success":true,"unsubscribe":"trade:XBTUSD","request":{"op":"unsubscribe","args":["trade:XBTUSD"]}}',
+        TRADE,
+    ])
+    assert messages == [json.loads(TRADE)]
+    assert parser.skipped == 2
+    assert parser.topics == set()
@@ -0,0 +1,61 @@
+"""Tests for frame recording and replay."""
+import pytest
+import trio
+
+from bitmex_trio_websocket.recorder import Recorder, open_replay, read_frames, read_messages
+from bitmex_trio_websocket.storage import Storage
+
+FRAMES = [
+    '{"info":"Welcome to the BitMEX Realtime API."}',
+    '{"table":"instrument","action":"partial","keys":["symbol"],"attributes":{},'
+    '"data":[{"symbol":"XBTUSD","lastPrice":100.0}]}',
+    '{"table":"instrument","action":"update","data":[{"symbol":"XBTUSD","lastPrice":101.0}]}',
+]
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(tmp_path, compress):
+    path = tmp_path / 'frames.log'
+    for chunk in (FRAMES[:2], FRAMES[2:]):
+        recorder = Recorder(path, compress=compress)
+        recorder._open()
+        for i, frame in enumerate(chunk):
+            recorder.write(frame, timestamp=i)
+        recorder.close()
+    assert [frame for _, frame in read_frames(path)] == FRAMES
+    assert [timestamp for timestamp, _ in read_frames(path)] == [0, 1, 0]
+
+def test_compression_mismatch(tmp_path):
+    path = tmp_path / 'frames.log'
+    recorder = Recorder(path)
+    recorder._open()
+    recorder.close()
+    with pytest.raises(ValueError):
+        Recorder(path, compress=True)._open()
+
+async def test_replay(tmp_path):
+    path = tmp_path / 'frames.log'
+    recorder = Recorder(path)
+    send_channel, receive_channel = trio.open_memory_channel(len(FRAMES))
+    for frame in FRAMES:
+        send_channel.send_nowait(frame)
+    await send_channel.aclose()
+
+    async def output(frame):
+        pass
+
+    await recorder.pump(receive_channel, output)
+    assert recorder.frames == 3
+
+    storage = Storage()
+    async with open_replay(path, storage=storage) as pipeline, pipeline.tap() as aiter:
+        actions = [action async for _, _, _, action in aiter]
+    assert actions == ['partial', 'update']
+    assert storage.data['instrument'][('XBTUSD',)]['lastPrice'] == 101.0
+
+    # Replay without trio.
+    storage = Storage()
+    messages = list(read_messages(path))
+    assert [message['action'] for message in messages] == ['partial', 'update']
+    storage.apply_many(messages, changes=False)
+    assert storage.data['instrument'][('XBTUSD',)]['lastPrice'] == 101.0
+    assert not list(read_messages(path, tables=('trade',)))
@@ -0,0 +1,162 @@
+"""End-to-end tests against the local BitMEX server."""
+import pytest
+from async_generator import aclosing
+from trio_websocket import ConnectionRejected
+
+from bitmex_trio_websocket import open_bitmex_websocket
+from bitmex_trio_websocket.exceptions import BitMEXWebsocketApiError
+from bitmex_trio_websocket.sharding import ShardRouter
+from bitmex_trio_websocket.testing import open_bitmex_server
+
+async def test_listen_instrument():
+    async with open_bitmex_server(rates={'instrument': 100}) as server, \
+            open_bitmex_websocket('testnet', url=server.url) as bws:
+        count = 0
+        async with aclosing(bws.listen('instrument', 'XBTUSD')) as agen:
+            async for item in agen:
+                assert item['symbol'] == 'XBTUSD'
+                count += 1
+                if count == 3:
+                    break
+        assert bws.storage.data['instrument'][('XBTUSD',)]['lastPrice'] > 0
+
+async def test_orderbook():
+    async with open_bitmex_server() as server, open_bitmex_websocket('testnet', url=server.url) as bws:
+        async with aclosing(bws.listen('orderBookL2', 'XBTUSD')) as agen:
+            async for msg in agen:
+                # The partial delivers the whole book
+                assert len(msg) == 2
+                break
+        book = bws.storage.order_book('XBTUSD')
+        assert book.best_bid[0] < book.best_ask[0]
+
+async def test_conflate_orderbook():
+    async with open_bitmex_server() as server, open_bitmex_websocket('testnet', url=server.url) as bws:
+        items = []
+        async with aclosing(bws.listen('orderBookL2', 'XBTUSD', conflate=True)) as agen:
+            async for item in agen:
+                items.append(item)
+                if len(items) == 5:
+                    break
+        # The partial book is queued as is, and isn't written to while computing its key.
+        assert len(items[0]) == 2
+        assert all('id' in item for item in items[1:])
+        assert set(bws.storage.data['orderBookL2']['XBTUSD']) == {'Buy', 'Sell'}
+
+async def test_auth_fail():
+    async with open_bitmex_server(api_key='key', api_secret='secret') as server:
+        with pytest.raises(ConnectionRejected):
+            async with open_bitmex_websocket('testnet', 'abcd1234', 'efgh5678', url=server.url):
+                assert False
+
+async def test_auth_success():
+    async with open_bitmex_server(api_key='key', api_secret='secret', rates={'order': 100}) as server, \
+            open_bitmex_websocket('testnet', 'key', 'secret', url=server.url) as bws:
+        async with aclosing(bws.listen('order')) as agen:
+            async for item in agen:
+                assert 'orderID' in item
+                break
+
+async def test_unknown_symbol():
+    with pytest.raises(BitMEXWebsocketApiError):
+        async with open_bitmex_server() as server, open_bitmex_websocket('testnet', url=server.url) as bws:
+            async with aclosing(bws.listen('instrument', 'PAROTCOIN')) as agen:
+                async for _ in agen:
+                    pass
+
+async def test_listen_candles():
+    async with open_bitmex_server(rates={'trade': 200}) as server, \
+            open_bitmex_websocket('testnet', url=server.url) as bws:
+        async with aclosing(bws.listen_candles('XBTUSD', 0.1, closed_only=True)) as agen:
+            async for candle in agen:
+                assert candle.closed
+                assert candle.low <= candle.vwap <= candle.high
+                break
+        assert not bws._candles._candles
+
+async def test_listen_batches():
+    async with open_bitmex_server(rates={'orderBookL2': 200}) as server, \
+            open_bitmex_websocket('testnet', url=server.url) as bws:
+        async with aclosing(bws.listen_batches('orderBookL2', 'XBTUSD')) as agen:
+            partial = await agen.__anext__()
+            assert partial.action == 'partial' and len(partial.rows) == 1
+            batch = await agen.__anext__()
+            assert batch.symbol == 'XBTUSD' and batch.table == 'orderBookL2'
+            assert batch.rows and all(row['symbol'] == 'XBTUSD' for row in batch.rows)
+
+async def test_listen_book_deltas():
+    async with open_bitmex_server(rates={'orderBookL2': 200}) as server, \
+            open_bitmex_websocket('testnet', url=server.url) as bws:
+        async with aclosing(bws.listen_book_deltas('XBTUSD')) as agen:
+            snapshot = await agen.__anext__()
+            assert snapshot.snapshot and len(snapshot.levels) == 50
+            sequence = snapshot.sequence
+            async for delta in agen:
+                assert not delta.snapshot and delta.sequence == sequence + 1
+                sequence = delta.sequence
+                if sequence == snapshot.sequence + 10:
+                    break
+        assert bws.storage.order_book('XBTUSD').deltas is None
+        with pytest.raises(ValueError):
+            await bws.listen_book_deltas('XBTUSD', overflow='conflate').__anext__()
+
+async def test_listen_book_analytics():
+    async with open_bitmex_server(rates={'orderBookL2': 200}) as server, \
+            open_bitmex_websocket('testnet', url=server.url) as bws:
+        count = 0
+        last = None
+        async with aclosing(bws.listen_book_analytics('XBTUSD', threshold={'imbalance': 0.01})) as agen:
+            async for metrics in agen:
+                if last is not None:
+                    assert abs(metrics.imbalance - last.imbalance) > 0.01
+                last = metrics
+                count += 1
+                if count == 5:
+                    break
+        assert bws.storage.order_book('XBTUSD').analytics is None
+        with pytest.raises(ValueError):
+            async with aclosing(bws.listen_book_analytics('XBTUSD', threshold={'spread': 1})) as agen:
+                await agen.__anext__()
+
+async def test_reconnect_resync():
+    async with open_bitmex_server(rates={'orderBookL2': 0}) as server, \
+            open_bitmex_websocket('testnet', url=server.url, reconnect=True) as bws:
+        async with aclosing(bws.listen('orderBookL2', 'XBTUSD')) as agen:
+            book = await agen.__anext__()
+            assert len(book['Buy']) == 25
+
+            # Change the market while the client is disconnected.
+            levels = server.market.books['XBTUSD']
+            updated, deleted = list(levels)[:2]
+            levels[updated]['size'] = 123456
+            del levels[deleted]
+            inserted = server.market._level('XBTUSD', 'Buy', 1000.0)['id']
+            await server.disconnect()
+
+            # Only the differences are delivered, without reattaching the listener.
+            changes = [(await agen.__anext__())['id'] for _ in range(3)]
+            assert sorted(changes) == sorted([updated, deleted, inserted])
+
+        stats = bws.reconnect_stats
+        assert stats.reconnects == 1
+        assert stats.last_reconnect_time is not None and stats.last_gap is not None
+        assert bws.storage.order_book('XBTUSD').bids[1000.0] == server.market.books['XBTUSD'][inserted]['size']
+        assert all(deleted not in side for side in bws.storage.data['orderBookL2']['XBTUSD'].values())
+        assert len(bws.storage.order_book('XBTUSD')) == len(levels)
+
+async def test_sharded_connections():
+    router = ShardRouter(3)
+    async with open_bitmex_server(rates={'orderBookL2': 50}) as server, \
+            open_bitmex_websocket('testnet', url=server.url, connections=router) as bws:
+        assert len(server.sessions) == 3
+        async with aclosing(bws.listen('orderBookL2', 'XBTUSD')) as xbt, \
+                aclosing(bws.listen('orderBookL2', 'ETHUSD')) as eth, \
+                aclosing(bws.listen('instrument', 'XBTUSD')) as instrument:
+            await xbt.__anext__()
+            await eth.__anext__()
+            await instrument.__anext__()
+            assert router.shard('instrument', 'XBTUSD') == 0
+            # Each book gets a connection of its own.
+            assert {router.shard('orderBookL2', 'XBTUSD'), router.shard('orderBookL2', 'ETHUSD')} == {1, 2}
+            assert sorted(len(session.subscriptions) for session in server.sessions) == [1, 1, 1]
+        assert bws.storage.order_book('XBTUSD').best_bid < bws.storage.order_book('ETHUSD').best_bid
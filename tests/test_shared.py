@@ -0,0 +1,79 @@
+"""Tests for order books in shared memory."""
+import multiprocessing
+import os
+import sys
+
+import pytest
+from async_generator import aclosing
+
+from bitmex_trio_websocket import open_bitmex_websocket
+from bitmex_trio_websocket.orderbook import OrderBook
+from bitmex_trio_websocket.shared import SEQUENCE, SharedBooks, SharedBooksReader
+from bitmex_trio_websocket.testing import open_bitmex_server
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 8), reason='Shared memory requires Python 3.8 or newer.')
+
+def _name():
+    return f'bts-test-{os.getpid()}'
+
+def _book(*levels):
+    book = OrderBook('XBTUSD')
+    book.insert({'id': index, 'side': side, 'price': price, 'size': size}
+                for index, (side, price, size) in enumerate(levels))
+    return book
+
+def _read_top(name, queue):
+    with SharedBooksReader(name) as reader:
+        queue.put(reader.top('XBTUSD'))
+
+def test_publish_snapshot():
+    with SharedBooks(_name(), ['XBTUSD', 'ETHUSD'], depth=2) as shared:
+        with SharedBooksReader(shared.name) as reader:
+            assert reader.symbols == ('XBTUSD', 'ETHUSD')
+            assert reader.depth == 2
+            assert reader.sequence('XBTUSD') == 0
+            shared.publish('XBTUSD', _book(('Buy', 99, 10), ('Buy', 98, 20), ('Buy', 97, 30), ('Sell', 101, 5)))
+            snapshot = reader.snapshot('XBTUSD')
+            assert snapshot.sequence == 2
+            assert snapshot.bids == [(99, 10), (98, 20)]
+            assert snapshot.asks == [(101, 5)]
+            assert reader.top('XBTUSD') == ((99, 10), (101, 5))
+            assert reader.top('ETHUSD') == (None, None)
+
+def test_reader_process():
+    with SharedBooks(_name(), ['XBTUSD']) as shared:
+        shared.publish('XBTUSD', _book(('Buy', 99, 10), ('Sell', 101, 5)))
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_read_top, args=(shared.name, queue))
+        process.start()
+        assert queue.get(timeout=10) == ((99, 10), (101, 5))
+        process.join()
+
+def test_not_shared_books():
+    with SharedBooks(_name(), ['XBTUSD']) as shared:
+        shared._buffer[:4] = b'NOPE'
+        with pytest.raises(ValueError):
+            SharedBooksReader(shared.name)
+
+def test_reader_timeout():
+    with SharedBooks(_name(), ['XBTUSD']) as shared, SharedBooksReader(shared.name, timeout=0.01) as reader:
+        # A writer that died in the middle of a write leaves an odd sequence number.
+        SEQUENCE.pack_into(shared._buffer, shared._offsets['XBTUSD'], 1)
+        with pytest.raises(TimeoutError):
+            reader.snapshot('XBTUSD')
+
+async def test_publish_from_pipeline():
+    with SharedBooks(_name(), ['XBTUSD']) as shared, SharedBooksReader(shared.name) as reader:
+        async with open_bitmex_server(rates={'orderBookL2': 200}) as server, \
+                open_bitmex_websocket('testnet', url=server.url, publish=shared) as bws:
+            async with aclosing(bws.listen('orderBookL2', 'XBTUSD')) as agen:
+                count = 0
+                async for _ in agen:
+                    count += 1
+                    if count == 5:
+                        break
+            book = bws.storage.order_book('XBTUSD')
+            snapshot = reader.snapshot('XBTUSD')
+            assert snapshot.sequence > 0
+            assert snapshot.bids[0] == book.best_bid
+            assert snapshot.asks[0] == book.best_ask
@@ -0,0 +1,268 @@
+"""Tests for the storage engine."""
+import pytest
+import trio
+
+from bitmex_trio_websocket.policies import TablePolicy
+from bitmex_trio_websocket.storage import Storage
+
+def _order(order_id, leaves_qty):
+    return {'orderID': order_id, 'symbol': 'XBTUSD', 'leavesQty': leaves_qty,
+            'timestamp': '2021-01-01T00:00:00.000Z'}
+
+async def _pump(storage, messages):
+    send_channel, receive_channel = trio.open_memory_channel(len(messages))
+    for message in messages:
+        send_channel.send_nowait(message)
+    await send_channel.aclose()
+
+    async def output(item):
+        pass
+
+    await storage.pump(receive_channel, output)
+
+async def test_evict_closed_orders(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('bitmex_trio_websocket.storage.monotonic', lambda: clock[0])
+    storage = Storage()
+    await _pump(storage, [
+        {'table': 'order', 'action': 'partial', 'keys': ['orderID'],
+         'data': [_order('a', 0), _order('b', 100)]},
+    ])
+    clock[0] += 30
+    await _pump(storage, [
+        {'table': 'order', 'action': 'update', 'data': [{'orderID': 'b', 'leavesQty': 0}]},
+        {'table': 'order', 'action': 'insert', 'data': [_order('c', 0)]},
+    ])
+    # An order reopened by amending leavesQty is not evicted.
+    await _pump(storage, [
+        {'table': 'order', 'action': 'update', 'data': [{'orderID': 'c', 'leavesQty': 50}]},
+    ])
+    assert list(storage._closed_orders) == [('a',), ('b',)]
+
+    clock[0] += 31
+    assert storage.evict() == 1
+    assert sorted(storage.data['order']) == [('b',), ('c',)]
+
+    clock[0] += 30
+    assert storage.evict() == 1
+    assert list(storage.data['order']) == [('c',)]
+    assert not storage._closed_orders
+
+async def test_compact_rows():
+    storage = Storage(compact=True)
+    rows = []
+
+    async def output(batch):
+        rows.extend(batch.rows)
+
+    send_channel, receive_channel = trio.open_memory_channel(10)
+    send_channel.send_nowait({
+        'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+        'types': {'symbol': 'symbol', 'lastPrice': 'float', 'timestamp': 'timestamp'},
+        'data': [{'symbol': 'XBTUSD', 'lastPrice': 100.0, 'timestamp': '2021-01-01T00:00:00.000Z'}]})
+    send_channel.send_nowait({'table': 'instrument', 'action': 'update',
+                              'data': [{'symbol': 'XBTUSD', 'lastPrice': 101.0, 'fairPrice': 100.5}]})
+    await send_channel.aclose()
+    await storage.pump(receive_channel, output)
+
+    row = storage.data['instrument'][('XBTUSD',)]
+    assert type(row) is storage.records['instrument']
+    assert rows == [row, row]
+    assert dict(row) == {'symbol': 'XBTUSD', 'lastPrice': 101.0, 'timestamp': '2021-01-01T00:00:00.000Z',
+                         'fairPrice': 100.5}
+    assert 'lastPrice' in row and 'markPrice' not in row
+    assert row.get('markPrice') is None
+    assert not hasattr(row, '__dict__')
+
+async def test_secondary_indexes():
+    storage = Storage(indexes={'order': ['clOrdID', ('symbol', 'ordStatus')]})
+    def order(order_id, symbol, status):
+        return {'orderID': order_id, 'clOrdID': f'cl-{order_id}', 'symbol': symbol, 'ordStatus': status,
+                'leavesQty': 100}
+    await _pump(storage, [
+        {'table': 'order', 'action': 'partial', 'keys': ['orderID'],
+         'data': [order('a', 'XBTUSD', 'New'), order('b', 'ETHUSD', 'New')]},
+        {'table': 'order', 'action': 'insert', 'data': [order('c', 'XBTUSD', 'New')]},
+        {'table': 'order', 'action': 'update', 'data': [{'orderID': 'a', 'ordStatus': 'Filled', 'leavesQty': 0}]},
+        {'table': 'order', 'action': 'delete', 'data': [{'orderID': 'b'}]},
+    ])
+    assert storage.lookup('order', clOrdID='cl-c')['orderID'] == 'c'
+    assert storage.lookup('order', clOrdID='cl-b') is None
+    assert [row['orderID'] for row in storage.query('order', symbol='XBTUSD', ordStatus='New')] == ['c']
+    assert [row['orderID'] for row in storage.query('order', symbol='XBTUSD', ordStatus='Filled')] == ['a']
+    # Criteria without an index, and predicates, are checked against the candidate rows.
+    assert [row['orderID'] for row in storage.query('order', clOrdID='cl-a', where=lambda row: row['leavesQty'] == 0)] \
+        == ['a']
+    assert [row['orderID'] for row in storage.query('order', leavesQty=100)] == ['c']
+
+    # Evicted orders are removed from the indexes.
+    assert storage.evict(now=float('inf')) == 1
+    assert storage.lookup('order', clOrdID='cl-a') is None
+    assert len(storage.indexes['order'][('symbol', 'ordStatus')]) == 1
+
+async def test_snapshots():
+    storage = Storage()
+    await _pump(storage, [
+        {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+         'data': [{'symbol': 'XBTUSD', 'lastPrice': 100.0}, {'symbol': 'ETHUSD', 'lastPrice': 10.0}]},
+        {'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+         'data': [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'price': 99.0, 'size': 10},
+                  {'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell', 'price': 101.0, 'size': 20}]},
+    ])
+    instruments = storage.snapshot('instrument')
+    book = storage.snapshot('orderBookL2', 'XBTUSD')
+    assert instruments.sequence == 1 and book.sequence == 2
+    assert storage.snapshot('instrument') is instruments
+    assert storage.snapshot('orderBookL2', 'XBTUSD') is book
+
+    await _pump(storage, [
+        {'table': 'instrument', 'action': 'update', 'data': [{'symbol': 'XBTUSD', 'lastPrice': 101.0}]},
+        {'table': 'instrument', 'action': 'insert', 'data': [{'symbol': 'XRPUSD', 'lastPrice': 1.0}]},
+        {'table': 'orderBookL2', 'action': 'update', 'data': [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'size': 5}]},
+    ])
+    # The snapshots are unchanged, while storage has moved on.
+    assert instruments[('XBTUSD',)]['lastPrice'] == 100.0 and len(instruments) == 2
+    assert storage.data['instrument'][('XBTUSD',)]['lastPrice'] == 101.0
+    assert instruments[('ETHUSD',)] is storage.data['instrument'][('ETHUSD',)]
+    assert book.best_bid == (99.0, 10)
+    assert storage.order_book('XBTUSD').best_bid == (99.0, 5)
+    assert storage.snapshot('instrument').sequence == 4
+    assert storage.snapshot('orderBookL2', 'XBTUSD').sequence == 5
+    with pytest.raises(TypeError):
+        book.delete([{'id': 1, 'side': 'Buy'}])
+
+async def test_rows_before_partial():
+    storage = Storage()
+    rows = []
+
+    async def output(batch):
+        rows.append((batch.action, [dict(row) for row in batch.rows]))
+
+    def instrument(symbol, price, second):
+        return {'symbol': symbol, 'lastPrice': price, 'timestamp': f'2021-01-01T00:00:0{second}.000Z'}
+
+    messages = [
+        {'table': 'instrument', 'action': 'update', 'data': [instrument('XBTUSD', 99.0, 1)]},
+        {'table': 'instrument', 'action': 'insert', 'data': [instrument('ETHUSD', 10.0, 2)]},
+        {'table': 'instrument', 'action': 'update', 'data': [instrument('XBTUSD', 101.0, 3)]},
+        {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'filter': {'symbol': 'XBTUSD'},
+         'data': [instrument('XBTUSD', 100.0, 2)]},
+    ]
+    send_channel, receive_channel = trio.open_memory_channel(len(messages))
+    for message in messages:
+        send_channel.send_nowait(message)
+    await send_channel.aclose()
+    await storage.pump(receive_channel, output)
+
+    # The update from before the partial is discarded, since the partial is newer. The newer
+    # update is applied after the partial. The ETHUSD row waits for its own partial.
+    assert storage.data['instrument'][('XBTUSD',)]['lastPrice'] == 101.0
+    assert [action for action, _ in rows] == ['partial', 'update']
+    assert storage.buffered['instrument'] == 3
+    assert storage.discarded['instrument'] == 1
+    assert [row['symbol'] for _, row in storage._pending['instrument']] == ['ETHUSD']
+
+async def test_held_insert_in_partial():
+    storage = Storage()
+    rows = []
+
+    async def output(batch):
+        rows.append((batch.action, [dict(row) for row in batch.rows]))
+
+    def trade(match, second):
+        return {'symbol': 'XBTUSD', 'trdMatchID': match, 'price': 100.0, 'size': 1,
+                'timestamp': f'2021-01-01T00:00:0{second}.000Z'}
+
+    messages = [
+        {'table': 'trade', 'action': 'insert', 'data': [trade('a', 1)]},
+        {'table': 'trade', 'action': 'insert', 'data': [trade('b', 2)]},
+        {'table': 'trade', 'action': 'partial', 'keys': [], 'filter': {'symbol': 'XBTUSD'},
+         'attributes': {'symbol': 'grouped', 'trdMatchID': 'unique', 'price': '', 'size': '', 'timestamp': ''},
+         'data': [trade('a', 1)]},
+    ]
+    send_channel, receive_channel = trio.open_memory_channel(len(messages))
+    for message in messages:
+        send_channel.send_nowait(message)
+    await send_channel.aclose()
+    await storage.pump(receive_channel, output)
+
+    # The held trade with the same timestamp as the partial row is already in the partial.
+    assert rows == [('partial', [trade('a', 1)]), ('insert', [trade('b', 2)])]
+    assert storage.discarded['trade'] == 1
+
+def test_apply():
+    storage = Storage()
+    changes = storage.apply({'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+                             'data': [{'symbol': 'XBTUSD', 'lastPrice': 100.0}]})
+    assert [(batch.table, batch.action, len(batch.rows)) for batch in changes] == [('instrument', 'partial', 1)]
+    # Control messages change nothing.
+    assert storage.apply({'info': 'Welcome'}) == []
+
+    messages = [{'table': 'instrument', 'action': 'update', 'data': [{'symbol': 'XBTUSD', 'lastPrice': price}]}
+                for price in (101.0, 102.0)]
+    batches = storage.apply_many(messages)
+    assert [batch.rows[0]['lastPrice'] for batch in batches] == [101.0, 102.0]
+    assert storage.sequence == 3
+    assert storage.apply_many(messages, changes=False) == []
+    assert storage.sequence == 5
+
+    level = {'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'size': 10, 'price': 100.0}
+    partial, update = storage.apply_many([
+        {'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'], 'data': [level]},
+        {'table': 'orderBookL2', 'action': 'update', 'data': [dict(level, size=20)]}])
+    assert partial.rows[0]['Buy'][1]['size'] == 10
+    assert update.rows[0]['size'] == 20
+
+def _quote(symbol, second):
+    return {'symbol': symbol, 'timestamp': f'2021-01-01T00:00:{second:02d}.000Z', 'bidPrice': 100.0 + second}
+
+def test_policies():
+    storage = Storage(policies={'quote': TablePolicy(latest_only=True), 'trade': {'max_rows': 3, 'max_age': 10}})
+    storage.apply({'table': 'quote', 'action': 'partial', 'keys': ['timestamp', 'symbol'],
+                   'data': [_quote('XBTUSD', 0)]})
+    storage.apply_many({'table': 'quote', 'action': 'insert', 'data': [_quote(symbol, second)]}
+                       for second in range(1, 5) for symbol in ('XBTUSD', 'ETHUSD'))
+    assert {key: row['bidPrice'] for key, row in storage.data['quote'].items()} == {
+        ('ETHUSD',): 104.0, ('XBTUSD',): 104.0}
+
+    storage.apply({'table': 'trade', 'action': 'partial', 'keys': [], 'attributes': {'timestamp': 'sorted'},
+                   'data': [_quote('XBTUSD', 0)]})
+    storage.apply({'table': 'trade', 'action': 'insert', 'data': [_quote('XBTUSD', 5), _quote('ETHUSD', 8)]})
+    assert len(storage.data['trade']) == 3
+    # Rows more than 10 seconds older than the newest row are evicted.
+    storage.apply({'table': 'trade', 'action': 'insert', 'data': [_quote('XBTUSD', 12)]})
+    assert [row['timestamp'][17:19] for row in storage.data['trade'].values()] == ['05', '08', '12']
+    storage.apply({'table': 'trade', 'action': 'insert', 'data': [_quote('XBTUSD', 13), _quote('XBTUSD', 14)]})
+    assert [row['timestamp'][17:19] for row in storage.data['trade'].values()] == ['12', '13', '14']
+
+    with pytest.raises(ValueError):
+        storage.set_policy('orderBookL2', TablePolicy(max_rows=10))
+    with pytest.raises(ValueError):
+        TablePolicy(latest_only=True, keys=['symbol'])
+
+def test_policy_rekeys_table():
+    storage = Storage()
+    storage.add_index('quote', 'bidPrice')
+    storage.apply({'table': 'quote', 'action': 'partial', 'keys': ['timestamp', 'symbol'],
+                   'data': [_quote('XBTUSD', 0), _quote('ETHUSD', 0), _quote('XBTUSD', 1)]})
+    storage.set_policy('quote', {'latest_only': True, 'max_age': 60})
+    storage.apply({'table': 'quote', 'action': 'partial', 'keys': ['timestamp', 'symbol'],
+                   'data': [_quote('XBTUSD', 2)]})
+    assert {key: row['bidPrice'] for key, row in storage.data['quote'].items()} == {
+        ('ETHUSD',): 100.0, ('XBTUSD',): 102.0}
+    assert [row['symbol'] for row in storage.query('quote', bidPrice=100.0)] == ['ETHUSD']
+    assert not storage.query('quote', bidPrice=101.0)
+
+def test_memory_usage():
+    storage = Storage(history={'trade': 100})
+    storage.apply({'table': 'trade', 'action': 'partial', 'keys': [],
+                   'attributes': {'timestamp': 'sorted', 'symbol': 'grouped'},
+                   'data': [_quote(symbol, second) for second in range(10) for symbol in ('XBTUSD', 'ETHUSD')]})
+    storage.apply({'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+                   'data': [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Buy', 'size': 10, 'price': 99.0}]})
+    usage = storage.memory_usage()
+    assert usage['trade']['rows'] == 20
+    assert usage['trade']['symbols']['XBTUSD']['rows'] == 10
+    assert usage['trade']['bytes'] == sum(entry['bytes'] for entry in usage['trade']['symbols'].values()) > 0
+    assert usage['trade']['history_bytes'] > 0
+    assert usage['orderBookL2']['symbols']['XBTUSD']['rows'] == 1